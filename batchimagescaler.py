@@ -1,9 +1,15 @@
-
-
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
-import os, requests, json
-import requests
-from datetime import datetime
+from azure.core.exceptions import ResourceNotFoundError
+import os, json, asyncio, argparse
+import shared.storage as storage
+import shared.event_loop as event_loop
+import shared.http_client as http_client
+import shared.bulk_runner as bulk_runner
+import shared.work_claims as work_claims
+import shared.result_sink as result_sink
+import shared.blob_transfer as blob_transfer
+from shared.image_scaler import ImageHelper
+from shared.batch_analyzer import BatchImageAnalyzer
+from shared.image_source import ImageSource
 
 def load_environment_vars():
     """
@@ -21,42 +27,171 @@ def load_environment_vars():
         os.environ[key] = value
 
 
-load_environment_vars()
-
-endpoint = "http://localhost:7071/api/orchestrator"
-
-# Create a BlobServiceClient object
-blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_ACCOUNT_CONNECTION'))
+def orchestrator_handler(endpoint):
+    """
+    This function returns a handler that runs an image through the orchestrator function.
+    """
+    async def handler(filename):
+        # Processing an image creates persons, so it is only retried when the orchestrator did not get the request
+        response = await http_client.get_client().get(endpoint, 'orchestrator', idempotent=False, params={'filename': filename})
+        response.raise_for_status()
+    return handler
 
-# Get the list of blobs in the original image container
-original_container_client = blob_service_client.get_container_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'))
-blobs = list(original_container_client.list_blobs())
 
-total_blobs = len(blobs)
-# Print the total amount of blobs
-print(f"Total blobs in container: {total_blobs}")
+def in_process_handler():
+    """
+    This function returns a handler that runs an image through an ImageProcessor in this process, without the
+    function host.
+    """
+    # Imported here so the other modes don't need the orchestrator's dependencies
+    from image_processor import ImageProcessor
+    processor = ImageProcessor()
 
-start_time = datetime.now()
+    async def handler(filename):
+        await processor.process_async(filename)
+    return handler
 
-i = 1
-for blob in blobs:
-    filename = blob.name
-    print(f"{i} of {total_blobs}: {filename}")
-    
-    response = requests.get(endpoint, params={'filename': filename})
 
-    if response.status_code != 200:
-        print(f"Error: {response.status_code}")
+class AnalysisBatcher:
+    """
+    Collects the images the runner hands out one at a time into batches for BatchImageAnalyzer.  A batch is sent
+    once it is full, or when the first image in it has waited linger_seconds.
+    """
 
-    i += 1
+    def __init__(self, analyzer, linger_seconds=1.0):
+        self.analyzer = analyzer
+        self.linger_seconds = linger_seconds
+        self._pending = []
+        self._timer = None
+
+    async def analyze(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.analyzer.max_images:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.linger_seconds, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._analyze(batch))
+
+    async def _analyze(self, batch):
+        try:
+            results = await self.analyzer.analyze_images_async([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for item, future in batch:
+            if not future.done():
+                future.set_result(results[item['key']])
+
+
+async def save_analysis(filename, analysis):
+    """
+    This function adds a narrative and categories to the stored result for an image, creating the result if the
+    image has not been processed yet.
+    """
+    result_container = os.getenv('ORCHESTRATOR_RESULT_CONTAINER')
+    if result_container is None:
+        print(f"{filename}: {json.dumps(analysis)}")
+        return
 
-    if i > 100:
-        break
+    result_blob_client = storage.get_blob_service_client().get_blob_client(result_container, f"{os.path.splitext(filename)[0]}.json")
+    try:
+        result = json.loads(await (await result_blob_client.download_blob()).readall())
+    except ResourceNotFoundError:
+        result = {'filename': filename}
 
-end_time = datetime.now()
+    result['ainarrative'] = analysis['narrative']
+    result['categories'] = analysis['categories']
+    await result_blob_client.upload_blob(json.dumps(result), overwrite=True)
 
-# Print total time in seconds
-print(f"Total time: {(end_time - start_time).total_seconds()} seconds")
 
+def analysis_handler(batcher):
+    """
+    This function returns a handler that only generates the narrative and categories for an image, with batched
+    Azure OpenAI requests, rather than running it through the orchestrator.
+    """
+    helper = ImageHelper()
+    llm_settings = helper.get_output_settings('llm')
+
+    async def handler(filename):
+        # Resize the image the same way the pipeline does for the narrative and categories
+        blob_client = storage.get_blob_service_client().get_blob_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'), filename)
+        image_data = await blob_transfer.download_bytes(blob_client, helper.get_max_original_bytes())
+        resized = (await helper.create_derivatives_async(image_data, {ImageHelper.PRIMARY_DERIVATIVE: llm_settings}))[ImageHelper.PRIMARY_DERIVATIVE]
+
+        analysis = await batcher.analyze({
+            'key': filename,
+            'image': ImageSource.from_bytes(resized['data'], ImageHelper.OUTPUT_FORMATS[resized['format']]['content_type']),
+            'width': resized['width'],
+            'height': resized['height']
+        })
+        if 'error' in analysis:
+            raise RuntimeError(analysis['error'])
+
+        await save_analysis(filename, analysis)
+    return handler
+
+
+parser = argparse.ArgumentParser(description="Runs the images in the original image container through the pipeline.")
+parser.add_argument('--mode', choices=['orchestrator', 'in-process', 'analysis'], default='orchestrator',
+                    help="'orchestrator' calls the orchestrator function for each image.  'in-process' runs the pipeline in this process.  'analysis' only backfills the narrative and categories, several images per Azure OpenAI request.")
+parser.add_argument('--endpoint', default="http://localhost:7071/api/orchestrator", help="The orchestrator function to call in 'orchestrator' mode.")
+parser.add_argument('--concurrency', type=int, help="How many images are processed at once.  Defaults to BULK_CONCURRENCY, or enough to fill every batch in 'analysis' mode.")
+parser.add_argument('--prefix', help="Only process the blobs whose names start with this.")
+parser.add_argument('--limit', type=int, default=0, help="The most images to list, 0 for all of them.")
+parser.add_argument('--checkpoint', help="The file that records the finished images, so a rerun skips them.  Defaults to batchimagescaler.<mode>.checkpoint.")
+parser.add_argument('--shard-index', type=int, default=0, help="The part of the container this worker processes, from 0 to --shard-count - 1.")
+parser.add_argument('--shard-count', type=int, default=1, help="How many workers the container is split between.  Each blob belongs to one shard by a hash of its name.")
+parser.add_argument('--report-seconds', type=float, help="How often to report the progress.  Defaults to BULK_REPORT_SECONDS or 10.")
+args = parser.parse_args()
+
+if not 0 <= args.shard_index < args.shard_count:
+    parser.error("--shard-index must be from 0 to --shard-count - 1")
 
+load_environment_vars()
 
+if args.mode == 'analysis':
+    analyzer = BatchImageAnalyzer()
+    handler = analysis_handler(AnalysisBatcher(analyzer))
+    concurrency = args.concurrency or analyzer.max_images * analyzer.concurrency
+elif args.mode == 'in-process':
+    handler = in_process_handler()
+    concurrency = args.concurrency
+else:
+    handler = orchestrator_handler(args.endpoint)
+    concurrency = args.concurrency
+
+checkpoint = bulk_runner.Checkpoint(args.checkpoint or f"batchimagescaler.{args.mode}.checkpoint")
+print(f"{len(checkpoint)} images already processed according to {checkpoint.path}")
+
+# With WORK_CLAIM_CONTAINER set, workers on other machines don't process the same images, and images they finished are skipped
+claims = work_claims.get_claims(f"bulk-{args.mode}")
+if claims is not None:
+    print(f"Claiming images in the {claims.container} container as {claims.worker_id}")
+
+runner = bulk_runner.BulkRunner(handler, concurrency, checkpoint, args.report_seconds, on_report=print, claims=claims)
+names = bulk_runner.list_blob_names(os.getenv('ORIGINAL_IMAGE_CONTAINER'), args.prefix, args.limit)
+names = work_claims.shard_names(names, args.shard_index, args.shard_count)
+summary = runner.run(names)
+
+# Store the results still waiting in the spools while the process can still open connections
+for sink in (result_sink.get_sink(), result_sink.get_blob_sink()):
+    if sink is not None:
+        sink.close()
+
+event_loop.run_sync(http_client.get_client().close())
+
+print(f"Processed {summary['completed']} images, {summary['failed']} failed, {summary['skipped']} were already processed and {summary['claimed']} were claimed or finished by other workers.")
+print(f"Total time: {summary['total_time']:.1f} seconds, {summary['throughput']:.2f} images per second, "
+      f"p50 {summary['p50']:.2f}s  p95 {summary['p95']:.2f}s  p99 {summary['p99']:.2f}s")
@@ -0,0 +1,118 @@
+"""
+Compares uploading and downloading blobs with the storage SDK's default settings against the chunked, parallel
+transfers of shared/blob_transfer.py, and reports the peak memory of resizing a huge panorama within the
+decode budget.
+
+It needs a storage account, ex: Azurite from .devcontainer/docker-compose.yml, and STORAGE_ACCOUNT_CONNECTION
+in local.settings.json.  The blobs are written to the --container container, which is created if it doesn't
+exist, and deleted afterwards.  Azurite runs on the same machine, so the gains from parallel requests are
+smaller than against a storage account across a network.
+
+Usage: python benchmarks/benchmark_blob_transfer.py --megabytes 1 20 200 --concurrency 1 4 8 --chunk-megabytes 4
+"""
+import os, sys, json, argparse, asyncio, time, tracemalloc, resource
+from concurrent.futures import ProcessPoolExecutor
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob.aio import BlobServiceClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.blob_transfer as blob_transfer
+from shared.image_scaler import ImageHelper
+from synthetic_images import make_image
+
+
+def load_settings(path):
+    # Load the function app settings, the same way batchimagescaler.py does, without overriding the environment
+    if os.path.exists(path):
+        with open(path) as f:
+            for key, value in json.load(f)['Values'].items():
+                os.environ.setdefault(key, value)
+
+
+async def measure(transfer):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    await transfer()
+    elapsed = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+async def run(container, size_bytes, settings):
+    data = os.urandom(size_bytes)
+    results = {}
+
+    for label, client_settings, concurrency in settings:
+        async with BlobServiceClient.from_connection_string(os.getenv('STORAGE_ACCOUNT_CONNECTION'), **client_settings) as blob_service_client:
+            container_client = blob_service_client.get_container_client(container)
+            try:
+                await container_client.create_container()
+            except ResourceExistsError:
+                pass
+
+            blob_client = container_client.get_blob_client(f"benchmark-{size_bytes}")
+            if concurrency is None:
+                upload = lambda: blob_client.upload_blob(data, overwrite=True)
+                async def download():
+                    await (await blob_client.download_blob()).readall()
+            else:
+                upload = lambda: blob_transfer.upload_bytes(blob_client, data, concurrency, overwrite=True)
+                download = lambda: blob_transfer.download_bytes(blob_client, max_concurrency=concurrency)
+
+            results[label] = (await measure(upload), await measure(download))
+            await blob_client.delete_blob()
+
+    return results
+
+
+def resize_panorama(image_data, budget_bytes):
+    # Runs in a fresh process, so its peak resident memory is the resize's.  Pillow allocates rasters outside
+    # the Python allocator, where tracemalloc can't see them.
+    os.environ['IMAGE_DECODE_MAX_BYTES'] = str(budget_bytes)
+    helper = ImageHelper()
+
+    start_time = time.perf_counter()
+    # The 'best' strategy doesn't DCT scale on decode unless the image is over the decode budget
+    helper.create_derivatives(image_data, {ImageHelper.PRIMARY_DERIVATIVE: helper.get_output_settings()}, 'best')
+    elapsed = time.perf_counter() - start_time
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megabytes', type=float, nargs='+', default=[1, 20, 200])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--chunk-megabytes', type=float, default=4)
+    parser.add_argument('--container', default='benchmark-transfers')
+    parser.add_argument('--panorama-megapixels', type=float, default=200, help="The size of the panorama to resize, 0 to skip it.")
+    parser.add_argument('--settings', default='local.settings.json')
+    args = parser.parse_args()
+
+    load_settings(args.settings)
+
+    os.environ['BLOB_TRANSFER_CHUNK_BYTES'] = str(int(args.chunk_megabytes * 1024 * 1024))
+    settings = [('sdk defaults', {}, None)]
+    settings += [(f"{concurrency} x {args.chunk_megabytes:g} MB", blob_transfer.get_client_settings(), concurrency) for concurrency in args.concurrency]
+
+    for megabytes in args.megabytes:
+        size_bytes = int(megabytes * 1024 * 1024)
+        print(f"{megabytes:g} MB blob")
+        results = asyncio.run(run(args.container, size_bytes, settings))
+        for label, ((upload_time, upload_peak), (download_time, download_peak)) in results.items():
+            print(f"  {label:14} upload {upload_time:6.2f}s {size_bytes / upload_time / 1024 / 1024:7.1f} MB/s  peak {upload_peak / 1024 / 1024:6.1f} MB"
+                  f"   download {download_time:6.2f}s {size_bytes / download_time / 1024 / 1024:7.1f} MB/s  peak {download_peak / 1024 / 1024:6.1f} MB")
+
+    if args.panorama_megapixels:
+        # A wide JPEG the size of a stitched phone panorama
+        image_data = make_image(args.panorama_megapixels, 'JPEG', aspect=4)
+        budget = ImageHelper().get_decode_budget()
+        print(f"{args.panorama_megapixels:g} MP panorama, {len(image_data) / 1024 / 1024:.1f} MB, decode budget {budget / 1024 / 1024:.0f} MB")
+        for label, budget_bytes in (('budget', budget), ('no budget', 2**62)):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                elapsed, peak = executor.submit(resize_panorama, image_data, budget_bytes).result()
+            print(f"  {label:14} {elapsed:.2f}s  peak resident memory {peak / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares the transfers and memory of the blob trigger's original flow against the current one.  The original
+flow downloaded the upload, uploaded it again to the original image container, and then the processor
+downloaded it a third time.  The current flow downloads the upload once, hands the bytes to the processor, and
+archives the upload with a server-side copy while the image is processed.
+
+Only the resize stage runs, so no AI service is called.  It needs a storage account, ex: Azurite from
+.devcontainer/docker-compose.yml, and the container settings in local.settings.json.  The bytes of the original
+image moved through this process and the peak of Python allocations are reported for each flow.
+
+Usage: python benchmarks/benchmark_blob_trigger.py --megapixels 1 12 48
+"""
+import os, sys, json, argparse, asyncio, time, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.storage as storage
+import shared.http_client as http_client
+import image_processor
+from synthetic_images import make_image
+
+
+def load_settings(path):
+    # Load the function app settings, the same way batchimagescaler.py does, without overriding the environment
+    if os.path.exists(path):
+        with open(path) as f:
+            for key, value in json.load(f)['Values'].items():
+                os.environ.setdefault(key, value)
+
+
+async def original_flow(upload_blob_client, original_blob_client, filename):
+    blob_data = await (await upload_blob_client.download_blob()).readall()
+    await original_blob_client.upload_blob(blob_data, overwrite=True)
+    result = json.loads(await image_processor.ImageProcessor().process_async(filename, 'resize'))
+    # Downloaded, uploaded, then downloaded again by the processor
+    return len(blob_data) * 2 + result['metrics']['image_download_bytes']
+
+
+async def current_flow(upload_blob_client, original_blob_client, filename):
+    copy_task = asyncio.ensure_future(storage.copy_blob(upload_blob_client, original_blob_client))
+    try:
+        blob_data = await (await upload_blob_client.download_blob()).readall()
+        result = json.loads(await image_processor.ImageProcessor().process_async(filename, 'resize', image_data=blob_data))
+    finally:
+        await copy_task
+    return len(blob_data) + result['metrics']['image_download_bytes']
+
+
+async def run(flow, image_data, filename):
+    blob_service_client = storage.get_blob_service_client()
+    upload_blob_client = blob_service_client.get_blob_client(os.getenv('UPLOAD_IMAGE_CONTAINER'), filename)
+    original_blob_client = blob_service_client.get_blob_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'), filename)
+    await upload_blob_client.upload_blob(image_data, overwrite=True)
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    transferred = await flow(upload_blob_client, original_blob_client, filename)
+    elapsed = time.perf_counter() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    await upload_blob_client.delete_blob()
+    await http_client.get_client().close()
+    return elapsed, transferred, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 12, 48])
+    parser.add_argument('--settings', default='local.settings.json')
+    args = parser.parse_args()
+
+    load_settings(args.settings)
+
+    # The result cache would answer the second flow without processing the image
+    os.environ['RESULT_CACHE_MEMORY_BYTES'] = '0'
+    os.environ.pop('RESULT_CACHE_PATH', None)
+    os.environ.pop('RESULT_CACHE_CONTAINER', None)
+
+    for megapixels in args.megapixels:
+        image_data = make_image(megapixels, 'JPEG')
+        print(f"{megapixels} MP JPEG, {len(image_data) / 1024 / 1024:.1f} MB")
+        for label, flow in (('original', original_flow), ('current', current_flow)):
+            elapsed, transferred, peak = asyncio.run(run(flow, image_data, f"benchmark-{megapixels}mp.jpg"))
+            print(f"  {label:9} {elapsed:.2f}s  transferred {transferred / 1024 / 1024:.1f} MB  peak python memory {peak / 1024 / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
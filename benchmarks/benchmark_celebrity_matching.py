@@ -0,0 +1,105 @@
+"""
+Measures how celebrities are matched to faces in crowded photos.  Each synthetic scene is a tight grid of face
+boxes, ex: a stadium crowd, with some of the faces recognized as celebrities.  The celebrity boxes are jittered
+and a little larger than the face boxes, the way the Vision and Face APIs disagree, so they touch their
+neighbours too.
+
+The first overlap loop the face stage used to run is compared with the IoU assignment in box_matching, for
+the time per scene and how many celebrity names land on the right face.
+
+Usage: python benchmarks/benchmark_celebrity_matching.py --faces 100 300 1000 --celebrities 0.1
+"""
+import os, sys, argparse, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.box_matching as box_matching
+
+
+def make_scene(faces, celebrity_share, rng):
+    # Lay the faces out in rows with a small gap between them
+    size = 40
+    gap = 4
+    columns = max(1, int(faces ** 0.5 * 1.5))
+    face_rectangles = []
+    for i in range(faces):
+        face_rectangles.append({
+            'left': (i % columns) * (size + gap) + rng.randint(-2, 2),
+            'top': (i // columns) * (size + gap) + rng.randint(-2, 2),
+            'width': size,
+            'height': size
+        })
+
+    celebrities = []
+    truth = {}
+    for face_index in rng.sample(range(faces), max(1, int(faces * celebrity_share))):
+        face = face_rectangles[face_index]
+        grow = rng.randint(4, 10)
+        name = f"Celebrity {len(celebrities)}"
+        celebrities.append({
+            'name': name,
+            'faceRectangle': {
+                'left': face['left'] - grow // 2 + rng.randint(-4, 4),
+                'top': face['top'] - grow // 2 + rng.randint(-4, 4),
+                'width': size + grow,
+                'height': size + grow
+            }
+        })
+        truth[face_index] = name
+
+    return face_rectangles, celebrities, truth
+
+
+def first_overlap(face_rectangles, celebrities):
+    # The matching the face stage used before: the first celebrity whose box touches the face at all
+    names = []
+    for face in face_rectangles:
+        name = None
+        for celebrity in celebrities:
+            box = celebrity['faceRectangle']
+            if (max(face['left'], box['left']) <= min(face['left'] + face['width'], box['left'] + box['width'])
+                    and max(face['top'], box['top']) <= min(face['top'] + face['height'], box['top'] + box['height'])):
+                name = celebrity['name']
+                break
+        names.append(name)
+    return names
+
+
+def iou_assignment(face_rectangles, celebrities, min_iou):
+    matches = box_matching.match_boxes(face_rectangles, [celebrity['faceRectangle'] for celebrity in celebrities], min_iou)
+    return [celebrities[matches[i]]['name'] if i in matches else None for i in range(len(face_rectangles))]
+
+
+def score(names, truth):
+    correct = sum(1 for face_index, name in truth.items() if names[face_index] == name)
+    wrong = sum(1 for face_index, name in enumerate(names) if name is not None and truth.get(face_index) != name)
+    return correct, wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', type=int, nargs='+', default=[100, 300, 1000])
+    parser.add_argument('--celebrities', type=float, default=0.1, help='The share of faces that are celebrities')
+    parser.add_argument('--scenes', type=int, default=20)
+    parser.add_argument('--min-iou', type=float, default=0.3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    for faces in args.faces:
+        scenes = [make_scene(faces, args.celebrities, rng) for _ in range(args.scenes)]
+        celebrities = sum(len(truth) for _, _, truth in scenes)
+
+        for label, match in (('first overlap', first_overlap), ('iou assignment', lambda f, c: iou_assignment(f, c, args.min_iou))):
+            correct = 0
+            wrong = 0
+            start_time = time.perf_counter()
+            for face_rectangles, scene_celebrities, truth in scenes:
+                scene_correct, scene_wrong = score(match(face_rectangles, scene_celebrities), truth)
+                correct += scene_correct
+                wrong += scene_wrong
+            elapsed = (time.perf_counter() - start_time) / len(scenes)
+
+            print(f"{faces:5} faces  {label:14}  {elapsed * 1000:7.2f} ms/scene  correct {correct}/{celebrities}  wrong names {wrong}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Measures resize throughput for each ImageHelper resize strategy over a corpus of synthetic images.
+Each worker process is pinned to its share of the corpus so the images/sec per core figure is comparable
+between machines.
+
+Usage: python benchmarks/benchmark_decode.py --images 40 --workers 1
+"""
+import os, sys, argparse, time
+from multiprocessing import get_context
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.image_scaler as image_scaler
+from synthetic_images import make_corpus
+
+corpus = []
+
+
+def resize_all(args):
+    quality, indexes = args
+    helper = image_scaler.ImageHelper()
+    start_time = time.perf_counter()
+    for i in indexes:
+        helper.resize_image_data(corpus[i][1], quality=quality)
+    return time.perf_counter() - start_time
+
+
+def main():
+    global corpus
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--strategies', default=','.join(image_scaler.ImageHelper.RESIZE_STRATEGIES))
+    args = parser.parse_args()
+
+    print(f"Generating {args.images} synthetic images...")
+    corpus = make_corpus(args.images)
+    print(f"Corpus: {sum(len(data) for _, data in corpus) / 1024 / 1024:.0f} MB encoded")
+
+    # Fork after the corpus exists so the workers share it rather than receiving pickled copies
+    context = get_context('fork')
+    with context.Pool(args.workers) as pool:
+        for quality in args.strategies.split(','):
+            shards = [(quality, range(i, len(corpus), args.workers)) for i in range(args.workers)]
+            start_time = time.perf_counter()
+            busy_times = pool.map(resize_all, shards)
+            wall_time = time.perf_counter() - start_time
+
+            print(f"{quality:9} {len(corpus) / wall_time:6.2f} images/sec  "
+                  f"{len(corpus) / sum(busy_times):6.2f} images/sec/core  wall {wall_time:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compares the separate narrative and category requests against the combined image analysis request.  Every
+image is resized to the llm derivative and sent inline to the Azure OpenAI deployment both ways, one image at a
+time, and the latency and token usage per image are reported.
+
+This calls the real deployment, so it needs AZURE_OPEN_AI_ENDPOINT and AZURE_OPEN_AI_KEY, either in the
+environment or in local.settings.json.
+
+Usage: python benchmarks/benchmark_image_analysis.py --images 10
+       python benchmarks/benchmark_image_analysis.py --folder ./photos
+"""
+import os, sys, json, argparse, asyncio, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.http_client as http_client
+import shared.image_scaler as image_scaler
+import shared.narrative_generator as narrative_generator
+import shared.category_generator as category_generator
+import shared.image_analyzer as image_analyzer
+from shared.image_source import ImageSource
+from synthetic_images import make_corpus
+
+
+def load_settings(path):
+    # Load the function app settings, the same way batchimagescaler.py does, without overriding the environment
+    if os.path.exists(path):
+        with open(path) as f:
+            for key, value in json.load(f)['Values'].items():
+                os.environ.setdefault(key, value)
+
+
+def load_images(args):
+    if args.folder:
+        names = sorted(os.listdir(args.folder))[:args.images]
+        images = []
+        for name in names:
+            with open(os.path.join(args.folder, name), 'rb') as f:
+                images.append((name, f.read()))
+        return images
+    return make_corpus(args.images)
+
+
+async def separate(image):
+    return await asyncio.gather(
+        narrative_generator.NarrativeGenerator().generate_narrative_async(image),
+        category_generator.CategoryGenerator().generate_categories_async(image)
+    )
+
+
+async def combined(image):
+    return await image_analyzer.ImageAnalyzer().analyze_image_async(image)
+
+
+async def run(mode, images):
+    latencies = []
+    prompt_tokens = 0
+    completion_tokens = 0
+    fallbacks = 0
+    for image in images:
+        with http_client.collect_stats() as stats:
+            start_time = time.perf_counter()
+            result = await mode(image)
+            latencies.append(time.perf_counter() - start_time)
+
+        for endpoint in stats.summary().values():
+            prompt_tokens += endpoint.get('prompt_tokens', 0)
+            completion_tokens += endpoint.get('completion_tokens', 0)
+        if isinstance(result, dict) and result['fallback']:
+            fallbacks += 1
+
+    await http_client.get_client().close()
+
+    latencies.sort()
+    return {
+        'mean': sum(latencies) / len(latencies),
+        'p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        'prompt_tokens': prompt_tokens / len(images),
+        'completion_tokens': completion_tokens / len(images),
+        'fallbacks': fallbacks
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=10)
+    parser.add_argument('--folder', help='A folder of images to use instead of synthetic ones')
+    parser.add_argument('--settings', default='local.settings.json')
+    args = parser.parse_args()
+
+    load_settings(args.settings)
+
+    # Send the images the way the pipeline sends the llm derivative
+    helper = image_scaler.ImageHelper()
+    images = []
+    for name, data in load_images(args):
+        resized = helper.resize_image_data(data, output_settings=helper.get_output_settings('llm'))
+        images.append(ImageSource.from_bytes(resized['data'], helper.OUTPUT_FORMATS[resized['format']]['content_type']))
+    print(f"Prepared {len(images)} images")
+
+    for label, mode in (('separate', separate), ('combined', combined)):
+        stats = asyncio.run(run(mode, images))
+        print(f"{label:9} mean {stats['mean']:.2f}s  p95 {stats['p95']:.2f}s  "
+              f"prompt {stats['prompt_tokens']:.0f} tokens  completion {stats['completion_tokens']:.0f} tokens  "
+              f"fallbacks {stats['fallbacks']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Compares resize throughput on the event loop's thread pool against the ImagePool worker processes as the
+number of workers grows, and how long the event loop stalls meanwhile.  A stalled loop holds up every AI call
+in flight on it.
+
+The stall is measured by a ticker that asks to wake every 10 ms.  The lateness of each tick is how long the
+loop couldn't run it.  Throughput can only scale up to the number of cores on the machine.
+
+Usage: python benchmarks/benchmark_image_pool.py --images 32 --megapixels 12 --workers 1 2 4 8
+"""
+import os, sys, argparse, asyncio, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared.image_scaler import ImageHelper
+from shared.image_pool import ImagePool
+from synthetic_images import make_image
+
+
+async def measure_stalls(stalls, interval=0.01):
+    while True:
+        start_time = time.perf_counter()
+        await asyncio.sleep(interval)
+        stalls.append(time.perf_counter() - start_time - interval)
+
+
+async def run(engine, workers, images, derivative_settings):
+    helper = ImageHelper()
+    pool = None
+    if engine == 'process':
+        pool = ImagePool(workers)
+        # Warm the workers up first, the pool is started once per function host
+        await asyncio.gather(*(pool.create_derivatives(images[0], derivative_settings) for _ in range(workers)))
+
+    # The same number of resizes in flight for both engines
+    semaphore = asyncio.Semaphore(workers)
+    loop = asyncio.get_running_loop()
+
+    async def resize(image_data):
+        async with semaphore:
+            if pool is None:
+                await loop.run_in_executor(None, helper.create_derivatives, image_data, derivative_settings)
+            else:
+                await pool.create_derivatives(image_data, derivative_settings)
+
+    stalls = []
+    ticker = asyncio.ensure_future(measure_stalls(stalls))
+    start_time = time.perf_counter()
+    await asyncio.gather(*(resize(image_data) for image_data in images))
+    elapsed = time.perf_counter() - start_time
+    ticker.cancel()
+
+    if pool is not None:
+        pool.close()
+
+    stalls.sort()
+    return len(images) / elapsed, stalls[int(len(stalls) * 0.99)] if stalls else 0.0, stalls[-1] if stalls else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=32)
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    # A few different images, so nothing is answered from a cache
+    images = [make_image(args.megapixels, 'JPEG', quality=85 + index % 10) for index in range(min(args.images, 8))]
+    images = [images[index % len(images)] for index in range(args.images)]
+
+    helper = ImageHelper()
+    derivative_settings = {name: helper.get_output_settings(name) for name in [ImageHelper.PRIMARY_DERIVATIVE, 'llm']}
+
+    print(f"{args.images} x {args.megapixels:g} MP JPEGs, {os.cpu_count()} CPUs")
+    for workers in args.workers:
+        for engine in ('thread', 'process'):
+            throughput, p99_stall, max_stall = asyncio.run(run(engine, workers, images, derivative_settings))
+            print(f"  {workers:2} {engine:7}  {throughput:6.2f} images/s  loop stall p99 {p99_stall * 1000:6.1f} ms  max {max_stall * 1000:6.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Measures near duplicate lookups in the perceptual hash index.  The index is filled with random 64 bit hashes,
+then queried with hashes a few bits away from indexed ones (hits) and with fresh random hashes (misses).
+
+Usage: python benchmarks/benchmark_near_duplicates.py --entries 1000000 --distance 6
+"""
+import os, sys, argparse, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.near_duplicate_index as near_duplicate_index
+
+
+def flip_bits(image_hash, count, rng):
+    for bit in rng.sample(range(64), count):
+        image_hash ^= 1 << bit
+    return image_hash
+
+
+def time_queries(index, queries, distance):
+    latencies = []
+    found = 0
+    for query in queries:
+        start_time = time.perf_counter()
+        match = index.nearest(query, distance)
+        latencies.append(time.perf_counter() - start_time)
+        found += match is not None
+
+    latencies.sort()
+    return found, sum(latencies) / len(latencies), latencies[int(len(latencies) * 0.99)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--distance', type=int, default=6)
+    parser.add_argument('--blocks', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    index = near_duplicate_index.MultiIndexHash(args.blocks)
+
+    start_time = time.perf_counter()
+    hashes = [rng.getrandbits(64) for _ in range(args.entries)]
+    for i, image_hash in enumerate(hashes):
+        index.add(image_hash, i)
+    print(f"Indexed {args.entries} hashes in {time.perf_counter() - start_time:.1f}s")
+
+    near_queries = [flip_bits(rng.choice(hashes), rng.randint(0, args.distance), rng) for _ in range(args.queries)]
+    random_queries = [rng.getrandbits(64) for _ in range(args.queries)]
+
+    for label, queries in (('near duplicates', near_queries), ('unrelated', random_queries)):
+        found, mean, p99 = time_queries(index, queries, args.distance)
+        print(f"{label:16} found {found}/{len(queries)}  mean {mean * 1000:.3f} ms  p99 {p99 * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
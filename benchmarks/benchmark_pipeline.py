@@ -0,0 +1,272 @@
+"""
+Runs ImageProcessor.process end to end against local stand-ins for the Face, Vision and Azure OpenAI services,
+see service_stubs.py, so the pipeline can be measured without spending Azure quota.  It reports the images
+per second, the p50 and p99 of each image and each stage, the requests the services saw and the peak resident
+memory.
+
+It needs a storage account for the original and resized images, ex: Azurite from
+.devcontainer/docker-compose.yml.  The connection comes from STORAGE_ACCOUNT_CONNECTION in local.settings.json,
+or --connection.  The images are written to containers created for the run, which are deleted afterwards.
+
+--replay answers the service calls from a recording made with HTTP_CAPTURE_MODE=record instead, ex: of production
+traffic, at the recorded latencies times --latency-scale.
+
+--save-baseline writes the report to a file, and --baseline compares a run against it.  A run that is worse than
+the baseline by more than --tolerance on any measure exits with status 1, so it can gate a build.
+
+Usage: python benchmarks/benchmark_pipeline.py --images 40 --concurrency 8 --profile azure --baseline baseline.json
+"""
+import os, sys, json, uuid, shutil, argparse, asyncio, tempfile, time, resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.storage as storage
+import shared.blob_transfer as blob_transfer
+import shared.http_client as http_client
+import shared.http_transport as http_transport
+import shared.bulk_runner as bulk_runner
+import shared.result_sink as result_sink
+import shared.event_loop as event_loop
+import image_processor
+from synthetic_images import make_image
+from service_stubs import StubServices, PROFILES, load_profile
+
+
+def load_settings(path):
+    # Load the function app settings, the same way batchimagescaler.py does, without overriding the environment
+    if os.path.exists(path):
+        with open(path) as f:
+            for key, value in json.load(f)['Values'].items():
+                os.environ.setdefault(key, value)
+
+
+def reset_peak_rss():
+    # Linux resets the high water mark of the resident set when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    # VmHWM follows reset_peak_rss(), ru_maxrss is the peak since the process started
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def configure_pipeline(run_id, args):
+    # Containers of the run's own, and nothing the benchmark could pick up from an earlier run or share with one
+    os.environ['ORIGINAL_IMAGE_CONTAINER'] = f"benchmark-{run_id}-originals"
+    os.environ['RESIZED_IMAGE_CONTAINER'] = f"benchmark-{run_id}-resized"
+    os.environ['ORCHESTRATOR_RESULT_CONTAINER'] = f"benchmark-{run_id}-results"
+    os.environ['RESULT_SINK_SPOOL_PATH'] = os.path.join(tempfile.gettempdir(), f"benchmark-{run_id}-spool")
+    os.environ['IMAGE_TRANSPORT'] = args.transport
+    os.environ['RESULT_CACHE_MEMORY_BYTES'] = '0'
+    os.environ['NEAR_DUPLICATE_MODE'] = 'off'
+    for name in ('ORCHESTRATOR_RESULT_CONNECTION', 'RESULT_CACHE_CONTAINER', 'RESULT_CACHE_PATH', 'WORK_CLAIM_CONTAINER',
+                 'PERSON_REGISTRY_CONTAINER', 'PERSON_REGISTRY_PATH', 'RESULT_SINK_CONTAINER', 'RESULT_SINK_PATH'):
+        os.environ.pop(name, None)
+
+
+async def prepare(args):
+    blob_service_client = storage.get_blob_service_client()
+    for variable in ('ORIGINAL_IMAGE_CONTAINER', 'RESIZED_IMAGE_CONTAINER', 'ORCHESTRATOR_RESULT_CONTAINER'):
+        await blob_service_client.create_container(os.environ[variable])
+
+    # A handful of distinct images, reused under different names
+    distinct = [make_image(args.megapixels, 'JPEG', quality=85 + index) for index in range(min(args.images, 5))]
+    names = [f"image{index:05}.jpg" for index in range(args.images)]
+    for index, name in enumerate(names):
+        blob_client = blob_service_client.get_blob_client(os.environ['ORIGINAL_IMAGE_CONTAINER'], name)
+        await blob_transfer.upload_bytes(blob_client, distinct[index % len(distinct)], overwrite=True)
+    return names
+
+
+async def run(names, args):
+    processor = image_processor.ImageProcessor()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    image_times = []
+    stage_times = {}
+    failures = []
+
+    async def process(name):
+        async with semaphore:
+            try:
+                result = json.loads(await processor.process_async(name, args.stages))
+            except Exception as e:
+                failures.append(f"{name}: {e}")
+                return
+        image_times.append(result['metrics']['total_time'])
+        for stage, stage_time in result['metrics'].get('stages', {}).items():
+            stage_times.setdefault(stage, []).append(stage_time)
+
+    reset_peak_rss()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(process(name) for name in names))
+    elapsed = time.perf_counter() - start_time
+
+    image_times.sort()
+    return {
+        'images_per_second': len(image_times) / elapsed,
+        'image_p50': bulk_runner.percentile(image_times, 0.50),
+        'image_p99': bulk_runner.percentile(image_times, 0.99),
+        'stages': {stage: {'p50': bulk_runner.percentile(sorted(times), 0.50), 'p99': bulk_runner.percentile(sorted(times), 0.99)}
+                   for stage, times in sorted(stage_times.items())},
+        'peak_rss_mb': peak_rss() / 1024 / 1024,
+        'failed': len(failures),
+        'failures': failures[:10]
+    }
+
+
+async def close_blob_service_client():
+    await storage.get_blob_service_client().close()
+
+
+async def clean_up():
+    # The result blobs are uploaded in the background on the worker's shared event loop, with a client of its own,
+    # and the container can't go until they are in
+    await asyncio.to_thread(result_sink.get_blob_sink().close)
+    await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(close_blob_service_client(), event_loop.get_loop()))
+    shutil.rmtree(os.environ['RESULT_SINK_SPOOL_PATH'], ignore_errors=True)
+
+    blob_service_client = storage.get_blob_service_client()
+    for variable in ('ORIGINAL_IMAGE_CONTAINER', 'RESIZED_IMAGE_CONTAINER', 'ORCHESTRATOR_RESULT_CONTAINER'):
+        await blob_service_client.delete_container(os.environ[variable])
+    await http_client.get_client().close()
+    await blob_service_client.close()
+
+
+async def benchmark(args):
+    names = await prepare(args)
+    try:
+        return await run(names, args)
+    finally:
+        await clean_up()
+
+
+def measures(report):
+    # Each measure, and whether a higher value is better
+    yield 'images/s', report['images_per_second'], True
+    yield 'image p50 s', report['image_p50'], False
+    yield 'image p99 s', report['image_p99'], False
+    for stage, times in report['stages'].items():
+        yield f"{stage} p50 s", times['p50'], False
+        yield f"{stage} p99 s", times['p99'], False
+    yield 'peak rss MB', report['peak_rss_mb'], False
+
+
+def compare(report, baseline, tolerance):
+    """
+    This function prints each measure against the baseline.
+
+    Returns:
+    list: The measures that are worse than the baseline by more than the tolerance.
+
+    """
+
+    if baseline.get('settings') != report['settings']:
+        print(f"\nThe baseline ran with different settings: {baseline.get('settings')}")
+
+    baseline_measures = {name: value for name, value, _ in measures(baseline)}
+    regressions = []
+    print(f"\n{'':16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, value, higher_is_better in measures(report):
+        if name not in baseline_measures:
+            print(f"{name:16} {'':>10} {value:10.3f}")
+            continue
+
+        base = baseline_measures[name]
+        change = (value - base) / base if base else 0.0
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:16} {base:10.3f} {value:10.3f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--megapixels', type=float, default=12)
+    parser.add_argument('--concurrency', type=int, default=8, help="How many images are processed at once.")
+    parser.add_argument('--stages', help="The pipeline stages to run, ex: face,narrative.  Defaults to every stage.")
+    parser.add_argument('--transport', choices=['url', 'inline'], default='url')
+    parser.add_argument('--profile', default='azure', help=f"The latency and failures of the stub services, one of {', '.join(PROFILES)}, or a JSON file like them.")
+    parser.add_argument('--faces', type=int, default=4, help="How many faces the stub finds in every image.")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', help="A recording made with HTTP_CAPTURE_MODE=record to answer the service calls from, instead of the stubs.")
+    parser.add_argument('--latency-scale', type=float, default=1.0, help="Multiplies the recorded latencies of --replay, ex: 0 answers at once.")
+    parser.add_argument('--connection', help="The storage connection string.  Defaults to STORAGE_ACCOUNT_CONNECTION.")
+    parser.add_argument('--settings', default='local.settings.json')
+    parser.add_argument('--baseline', help="A report saved by --save-baseline to compare this run with.")
+    parser.add_argument('--save-baseline', help="Where to save this run's report.")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="How much worse than the baseline a measure can get, as a fraction.")
+    args = parser.parse_args()
+
+    load_settings(args.settings)
+    if args.connection:
+        os.environ['STORAGE_ACCOUNT_CONNECTION'] = args.connection
+
+    services = None
+    if args.replay:
+        os.environ['HTTP_CAPTURE_MODE'] = 'replay'
+        os.environ['HTTP_CAPTURE_PATH'] = args.replay
+        os.environ['HTTP_REPLAY_LATENCY_SCALE'] = str(args.latency_scale)
+        # The host isn't part of a recorded request, the path is.  These match the stubs, for recordings made with them.
+        os.environ.setdefault('AZURE_AI_SERVICE_ENDPOINT', 'https://replay.invalid')
+        os.environ.setdefault('AZURE_OPEN_AI_ENDPOINT', 'https://replay.invalid/openai/deployments/gpt-4o/chat/completions?api-version=2024-06-01')
+    else:
+        services = StubServices(load_profile(args.profile), faces_per_image=args.faces, seed=args.seed)
+        services.start()
+        services.configure_environment()
+    configure_pipeline(uuid.uuid4().hex[:8], args)
+
+    print(f"{args.images} x {args.megapixels:g} MP images, {args.concurrency} at a time, '{args.replay or args.profile}' services")
+    report = asyncio.run(benchmark(args))
+
+    report['settings'] = {name: getattr(args, name) for name in ('images', 'megapixels', 'concurrency', 'stages', 'transport', 'profile', 'faces', 'seed', 'replay', 'latency_scale')}
+    if services is not None:
+        services.stop()
+        report['requests'] = dict(services.requests)
+        report['throttled'] = dict(services.throttled)
+        report['errors'] = dict(services.errors)
+    else:
+        transport = http_transport.get_transport()
+        report['requests'] = dict(transport.matched + transport.unmatched)
+        report['throttled'] = {}
+        report['errors'] = {}
+        print(f"Answered from the recording of the same request {dict(transport.matched)}, from the endpoint's {dict(transport.unmatched)}")
+
+    print(f"{report['images_per_second']:.2f} images/s  image p50 {report['image_p50']:.2f}s  p99 {report['image_p99']:.2f}s  "
+          f"peak rss {report['peak_rss_mb']:.0f} MB  failed {report['failed']}")
+    for stage, times in report['stages'].items():
+        print(f"  {stage:12} p50 {times['p50']:.3f}s  p99 {times['p99']:.3f}s")
+    print(f"Requests {report['requests']}")
+    print(f"Throttled {report['throttled']}  errors {report['errors']}")
+    for failure in report['failures']:
+        print(f"  {failure}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the report to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} measures regressed by more than {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
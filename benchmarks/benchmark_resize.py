@@ -0,0 +1,85 @@
+"""
+Compares the memory and latency of the original temp file resize path against the in-memory
+ImageHelper.resize_image_data path.  Each run happens in a fresh process so the peak RSS numbers
+are not polluted by the previous run.
+
+Usage: python benchmarks/benchmark_resize.py --megapixels 40 --runs 3
+"""
+import os, sys, argparse, uuid, tempfile, time, resource
+from io import BytesIO
+from multiprocessing import get_context
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shared.image_scaler as image_scaler
+from synthetic_images import make_image
+
+
+def legacy_resize(image_data):
+    # This is the original ImageHelper.resize implementation minus the blob calls.
+    image = Image.open(BytesIO(image_data))
+    mode = image.mode
+    if image.mode.startswith('I;'):
+        mode = 'I'
+    image = image.convert(mode)
+
+    max_size_bytes = 6*1024*1024
+    image_size_bytes = len(image.tobytes())
+    if image_size_bytes > max_size_bytes:
+        scale_factor = (max_size_bytes / image_size_bytes) ** 0.5
+        new_size = (int(image.width * scale_factor), int(image.height * scale_factor))
+        image = image.resize(new_size, Image.Resampling.LANCZOS)
+
+    file_path = os.path.join(tempfile.gettempdir(), f'{uuid.uuid4()}.png')
+    image.save(file_path, format='PNG')
+    image = Image.open(file_path)
+    with open(image.filename, "rb") as data:
+        resized_image_data = data.read()
+    os.remove(image.filename)
+    return resized_image_data
+
+
+def in_memory_resize(image_data):
+    return image_scaler.ImageHelper().resize_image_data(image_data)['data']
+
+
+def run_once(path, image_data, queue):
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    resized = globals()[path](image_data)
+    elapsed = time.perf_counter() - start_time
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux
+    queue.put((elapsed, (peak_rss - baseline_rss) / 1024, len(resized)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megapixels', type=float, default=40)
+    parser.add_argument('--format', default='JPEG')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Generating a {args.megapixels} MP {args.format} image...")
+    image_data = make_image(args.megapixels, args.format)
+    print(f"Encoded original: {len(image_data) / 1024 / 1024:.1f} MB")
+
+    context = get_context('fork')
+    for path in ('legacy_resize', 'in_memory_resize'):
+        timings = []
+        peaks = []
+        for _ in range(args.runs):
+            queue = context.Queue()
+            process = context.Process(target=run_once, args=(path, image_data, queue))
+            process.start()
+            elapsed, peak_mb, output_bytes = queue.get()
+            process.join()
+            timings.append(elapsed)
+            peaks.append(peak_mb)
+
+        print(f"{path:18} best {min(timings):.3f}s  mean {sum(timings) / len(timings):.3f}s  "
+              f"peak RSS growth {max(peaks):.0f} MB  output {output_bytes / 1024:.0f} KB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Checks the retry, Retry-After and connection pooling behavior of HttpClient against the stub services in
+service_stubs.py.  Each check asserts what the client should do, and the script exits with status 1 if any of
+them fails, so it can run in a build.
+
+- A throttled call is retried HTTP_MAX_RETRIES times, waiting at least the Retry-After the service sent.
+- A call that fails with a 500 is retried when it is idempotent, and sent once when it isn't.
+- Calls one after another reuse a single pooled connection.
+
+Usage: python benchmarks/check_http_client.py
+"""
+import os, sys, asyncio, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from shared.http_client import HttpClient
+from service_stubs import StubServices
+
+
+RETRY_AFTER = 0.5
+MAX_RETRIES = 2
+
+
+async def call(services, client, idempotent=True):
+    url = f"{services.base_url}/face/v1.1-preview.1/detect"
+    start_time = time.perf_counter()
+    response = await client.post(url, 'face.detect', idempotent=idempotent, json={'url': 'https://example.invalid/image.jpg'})
+    return response, time.perf_counter() - start_time
+
+
+def check(name, passed, detail):
+    print(f"  {'ok  ' if passed else 'FAIL'} {name}: {detail}")
+    return passed
+
+
+async def check_throttled():
+    services = StubServices({'face': {'throttle_rate': 1.0, 'retry_after': RETRY_AFTER}})
+    services.start()
+    # No backoff jitter, so the waits are the Retry-After alone
+    client = HttpClient(max_retries=MAX_RETRIES, backoff_base=0, backoff_max=30)
+    try:
+        response, elapsed = await call(services, client)
+    finally:
+        await client.close()
+        services.stop()
+
+    stats = client.stats.summary()['face.detect']
+    return all([
+        check('throttled status', response.status_code == 429, f"the last answer was {response.status_code}"),
+        check('throttled attempts', services.requests['face.detect'] == MAX_RETRIES + 1, f"{services.requests['face.detect']} requests for {MAX_RETRIES} retries"),
+        check('throttled retries', stats['retries'] == MAX_RETRIES, f"{stats['retries']} retries in the stats"),
+        check('Retry-After honored', elapsed >= MAX_RETRIES * RETRY_AFTER, f"{elapsed:.2f}s for {MAX_RETRIES} waits of {RETRY_AFTER}s")
+    ])
+
+
+async def check_errors():
+    results = []
+    for idempotent, expected in ((True, MAX_RETRIES + 1), (False, 1)):
+        services = StubServices({'face': {'error_rate': 1.0}})
+        services.start()
+        client = HttpClient(max_retries=MAX_RETRIES, backoff_base=0)
+        try:
+            response, _ = await call(services, client, idempotent)
+        finally:
+            await client.close()
+            services.stop()
+
+        name = 'idempotent 500' if idempotent else 'non-idempotent 500'
+        results.append(check(name, response.status_code == 500 and services.requests['face.detect'] == expected,
+                             f"{services.requests['face.detect']} requests, expected {expected}"))
+    return all(results)
+
+
+async def check_pooling():
+    services = StubServices({'face': {}})
+    services.start()
+    client = HttpClient()
+    try:
+        for _ in range(20):
+            response, _ = await call(services, client)
+            response.raise_for_status()
+    finally:
+        await client.close()
+        services.stop()
+
+    return check('pooled connection', len(services.connections) == 1, f"{services.requests['face.detect']} requests over {len(services.connections)} connections")
+
+
+async def main():
+    results = [await check_throttled(), await check_errors(), await check_pooling()]
+    if not all(results):
+        sys.exit(1)
+    print("All checks passed")
+
+
+if __name__ == '__main__':
+    # No client side rate limit, so the only waits are the ones under test
+    for name in [name for name in os.environ if name.startswith('RATE_LIMIT_')]:
+        del os.environ[name]
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""
+Checks that the thread and process engines of IMAGE_ENGINE behave the same on corrupt originals.  The process
+engine decodes from shared memory through SharedMemoryReader rather than from the bytes, so a reader that
+behaves differently from a file surfaces as a different error, or a crashed worker.  Each corrupt image has to
+raise the same error under both engines, and a valid image has to resize under both.  The script exits with
+status 1 if any of them doesn't.
+
+Usage: python benchmarks/check_image_engines.py
+"""
+import os, io, sys, random, struct, asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from PIL import Image
+from shared.image_scaler import ImageHelper
+from shared.image_pool import ImagePool, SharedMemoryReader
+from synthetic_images import make_image
+
+
+def encode(format):
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), 'red').save(buffer, format)
+    return buffer.getvalue()
+
+
+def make_inputs():
+    random.seed(1)
+
+    # A bitmap whose pixel data starts past the end of the file, and a TIFF whose first directory does
+    bmp = bytearray(encode('BMP'))
+    bmp[10:14] = struct.pack('<I', 10_000_000)
+
+    return {
+        'valid jpeg': make_image(1, 'JPEG'),
+        'random bytes': random.randbytes(4096),
+        'empty': b'',
+        'truncated png': encode('PNG')[:40],
+        'truncated jpeg': encode('JPEG')[:200],
+        'bmp data past end': bytes(bmp[:60]),
+        'tiff directory past end': b'II*\x00' + struct.pack('<I', 10_000_000)
+    }
+
+
+def check(name, passed, detail):
+    print(f"  {'ok  ' if passed else 'FAIL'} {name}: {detail}")
+    return passed
+
+
+async def outcome(create_derivatives, image_data, derivative_settings):
+    try:
+        await create_derivatives(image_data, derivative_settings)
+        return 'resized'
+    except Exception as e:
+        return type(e).__name__
+
+
+async def main():
+    results = []
+
+    # Reading past the end of the buffer, ex: after a seek to an offset read from a corrupt header, reads nothing
+    reader = SharedMemoryReader(bytearray(b'abc'))
+    reader.seek(10)
+    try:
+        read = reader.read(4)
+    except Exception as e:
+        read = type(e).__name__
+    results.append(check('read past end', read == b'', f"read {read!r}"))
+
+    helper = ImageHelper()
+    derivative_settings = {ImageHelper.PRIMARY_DERIVATIVE: helper.get_output_settings(ImageHelper.PRIMARY_DERIVATIVE)}
+    loop = asyncio.get_running_loop()
+
+    async def create_on_thread(image_data, derivative_settings):
+        return await loop.run_in_executor(None, helper.create_derivatives, image_data, derivative_settings)
+
+    pool = ImagePool(1)
+    try:
+        for name, image_data in make_inputs().items():
+            thread = await outcome(create_on_thread, image_data, derivative_settings)
+            process = await outcome(pool.create_derivatives, image_data, derivative_settings)
+            expected = thread == 'resized' if name.startswith('valid') else thread != 'resized'
+            results.append(check(name, expected and thread == process, f"thread {thread}, process {process}"))
+    finally:
+        pool.close()
+
+    if not all(results):
+        sys.exit(1)
+    print("All checks passed")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
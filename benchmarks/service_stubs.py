@@ -0,0 +1,211 @@
+"""
+Local stand-ins for the Face, Vision and Azure OpenAI endpoints the pipeline calls, so it can be benchmarked
+without spending Azure quota.  The answers have the shape the pipeline reads, not real recognition results.
+
+Each service answers after a latency drawn from a log-normal distribution, which has the long tail real
+services do, and fails a fraction of requests with a 500 or throttles them with a 429 and a Retry-After, per
+the profile.
+"""
+import os, json, math, uuid, random, asyncio, threading, collections
+from aiohttp import web
+
+
+# For each service, the median latency and the log-normal shape (0 for a fixed latency), and the fraction of
+# requests that fail with a 500 or are throttled with a 429 and Retry-After seconds.
+PROFILES = {
+    'instant': {
+        'face': {'median_ms': 0, 'sigma': 0},
+        'vision': {'median_ms': 0, 'sigma': 0},
+        'openai': {'median_ms': 0, 'sigma': 0}
+    },
+    'azure': {
+        'face': {'median_ms': 150, 'sigma': 0.4},
+        'vision': {'median_ms': 450, 'sigma': 0.4},
+        'openai': {'median_ms': 3000, 'sigma': 0.5}
+    },
+    'throttled': {
+        'face': {'median_ms': 150, 'sigma': 0.4, 'throttle_rate': 0.1, 'retry_after': 1},
+        'vision': {'median_ms': 450, 'sigma': 0.4, 'throttle_rate': 0.1, 'retry_after': 1},
+        'openai': {'median_ms': 3000, 'sigma': 0.5, 'throttle_rate': 0.2, 'retry_after': 2}
+    },
+    'flaky': {
+        'face': {'median_ms': 150, 'sigma': 0.4, 'error_rate': 0.03},
+        'vision': {'median_ms': 450, 'sigma': 0.4, 'error_rate': 0.03},
+        'openai': {'median_ms': 3000, 'sigma': 0.5, 'error_rate': 0.03}
+    }
+}
+
+
+def load_profile(name_or_path):
+    """
+    This function returns a built in profile by name, or loads one from a JSON file with the same layout.
+    """
+
+    if name_or_path in PROFILES:
+        return PROFILES[name_or_path]
+    with open(name_or_path) as f:
+        return json.load(f)
+
+
+class StubServices:
+    """
+    The stub services, served by aiohttp on a background thread.
+    """
+
+    def __init__(self, profile, faces_per_image=4, known_face_rate=0.5, celebrity_rate=0.25, seed=None):
+        """
+        Parameters:
+        profile (dict): The latency and failures of each service, see PROFILES.
+        faces_per_image (int): How many faces detect finds in every image.
+        known_face_rate (float): The fraction of faces identify matches to a person created earlier.
+        celebrity_rate (float): The fraction of faces the Vision API names as a celebrity.
+        seed (int): Seeds the latencies and failures, so runs can be repeated.
+        """
+
+        self.profile = profile
+        self.faces_per_image = faces_per_image
+        self.known_face_rate = known_face_rate
+        self.celebrity_rate = celebrity_rate
+        self.random = random.Random(seed)
+        self.persons = []
+
+        # Requests, and the 500s and 429s sent, by endpoint
+        self.requests = collections.Counter()
+        self.errors = collections.Counter()
+        self.throttled = collections.Counter()
+
+        # The client ports requests came from, one per pooled connection
+        self.connections = set()
+
+        self._loop = None
+        self._runner = None
+        self.base_url = None
+
+    def start(self):
+        """
+        This function starts the server.
+
+        Returns:
+        str: The base URL of the services, ex: http://127.0.0.1:54321.
+
+        """
+
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self._start())
+            started.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=serve, name='service-stubs', daemon=True).start()
+        started.wait()
+        return self.base_url
+
+    async def _start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/face/{version}/detect', self._service('face', 'face.detect', self._detect))
+        app.router.add_post('/face/{version}/identify', self._service('face', 'face.identify', self._identify))
+        app.router.add_post('/face/{version}/persons', self._service('face', 'face.create_person', self._create_person))
+        app.router.add_patch('/face/{version}/persons/{person_id}', self._service('face', 'face.update_person', self._update_person))
+        app.router.add_post('/face/{version}/persons/{person_id}/recognitionModels/{model}/persistedFaces', self._service('face', 'face.add_face', self._add_face))
+        app.router.add_post('/vision/{version}/analyze', self._service('vision', 'vision.analyze', self._analyze))
+        app.router.add_post('/openai/deployments/{deployment}/chat/completions', self._service('openai', 'openai.chat', self._chat))
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', 0).start()
+        self.base_url = f"http://127.0.0.1:{self._runner.addresses[0][1]}"
+
+    def stop(self):
+        """
+        This function stops the server.
+        """
+
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def configure_environment(self, deployment='gpt-4o'):
+        """
+        This function points the pipeline's service settings at the stubs.
+        """
+
+        os.environ['AZURE_AI_SERVICE_ENDPOINT'] = self.base_url
+        os.environ['AZURE_AI_SERVICE_KEY'] = 'stub'
+        os.environ['AZURE_OPEN_AI_ENDPOINT'] = f"{self.base_url}/openai/deployments/{deployment}/chat/completions?api-version=2024-06-01"
+        os.environ['AZURE_OPEN_AI_KEY'] = 'stub'
+
+    def _service(self, service, endpoint, handler):
+        settings = self.profile.get(service, {})
+
+        async def handle(request):
+            self.requests[endpoint] += 1
+            self.connections.add(request.transport.get_extra_info('peername'))
+            body = await request.read()
+
+            median_ms, sigma = settings.get('median_ms', 0), settings.get('sigma', 0)
+            if median_ms > 0:
+                await asyncio.sleep(self.random.lognormvariate(math.log(median_ms / 1000), sigma) if sigma else median_ms / 1000)
+
+            draw = self.random.random()
+            if draw < settings.get('throttle_rate', 0):
+                self.throttled[endpoint] += 1
+                return web.json_response({'error': {'code': '429', 'message': 'Rate limit is exceeded.'}}, status=429,
+                                         headers={'Retry-After': str(settings.get('retry_after', 1))})
+            if draw < settings.get('throttle_rate', 0) + settings.get('error_rate', 0):
+                self.errors[endpoint] += 1
+                return web.json_response({'error': {'code': 'InternalServerError', 'message': 'Stub failure.'}}, status=500)
+
+            return web.json_response(handler(request, body))
+        return handle
+
+    def _detect(self, request, body):
+        return [{
+            'faceId': str(uuid.uuid4()),
+            'faceRectangle': {'left': 20 + index * 70, 'top': 40, 'width': 60, 'height': 60}
+        } for index in range(self.faces_per_image)]
+
+    def _identify(self, request, body):
+        results = []
+        for face_id in json.loads(body)['faceIds']:
+            candidates = []
+            if self.persons and self.random.random() < self.known_face_rate:
+                candidates = [{'personId': self.random.choice(self.persons), 'confidence': 0.9}]
+            results.append({'faceId': face_id, 'candidates': candidates})
+        return results
+
+    def _create_person(self, request, body):
+        person_id = str(uuid.uuid4())
+        self.persons.append(person_id)
+        return {'personId': person_id}
+
+    def _update_person(self, request, body):
+        return {}
+
+    def _add_face(self, request, body):
+        return {'persistedFaceId': str(uuid.uuid4())}
+
+    def _analyze(self, request, body):
+        celebrities = [{
+            'name': f"Celebrity {index}",
+            'confidence': 0.95,
+            'faceRectangle': {'left': 20 + index * 70, 'top': 40, 'width': 60, 'height': 60}
+        } for index in range(self.faces_per_image) if self.random.random() < self.celebrity_rate]
+        return {'categories': [{'name': 'people_', 'score': 0.9, 'detail': {'celebrities': celebrities}}]}
+
+    def _chat(self, request, body):
+        payload = json.loads(body)
+        system_prompt = payload['messages'][0]['content'][0]['text']
+
+        if 'response_format' in payload:
+            # The combined image analysis asks for a JSON object
+            content = json.dumps({'narrative': "A stub narrative of the scene.", 'categories': ['Lifestyle', 'Sports']})
+        elif 'categories' in system_prompt:
+            content = "Lifestyle, Sports"
+        else:
+            content = "A stub narrative of the scene."
+
+        return {
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 1100, 'completion_tokens': 120, 'total_tokens': 1220}
+        }
@@ -0,0 +1,56 @@
+"""
+Helpers for generating synthetic images for the benchmark scripts.
+"""
+import random
+from io import BytesIO
+from PIL import Image
+
+
+def make_image(megapixels, format, aspect=4 / 3, quality=90):
+    """
+    This function builds a synthetic photo-like image and returns it encoded.  A gradient with noise
+    keeps the encoders and decoders honest compared to a flat colour.
+
+    Parameters:
+    megapixels (float): The size of the image in millions of pixels.
+    format (str): The Pillow format to encode the image with, ex: 'JPEG', 'PNG', 'TIFF'.
+    aspect (float): The width to height ratio of the image.
+    quality (int): The encoder quality for lossy formats.
+
+    Returns:
+    bytes: The encoded image.
+
+    """
+
+    width = int((megapixels * 1_000_000 * aspect) ** 0.5)
+    height = int(width / aspect)
+    image = Image.radial_gradient('L').resize((width, height))
+    noise = Image.effect_noise((width, height), 48)
+    image = Image.merge('RGB', (image, noise, image.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+
+    output = BytesIO()
+    image.save(output, format=format, quality=quality)
+    return output.getvalue()
+
+
+def make_corpus(count, seed=0):
+    """
+    This function builds a mixed corpus of synthetic images, mostly JPEG photos with some PNG and TIFF scans.
+
+    Parameters:
+    count (int): The number of images to generate.
+    seed (int): The random seed so that runs are comparable.
+
+    Returns:
+    list: A list of (name, bytes) tuples.
+
+    """
+
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        format = rng.choices(['JPEG', 'PNG', 'TIFF'], weights=[8, 1, 1])[0]
+        megapixels = rng.choice([4, 12, 24, 40])
+        aspect = rng.choice([4 / 3, 3 / 2, 16 / 9, 3 / 4])
+        corpus.append((f"synthetic_{i}.{format.lower()}", make_image(megapixels, format, aspect)))
+    return corpus
@@ -0,0 +1,40 @@
+import os, sys, json, argparse
+import shared.event_loop as event_loop
+import shared.result_sink as result_sink
+
+
+def load_environment_vars():
+    # The settings of the function app, when run locally, see batchimagescaler.py
+    if os.path.exists('local.settings.json'):
+        with open('local.settings.json') as f:
+            for key, value in json.load(f)['Values'].items():
+                os.environ.setdefault(key, value)
+
+
+async def export(sink, since, output):
+    count = 0
+    async for record in sink.export(since):
+        output.write(json.dumps(record) + '\n')
+        count += 1
+    return count
+
+
+parser = argparse.ArgumentParser(description="Exports the results stored by the result sink as JSON lines, oldest first.")
+parser.add_argument('--since', help="Only the results processed at or after this UTC time, ex: 2024-06-01 or 2024-06-01T12:00.")
+parser.add_argument('--output', help="The file to write to.  Defaults to standard output.")
+args = parser.parse_args()
+
+load_environment_vars()
+
+sink = result_sink.get_sink()
+if sink is None:
+    sys.exit("Set RESULT_SINK_CONTAINER or RESULT_SINK_PATH to the results to export.")
+
+output = open(args.output, 'w') if args.output else sys.stdout
+try:
+    count = event_loop.run_sync(export(sink, args.since, output))
+finally:
+    if args.output:
+        output.close()
+
+print(f"Exported {count} results", file=sys.stderr)
@@ -3,6 +3,11 @@ import azure.functions as func
 import logging
 import function_http
 import function_blob
+import shared.telemetry as telemetry
+
+
+# Install the exporter named by TELEMETRY_EXPORTER, before the first image is processed
+telemetry.configure()
 
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
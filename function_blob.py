@@ -1,38 +1,74 @@
-import os, logging
+import os, logging, asyncio
 import azure.functions as func
 import azurefunctions.extensions.bindings.blob as blob
 import logging
 import image_processor
-from azure.storage.blob import BlobServiceClient
+import shared.storage as storage
+import shared.blob_transfer as blob_transfer
+import shared.image_scaler as image_scaler
+import shared.work_claims as work_claims
 
 
 bp = func.Blueprint()
 container_name = os.getenv('UPLOAD_IMAGE_CONTAINER')
 
 @bp.blob_trigger(arg_name="client", path=f"{container_name}/{{filename}}", connection="STORAGE_ACCOUNT_CONNECTION")
-def function_blob(client: blob.BlobClient):
+async def function_blob(client: blob.BlobClient):
 
     logging.info(f"Blob Trigger function triggered: {client.blob_name}")
-    blob_data = client.download_blob().readall()
 
-    # Create a BlobServiceClient object
-    blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_ACCOUNT_CONNECTION'))  
-    
-    # Get the BlobClient for the original blob
+    # Get the shared async BlobServiceClient
+    blob_service_client = storage.get_blob_service_client()
+
+    # Get the BlobClients for the upload and the original blob
+    upload_blob_client = blob_service_client.get_blob_client(client.container_name, client.blob_name)
     original_blob_client = blob_service_client.get_blob_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'), client.blob_name)
-    original_blob_client.upload_blob(blob_data, overwrite=True)
 
-    # Create an instance of the ImageProcessor class
-    processor = image_processor.ImageProcessor()
-    result_json = processor.process(client.blob_name)
+    # Archive the upload to the original container with a server-side copy, while the image is processed
+    copy_task = asyncio.ensure_future(storage.copy_blob(upload_blob_client, original_blob_client))
+
+    try:
+        # Download the upload once, and hand the bytes to the processor so it doesn't download the original again
+        try:
+            blob_data = await blob_transfer.download_bytes(upload_blob_client, image_scaler.ImageHelper().get_max_original_bytes())
+            logging.info(f"Downloaded {len(blob_data)} bytes for {client.blob_name}")
+
+            # Create an instance of the ImageProcessor class
+            processor = image_processor.ImageProcessor()
+            result_json = await processor.process_async(client.blob_name, image_data=blob_data)
+        except work_claims.ClaimedError as e:
+            # A duplicate trigger, the worker holding the claim processes the image and deletes the upload
+            logging.info(f"Skipping {client.blob_name}: {e}")
+            return
+        except (blob_transfer.BlobTooLargeError, image_scaler.ImageTooLargeError) as e:
+            # Retrying won't make the image any smaller.  It is archived, and the upload is left for someone to look at.
+            logging.error(f"Not processing {client.blob_name}: {e}")
+            return
+    finally:
+        # The upload is the source of the copy, so the copy has to finish before the upload is deleted
+        archived = await _wait_for_copy(copy_task, client.blob_name)
 
     logging.info(f"Image processing completed for {client.blob_name}")
     logging.info(f"Result: {result_json}")
 
+    # The image was processed, so a failed copy doesn't fail the invocation.  The upload is kept instead, it is the
+    # only copy of the original.
+    if not archived:
+        logging.warning(f"Not deleting {client.blob_name}, it could not be archived to the original container")
+        return
+
     #Delete the original blob
-    client.delete_blob()
+    await upload_blob_client.delete_blob()
 
     logging.info(f"Blob trigger processing completed!")
 
-    
-    
+
+async def _wait_for_copy(copy_task, blob_name):
+    # Wait for the archive copy, and log rather than raise when it failed, so the failure doesn't hide the outcome of
+    # processing the image
+    try:
+        await copy_task
+        return True
+    except Exception as e:
+        logging.error(f"Failed to archive {blob_name} to the original container: {e}")
+        return False
@@ -2,12 +2,15 @@ import logging
 import azure.functions as func
 import logging
 import image_processor
+import shared.work_claims as work_claims
+import shared.blob_transfer as blob_transfer
+import shared.image_scaler as image_scaler
 
 
 bp = func.Blueprint()
 
 @bp.route(route="orchestrator")
-def function_http(req: func.HttpRequest) -> func.HttpResponse:
+async def function_http(req: func.HttpRequest) -> func.HttpResponse:
 
     logging.info('Orchestrator function triggered.')    
 
@@ -16,10 +19,23 @@ def function_http(req: func.HttpRequest) -> func.HttpResponse:
     if not filename:
         return func.HttpResponse("You must pass in the filename parameter in the query string", status_code=400)
     
+    processor = image_processor.ImageProcessor()
+
+    # Get the optional selection of pipeline stages, ex: stages=face,narrative
+    try:
+        stages = processor.parse_stages(req.params.get('stages'))
+    except ValueError as e:
+        return func.HttpResponse(str(e), status_code=400)
+
     logging.info(f"Orchestrating functions for file: {filename}")
 
-    # Call the ImageProcessor class to process the image
-    result_json = image_processor.ImageProcessor().process(filename)
+    # Call the ImageProcessor class to process the image.  It runs on the function host's event loop.
+    try:
+        result_json = await processor.process_async(filename, stages)
+    except work_claims.ClaimedError as e:
+        return func.HttpResponse(str(e), status_code=409)
+    except (blob_transfer.BlobTooLargeError, image_scaler.ImageTooLargeError) as e:
+        return func.HttpResponse(str(e), status_code=413)
 
     return func.HttpResponse(result_json, mimetype="application/json", status_code=200)
     
@@ -1,151 +1,536 @@
-import os, logging, json, datetime
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions
-from concurrent.futures import ThreadPoolExecutor
+import os, logging, json, datetime, asyncio, hashlib
+from azure.storage.blob import generate_blob_sas, BlobSasPermissions
 import shared.image_scaler as image_scaler
 import shared.facial_recognition as facial_recognition
 import shared.narrative_generator as narrative_generator
 import shared.category_generator as category_generator
+import shared.image_analyzer as image_analyzer
+import shared.http_client as http_client
+import shared.storage as storage
+import shared.blob_transfer as blob_transfer
+import shared.event_loop as event_loop
+import shared.pipeline as pipeline_engine
+import shared.result_cache as result_cache
+import shared.near_duplicate_index as near_duplicate_index
+import shared.work_claims as work_claims
+import shared.result_sink as result_sink
+import shared.telemetry as telemetry
+from shared.image_source import ImageSource
 import logging
 
 class ImageProcessor:
-    def process(self, filename):
-        
+
+    # The image derivative each downstream service is sent.  See ImageHelper.get_derivative_names.
+    SERVICE_DERIVATIVES = {
+        'face': 'face',
+        'celebrity': 'vision',
+        'narrative': 'llm',
+        'categories': 'llm',
+    }
+
+    async def process_async(self, filename, stages=None, image_data=None):
+        """
+        This function resizes an image and runs it through face recognition, narrative generation and category
+        generation.  Everything runs on the caller's event loop, so one worker can have many images in flight.
+
+        Parameters:
+        filename (str): The name of the blob in the original image container.
+        stages (str or list): The pipeline stages to run, ex: 'face,narrative'.  The stages they depend on are
+                              run as well.  Defaults to the PIPELINE_STAGES environment variable, or every stage.
+        image_data (bytes or file): The original image, when the caller already has it, ex: the blob trigger.  It
+                                    is downloaded from the original image container if None.
+
+        Returns:
+        str: The result as JSON.
+
+        Raises:
+        work_claims.ClaimedError: When WORK_CLAIM_CONTAINER is set and another worker is processing the image.
+
+        """
+
+        stages = self.parse_stages(stages)
+
+        # Every span for the image, the claim, stages, transfers and service calls, is a child of this one.  It
+        # also times the image for the result's total_time.
+        with telemetry.TimedSpan('process image', {'image.filename': filename}) as timing:
+            return await self._claim_and_process(filename, stages, image_data, timing)
+
+    async def _claim_and_process(self, filename, stages, image_data, timing):
+        # Claim the image, so a duplicate trigger or another worker doesn't process it at the same time.  An
+        # image that was processed before is processed again, someone asked for it.
+        claims = work_claims.get_claims('process')
+        claim = None
+        if claims is not None:
+            claim = await claims.claim(filename, skip_done=False)
+            if claim is None:
+                raise work_claims.ClaimedError(f"{filename} is being processed by another worker")
+
+        try:
+            # Collect the stats for every outbound HTTP call made while processing this image
+            with http_client.collect_stats() as http_stats:
+                result = await self._process(filename, stages, http_stats, timing, image_data, claim)
+        except BaseException:
+            if claim is not None:
+                await claim.release()
+            raise
+
+        if claim is not None:
+            try:
+                await claim.complete()
+            except work_claims.ClaimedError:
+                raise
+            except Exception as e:
+                logging.warning(f"Could not mark {filename} as processed: {e}")
+        return result
+
+    def process(self, filename, stages=None, image_data=None):
+        """
+        The synchronous wrapper for process_async.  It runs on the worker's shared event loop.
+        """
+
+        return event_loop.run_sync(self.process_async(filename, stages, image_data))
+
+    def parse_stages(self, stages=None):
+        """
+        This function parses and validates a selection of pipeline stages.
+
+        Parameters:
+        stages (str or list): A comma separated string or a list of stage names.  Defaults to the PIPELINE_STAGES
+                              environment variable.
+
+        Returns:
+        list: The selected stage names, or None to run every stage.
+
+        """
+
+        if stages is None:
+            stages = os.getenv('PIPELINE_STAGES')
+
+        if isinstance(stages, str):
+            stages = [stage.strip().lower() for stage in stages.split(',') if stage.strip()]
+
+        if not stages:
+            return None
+
+        # Raises a ValueError for unknown stages
+        self._build_pipeline().plan(stages)
+        return list(stages)
+
+    def _build_pipeline(self):
+        # The stages an image goes through.  Each stage starts as soon as the stages it depends on are done,
+        # so face detection, narrative generation and category generation all start once the image is resized.
+        # Celebrity detection runs alongside face identification, and both are pruned when there are no faces.
+        pipeline = pipeline_engine.Pipeline()
+        pipeline.add_stage('resize', self._stage_resize,
+                           prune=lambda resized: [] if resized['reused_result'] is None else ['detect', 'identify', 'celebrity', 'face', 'analysis', 'narrative', 'categories'])
+        pipeline.add_stage('detect', self._stage_detect, requires=['resize'],
+                           prune=lambda faces: [] if faces else ['identify', 'celebrity', 'face'])
+        pipeline.add_stage('identify', self._stage_identify, requires=['detect'])
+        pipeline.add_stage('celebrity', self._stage_celebrity, requires=['detect'])
+        pipeline.add_stage('face', self._stage_face, requires=['identify'], after=['celebrity'])
+
+        if self._get_analysis_mode() == 'combined':
+            # One request generates both the narrative and the categories
+            pipeline.add_stage('analysis', self._stage_analysis, requires=['resize'])
+            pipeline.add_stage('narrative', self._stage_analysis_narrative, requires=['analysis'])
+            pipeline.add_stage('categories', self._stage_analysis_categories, requires=['analysis'])
+        else:
+            pipeline.add_stage('narrative', self._stage_narrative, requires=['resize'])
+            pipeline.add_stage('categories', self._stage_categories, requires=['resize'])
+        return pipeline
+
+    def _get_analysis_mode(self):
+        # Whether the narrative and categories are generated by 'separate' requests or one 'combined' request
+        analysis_mode = os.getenv('IMAGE_ANALYSIS_MODE', 'separate').lower()
+        if analysis_mode not in ('separate', 'combined'):
+            raise ValueError(f"Unknown image analysis mode '{analysis_mode}'.  Expected 'separate' or 'combined'.")
+        return analysis_mode
+
+    async def _process(self, filename, stages, http_stats, timing, image_data=None, claim=None):
+
         logging.info(f"Processing file: {filename}")
-        start_time = datetime.datetime.now()
 
         result_dict = {}
         result_dict["metrics"] = {}
         result_dict["filename"] = filename
 
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_ACCOUNT_CONNECTION')) 
-
-        logging.info(f"Calling ImageScaler function for file: {filename}")
-        resized_result = self._resize_image(filename)
-        resized_filename = resized_result["resized_filename"]
-        result_dict["resizedfilename"] = resized_filename
-        result_dict["metrics"]["image_resize"] = resized_result["total_time"]
-
-        # Generate a SAS token for the blob
-        sas_token = generate_blob_sas(
-            blob_service_client.account_name,
-            os.getenv('RESIZED_IMAGE_CONTAINER'),
-            resized_filename,
-            account_key=blob_service_client.credential.account_key,
-            permission=BlobSasPermissions(read=True),
-            expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1)
-        )
-
-        # Construct the SAS URL for the blob
-        sas_url = f"https://{blob_service_client.account_name}.blob.core.windows.net/{os.getenv('RESIZED_IMAGE_CONTAINER')}/{resized_filename}?{sas_token}"
-
-        
-        logging.info(f"Calling Face Processing, Narrative generation, and Category generation in parallel for file: {resized_filename}")
-        # Execute API calls in parallel
-        with ThreadPoolExecutor(max_workers=2) as executor:
-            face_orchestrator_future = executor.submit(self._call_face_orchestrator, sas_url)
-            ai_narrative_future = executor.submit(self._call_ai_narrative, sas_url)
-            categories_future = executor.submit(self._call_categories, sas_url)
-
-            face_api_result = face_orchestrator_future.result()
-            ai_narrative_result = ai_narrative_future.result()
-            categories_result = categories_future.result()
-
-        # Add results to the result dictionary
-        result_dict["facedetails"] = face_api_result["face_result"]
-        result_dict["metrics"]["facial_recognition"] = face_api_result["total_time"]
-        result_dict["ainarrative"] = ai_narrative_result["narrative"]
-        result_dict["metrics"]["ai_narrative"] = ai_narrative_result["total_time"]
-        result_dict["categories"] = categories_result["categories_result"]
-        result_dict["metrics"]["ai_categories"] = categories_result["total_time"]
-
-        end_time = datetime.datetime.now()
-
-        total_time = (end_time - start_time).total_seconds()
+        blob_service_client = storage.get_blob_service_client()
+
+        # Work out how the services get hold of the image.  They either fetch it from a SAS URL, or the bytes are posted inline.
+        transport = os.getenv('IMAGE_TRANSPORT', 'url').lower()
+        if transport not in ('url', 'inline'):
+            raise ValueError(f"Unknown image transport '{transport}'.  Expected 'url' or 'inline'.")
+        result_dict["metrics"]["image_transport"] = transport
+
+        # Work out what to do with near duplicates of images that were already processed
+        near_duplicate_mode = os.getenv('NEAR_DUPLICATE_MODE', 'off').lower()
+        if near_duplicate_mode not in ('off', 'link', 'reuse'):
+            raise ValueError(f"Unknown near duplicate mode '{near_duplicate_mode}'.  Expected 'off', 'link' or 'reuse'.")
+
+        # Download the original image, unless the caller handed it over.  Its hash keys the result cache, and it is
+        # resized straight from memory.
+        with telemetry.TimedSpan('image download') as download_timing:
+            if image_data is None:
+                original_blob_client = blob_service_client.get_blob_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'), filename)
+                image_data = await blob_transfer.download_bytes(original_blob_client, image_scaler.ImageHelper().get_max_original_bytes())
+                result_dict["metrics"]["image_download_bytes"] = len(image_data)
+            else:
+                if hasattr(image_data, 'read'):
+                    image_data = await asyncio.to_thread(image_data.read)
+                result_dict["metrics"]["image_download_bytes"] = 0
+        result_dict["metrics"]["image_download"] = download_timing.total_time
+
+        # An image that was already processed with the same configuration is answered from the result cache,
+        # without touching any of the AI services
+        image_hash = await asyncio.get_running_loop().run_in_executor(None, result_cache.ResultCache.hash_image, image_data)
+        cache_version = self._get_cache_version(stages)
+        result_dict["metrics"]["image_hash"] = image_hash
+
+        cache = result_cache.get_cache()
+        cache_key = None
+        cached_json = None
+        state = None
+        if cache is not None:
+            cache_key = result_cache.ResultCache.make_key(image_hash, cache_version)
+            cached_json, cache_tier = await cache.get(cache_key)
+
+            result_dict["metrics"]["cache"] = 'miss' if cached_json is None else 'hit'
+            if cached_json is not None:
+                result_dict["metrics"]["cache_tier"] = cache_tier
+        else:
+            result_dict["metrics"]["cache"] = 'disabled'
+
+        if cached_json is not None:
+            logging.info(f"Result cache hit for file: {filename}")
+            # Keep the cached results, but report the metrics of this run
+            cached_result = json.loads(cached_json)
+            result_dict.update({key: value for key, value in cached_result.items() if key not in ('metrics', 'filename')})
+        else:
+            state = await self._run_pipeline(filename, image_data, image_hash, cache_version, near_duplicate_mode, transport, blob_service_client, stages, result_dict, claim)
+
+        result_dict["metrics"]["http"] = http_stats.summary()
+        result_dict["metrics"]["rate_limit_wait"] = http_stats.total_queue_time()
+
+        total_time = timing.elapsed()
         result_dict["metrics"]["total_time"] = total_time
+        telemetry.image_duration.record(total_time, {'pipeline.cache': result_dict["metrics"]["cache"]})
+        telemetry.images_processed.add(1, {'pipeline.cache': result_dict["metrics"]["cache"]})
 
         logging.info(f"Processing completed in {total_time} seconds")
 
         # Convert the result back to json
         result_json = json.dumps(result_dict)
 
-        if (os.getenv('ORCHESTRATOR_RESULT_CONTAINER') is not None):
-            # Create a new BlobClient for the results json blob
-            result_file = f"{os.path.splitext(filename)[0]}.json"
-        
-            result_service_client = blob_service_client
+        # Don't store the result of an image that another worker may have taken over and be storing as well
+        if claim is not None:
+            claim.check()
 
-            if (os.getenv('ORCHESTRATOR_RESULT_CONNECTION') is not None):
-                result_service_client = BlobServiceClient.from_connection_string(os.getenv('ORCHESTRATOR_RESULT_CONNECTION'))
+        # Cache the result for the next time the same image is processed
+        if cache_key is not None and cached_json is None:
+            await cache.put(cache_key, result_json)
 
-            result_blob_client = result_service_client.get_blob_client(os.getenv('ORCHESTRATOR_RESULT_CONTAINER'), result_file)
-            # Upload the result blob.
-            result_blob_client.upload_blob(result_json, overwrite=True)
+        # Index the perceptual hash of a newly processed image so its near duplicates can find it.  Reused results
+        # are not indexed, the image they came from already is.
+        if near_duplicate_mode != 'off' and state is not None and 'resize' in state and state['resize']['reused_result'] is None:
+            try:
+                await near_duplicate_index.get_index().add(state['resize']['perceptual_hash'], cache_version, {'filename': filename, 'image_hash': image_hash})
+            except Exception as e:
+                logging.warning(f"Failed to add {filename} to the near duplicate index: {e}")
 
-        self._save_to_database(result_json)
+        self._save_to_database(filename, result_json)
 
         # Log the result
         logging.info(f"Processing result: {result_json}")
 
         return result_json
 
-    def _resize_image(self,filename):
-        start_time = datetime.datetime.now()
-        resized_filename = image_scaler.ImageHelper().resize(filename)
-        end_time = datetime.datetime.now()
+    async def _run_pipeline(self, filename, image_data, image_hash, cache_version, near_duplicate_mode, transport, blob_service_client, stages, result_dict, claim=None):
+        # The state is shared by the stages.  Each stage adds its output under its own name.
+        state = {
+            'filename': filename,
+            'image_data': image_data,
+            'image_hash': image_hash,
+            'cache_version': cache_version,
+            'near_duplicate_mode': near_duplicate_mode,
+            'transport': transport,
+            'blob_service_client': blob_service_client,
+            'face_recognition': facial_recognition.AzureFaceRecognition(),
+            'claim': claim,
+            'result': result_dict
+        }
 
-        total_time = (end_time - start_time).total_seconds()
-        logging.info(f"Image resizing completed in {total_time} seconds")
+        pipeline = self._build_pipeline()
+        try:
+            pipeline_result = await pipeline.run(state, stages)
+        except BaseException:
+            # Don't leave the background upload of the resized images running when the pipeline fails
+            upload_task = state.get('resize', {}).get('upload_task')
+            if upload_task is not None:
+                upload_task.cancel()
+            raise
+
+        # Make sure the background upload of the resized images has finished
+        upload_task = state.get('resize', {}).get('upload_task')
+        if upload_task is not None:
+            result_dict["metrics"]["image_upload"] = await upload_task
+
+        planned = pipeline_result["planned"]
+        timings = pipeline_result["timings"]
+
+        # Add results to the result dictionary.  Stages that were pruned still report their empty result.
+        if 'face' in planned:
+            result_dict["facedetails"] = state.get('face', [])
+        if 'celebrity' in planned:
+            result_dict["celebrities"] = state.get('celebrity', [])
+
+        # Face recognition is the time from the start of face detection to the end of the last face stage that ran
+        face_timings = [timings[name] for name in ('detect', 'identify', 'celebrity', 'face') if name in timings]
+        if face_timings:
+            result_dict["metrics"]["facial_recognition"] = (max(timing['end'] for timing in face_timings) - timings['detect']['start']).total_seconds()
+
+        # A near duplicate's result stands in for the stages that were pruned
+        if 'resize' in state and state['resize']['reused_result'] is not None:
+            reused_result = state['resize']['reused_result']
+            result_dict.update({key: value for key, value in reused_result.items() if key in ('facedetails', 'celebrities', 'ainarrative', 'categories')})
+
+        # The AI calls are timed by their stages.  A combined analysis generates the narrative and the categories in
+        # one request, so they took as long as the analysis did.
+        for metric, name in (('ai_analysis', 'analysis'), ('ai_narrative', 'narrative'), ('ai_categories', 'categories')):
+            if name in timings:
+                result_dict["metrics"][metric] = timings['analysis' if 'analysis' in timings else name]['total_time']
+
+        result_dict["metrics"]["stages"] = {name: timing['total_time'] for name, timing in timings.items()}
+        result_dict["metrics"]["skipped_stages"] = pipeline_result["skipped"]
+
+        return state
+
+    def _get_cache_version(self, stages):
+        # Everything that changes the result of processing an image.  Set RESULT_CACHE_VERSION to a new value to
+        # invalidate every cached result, ex: after the person group was reset.
+        image_helper = image_scaler.ImageHelper()
+        config = {
+            'version': os.getenv('RESULT_CACHE_VERSION', '1'),
+            'stages': self._build_pipeline().plan(stages),
+            'resize_quality': os.getenv('IMAGE_RESIZE_QUALITY', 'balanced'),
+            'derivatives': {name: image_helper.get_output_settings(name) for name in image_helper.get_derivative_names()},
+            'face_api_version': facial_recognition.AzureFaceRecognition.API_VERSION,
+            'celebrity_min_iou': float(os.getenv('CELEBRITY_MIN_IOU', '0.3')),
+            'openai_endpoint': os.getenv('AZURE_OPEN_AI_ENDPOINT'),
+            'analysis_mode': self._get_analysis_mode(),
+            'prompts': [
+                narrative_generator.NarrativeGenerator.SYSTEM_PROMPT,
+                narrative_generator.NarrativeGenerator.USER_PROMPT,
+                category_generator.CategoryGenerator.SYSTEM_PROMPT,
+                category_generator.CategoryGenerator.USER_PROMPT,
+                image_analyzer.ImageAnalyzer.SYSTEM_PROMPT,
+                image_analyzer.ImageAnalyzer.USER_PROMPT
+            ]
+        }
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
-        # Create a dictionary with the results
-        result = {
-            'resized_filename': resized_filename,
-            'total_time': total_time
+    async def _stage_resize(self, state):
+        result_dict = state["result"]
+        filename = state["filename"]
+        transport = state["transport"]
+
+        logging.info(f"Calling ImageScaler function for file: {filename}")
+        # With inline transport the resized images are uploaded in the background, off the critical path
+        resized_result = await self._resize_image(filename, state["image_data"], upload=transport == 'url')
+        resized_filename = resized_result["resized_filename"]
+        result_dict["resizedfilename"] = resized_filename
+        result_dict["metrics"]["image_resize"] = resized_result["total_time"]
+        result_dict["metrics"]["image_engine"] = resized_result["engine"]
+        result_dict["metrics"]["image_queue_wait"] = resized_result["queue_wait"]
+        result_dict["metrics"]["resized_format"] = resized_result["format"]
+        result_dict["metrics"]["resized_quality"] = resized_result["quality"]
+        result_dict["metrics"]["resized_bytes"] = resized_result["size_bytes"]
+        result_dict["metrics"]["resized_dimensions"] = [resized_result["width"], resized_result["height"]]
+
+        derivatives = resized_result["derivatives"]
+        result_dict["metrics"]["derivatives"] = {
+            name: {
+                'format': derivative["format"],
+                'quality': derivative["quality"],
+                'bytes': derivative["size_bytes"],
+                'dimensions': [derivative["width"], derivative["height"]]
+            } for name, derivative in derivatives.items()
         }
 
-        return result
+        # Work out which derivative each service is sent
+        service_derivatives = self._get_service_derivatives(derivatives)
+        result_dict["metrics"]["service_derivatives"] = service_derivatives
+
+        upload_task = None
+        if transport == 'inline':
+            # Post the image bytes straight to the services.  The resized blobs are still uploaded, but in the background.
+            image_sources = {name: ImageSource.from_bytes(derivative["data"], derivative["content_type"]) for name, derivative in derivatives.items()}
+            upload_task = asyncio.ensure_future(self._upload_resized_image(resized_result))
+        else:
+            # Generate a SAS URL for each derivative, which the services fetch the image from
+            blob_service_client = state["blob_service_client"]
+            image_sources = {name: ImageSource.from_url(self._generate_sas_url(blob_service_client, derivative["resized_filename"])) for name, derivative in derivatives.items()}
+
+        # Look for an earlier result for a near duplicate of this image
+        perceptual_hash = resized_result["perceptual_hash"]
+        result_dict["perceptualhash"] = format(perceptual_hash, '016x')
+        reused_result = None
+        if state["near_duplicate_mode"] != 'off':
+            reused_result = await self._find_near_duplicate(state, perceptual_hash)
+
+        return {
+            'images': {service: image_sources[derivative] for service, derivative in service_derivatives.items()},
+            'perceptual_hash': perceptual_hash,
+            'reused_result': reused_result,
+            # Celebrity bounding boxes come back in the coordinates of the image they were detected in
+            'celebrity_scale': derivatives[service_derivatives["face"]]["width"] / derivatives[service_derivatives["celebrity"]]["width"],
+            'upload_task': upload_task
+        }
 
-    def _call_face_orchestrator(self,sas_url):
-        start_time = datetime.datetime.now()
-        face_result = facial_recognition.AzureFaceRecognition().process_image(sas_url)
-        end_time = datetime.datetime.now()
+    async def _find_near_duplicate(self, state, perceptual_hash):
+        result_dict = state["result"]
 
-        total_time = (end_time - start_time).total_seconds()
-        logging.info(f"Face recognition completed in {total_time} seconds")
+        try:
+            near_duplicate = await near_duplicate_index.get_index().find(perceptual_hash, state["cache_version"], int(os.getenv('NEAR_DUPLICATE_DISTANCE', '6')))
+        except Exception as e:
+            logging.warning(f"Near duplicate lookup failed for {state['filename']}: {e}")
+            return None
 
-        result = {
-            'face_result': face_result,
-            'total_time': total_time
+        if near_duplicate is None:
+            result_dict["metrics"]["near_duplicate"] = 'none'
+            return None
+
+        logging.info(f"{state['filename']} is a near duplicate of {near_duplicate['filename']}, distance {near_duplicate['distance']}")
+
+        # Link the earlier image in the result
+        result_dict["nearduplicate"] = {
+            'filename': near_duplicate['filename'],
+            'distance': near_duplicate['distance'],
+            'perceptualhash': near_duplicate['perceptual_hash']
         }
-        return result
+        result_dict["metrics"]["near_duplicate"] = 'linked'
+
+        if state["near_duplicate_mode"] != 'reuse':
+            return None
+
+        # Reuse the earlier result when it is still in the result cache
+        cache = result_cache.get_cache()
+        if cache is None:
+            return None
+
+        cached_json, _ = await cache.get(result_cache.ResultCache.make_key(near_duplicate['image_hash'], state["cache_version"]))
+        if cached_json is None:
+            return None
+
+        result_dict["metrics"]["near_duplicate"] = 'reused'
+        return json.loads(cached_json)
+
+    async def _stage_detect(self, state):
+        detected_faces = await state["face_recognition"].detect_faces_async(state["resize"]["images"]["face"])
+        state["result"]["metrics"]["faces_detected"] = len(detected_faces)
+        telemetry.faces_per_image.record(len(detected_faces))
+        return detected_faces
+
+    async def _stage_identify(self, state):
+        return await state["face_recognition"].identify_faces_async(state["detect"])
+
+    async def _stage_celebrity(self, state):
+        return await state["face_recognition"].detect_celebrities_async(state["resize"]["images"]["celebrity"], state["resize"]["celebrity_scale"])
 
-    def _call_ai_narrative(self,sas_url):
-        start_time = datetime.datetime.now()
-        narrative = narrative_generator.NarrativeGenerator().generate_narrative(sas_url)
-        end_time = datetime.datetime.now()
+    async def _stage_face(self, state):
+        # Registering faces changes the person group, so stop if another worker may have taken the image over
+        if state["claim"] is not None:
+            state["claim"].check()
 
-        total_time = (end_time - start_time).total_seconds()
-        logging.info(f"AI narrative generation completed in {total_time} seconds")
+        # The celebrity names are used when the celebrity stage ran
+        persons = await state["face_recognition"].register_faces_async(state["resize"]["images"]["face"], state["detect"], state["identify"], state.get("celebrity"))
 
+        # The Face API calls the person registry skipped
+        state["result"]["metrics"]["face_calls_saved"] = dict(state["face_recognition"].saved_calls)
+        return persons
+
+    async def _stage_narrative(self, state):
+        narrative = await narrative_generator.NarrativeGenerator().generate_narrative_async(state["resize"]["images"]["narrative"])
+        state["result"]["ainarrative"] = narrative
+        return narrative
+
+    async def _stage_analysis(self, state):
+        analysis = await image_analyzer.ImageAnalyzer().analyze_image_async(state["resize"]["images"]["narrative"])
+        state["result"]["metrics"]["ai_analysis_fallback"] = analysis["fallback"]
+        return analysis
+
+    async def _stage_analysis_narrative(self, state):
+        # The narrative came back with the analysis
+        state["result"]["ainarrative"] = state["analysis"]["narrative"]
+        return state["analysis"]["narrative"]
+
+    async def _stage_analysis_categories(self, state):
+        state["result"]["categories"] = state["analysis"]["categories"]
+        return state["analysis"]["categories"]
+
+    async def _stage_categories(self, state):
+        categories = await category_generator.CategoryGenerator().generate_categories_async(state["resize"]["images"]["categories"])
+        state["result"]["categories"] = categories
+        return categories
+
+    async def _resize_image(self, filename, image_data=None, upload=True):
+        with telemetry.TimedSpan('image resize') as timing:
+            resized_image = await image_scaler.ImageHelper().resize_async(filename, upload=upload, image_data=image_data)
+
+        total_time = timing.total_time
+        logging.info(f"Image resizing completed in {total_time} seconds.  {resized_image['format']} {resized_image['width']}x{resized_image['height']}, {resized_image['size_bytes']} bytes")
+
+        # Create a dictionary with the results
         result = {
-            'narrative': narrative,
+            'resized_filename': resized_image['resized_filename'],
+            'format': resized_image['format'],
+            'quality': resized_image['quality'],
+            'width': resized_image['width'],
+            'height': resized_image['height'],
+            'size_bytes': resized_image['size_bytes'],
+            'derivatives': resized_image['derivatives'],
+            'perceptual_hash': resized_image['perceptual_hash'],
+            'engine': resized_image['engine'],
+            'queue_wait': resized_image['queue_wait'],
             'total_time': total_time
         }
+
         return result
 
-    def _call_categories(self,sas_url):
-        start_time = datetime.datetime.now()
-        categories = category_generator.CategoryGenerator().generate_categories(sas_url)
-        end_time = datetime.datetime.now()
+    async def _upload_resized_image(self, resized_result):
+        with telemetry.TimedSpan('image upload') as timing:
+            await image_scaler.ImageHelper().upload_async(resized_result)
 
-        total_time = (end_time - start_time).total_seconds()
-        logging.info(f"AI category generation completed in {total_time} seconds")
+        logging.info(f"Resized image upload completed in {timing.total_time} seconds")
+        return timing.total_time
 
-        result = {
-            'categories_result': categories,
-            'total_time': total_time
+    def _generate_sas_url(self, blob_service_client, resized_filename):
+        # Generate a SAS token for the blob
+        sas_token = generate_blob_sas(
+            blob_service_client.account_name,
+            os.getenv('RESIZED_IMAGE_CONTAINER'),
+            resized_filename,
+            account_key=blob_service_client.credential.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        )
+
+        # Construct the SAS URL for the blob
+        return f"https://{blob_service_client.account_name}.blob.core.windows.net/{os.getenv('RESIZED_IMAGE_CONTAINER')}/{resized_filename}?{sas_token}"
+
+    def _get_service_derivatives(self, derivatives):
+        # Route each service to its own derivative, or the primary derivative if that one was not produced
+        return {
+            service: derivative if derivative in derivatives else image_scaler.ImageHelper.PRIMARY_DERIVATIVE
+            for service, derivative in ImageProcessor.SERVICE_DERIVATIVES.items()
         }
-        return result
 
-    def _save_to_database(self, result_json):
-        # TODO - Save the result to a database
-        logging.info(f"TODO!!!! Saving result to database!")
\ No newline at end of file
+    def _save_to_database(self, filename, result_json):
+        # The result blob for the orchestrator is uploaded in the background as well.  See ORCHESTRATOR_RESULT_CONTAINER.
+        blob_sink = result_sink.get_blob_sink()
+        if blob_sink is not None:
+            blob_sink.add(filename, result_json)
+
+        # Hand the result to the result sink, which stores it in bulk in the background.  See RESULT_SINK_CONTAINER.
+        sink = result_sink.get_sink()
+        if sink is not None:
+            sink.add(filename, result_json)
\ No newline at end of file
@@ -0,0 +1,86 @@
+import os, asyncio
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+import shared.storage as storage
+
+
+class FileAppendLog:
+    """
+    An append only log of entries in a local file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    async def read(self, offset):
+        return await asyncio.to_thread(self._read, offset)
+
+    async def append(self, line):
+        await asyncio.to_thread(self._append, line)
+
+    def _read(self, offset):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(offset)
+                return f.read()
+        except FileNotFoundError:
+            return b''
+
+    def _append(self, line):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'ab') as f:
+            f.write(line)
+
+
+class BlobAppendLog:
+    """
+    An append only log of entries in an append blob, shared by every worker.  Each entry is appended as a
+    single block, so concurrent writers never interleave.
+    """
+
+    def __init__(self, container, blob_name, connection_string=None):
+        self.container = container
+        self.blob_name = blob_name
+        self.connection_string = connection_string
+        self._created = False
+
+    def _get_blob_client(self):
+        return storage.get_blob_service_client(self.connection_string).get_blob_client(self.container, self.blob_name)
+
+    async def read(self, offset):
+        blob_client = self._get_blob_client()
+        try:
+            size = (await blob_client.get_blob_properties()).size
+        except ResourceNotFoundError:
+            return b''
+
+        if size <= offset:
+            return b''
+        return await (await blob_client.download_blob(offset=offset, length=size - offset)).readall()
+
+    async def append(self, line):
+        blob_client = self._get_blob_client()
+        if not self._created:
+            try:
+                await blob_client.create_append_blob(if_none_match='*')
+            except ResourceExistsError:
+                pass
+            self._created = True
+        await blob_client.append_block(line)
+
+
+def whole_lines(data):
+    """
+    This function trims a read from a log to the whole lines in it.  A partial line is still being written, and
+    is read again next time.
+
+    Parameters:
+    data (bytes): What was read from the log.
+
+    Returns:
+    bytes: The whole lines.
+
+    """
+
+    return data[:data.rfind(b'\n') + 1]
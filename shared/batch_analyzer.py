@@ -0,0 +1,277 @@
+import os, math, logging, asyncio
+import shared.http_client as http_client
+import shared.event_loop as event_loop
+import shared.image_analyzer as image_analyzer
+
+
+class BatchImageAnalyzer:
+    """
+    Generates the narrative and categories for many images at once, for offline backfills where the latency of
+    a single image doesn't matter.  Several images are packed into each Azure OpenAI request, so the system
+    prompt and request overhead are paid once per batch rather than once per image.
+
+    Batches are sized from an estimate of their prompt and completion tokens.  A batch whose response is cut
+    short or can't be parsed, or which the service rejects, ex: as too long, is split in half and retried.
+    Images missing from a response, or with a malformed analysis, are retried on their own with ImageAnalyzer.
+    """
+
+    SYSTEM_PROMPT = (
+        "You are a helpful assistant that looks at images, describes them in as much detail as possible, and suggests categories for them. "
+        "You will be given several images.  Each image is preceded by a line with its id, ex: 'Image 3:'. "
+        "Respond with a JSON object with a single key, \"images\", holding a list with one object for every image, in the order they were given. "
+        "Each object has exactly three keys. "
+        "\"id\" is the id of the image. "
+        "\"narrative\" is a string describing the scene in the image with as much detail as possible. Don't use any apostrophe characters (like this ') or possessive nouns (like the man's) in it. "
+        "\"categories\" is a list of strings.  You must only recommend (Lifestyle, Civil Rights, Entertainment, Sports) as potential categories.  If you are not sure, don't recommend anything and use an empty list. "
+        "Describe every image on its own, never compare the images or refer to one from another."
+    )
+
+    USER_PROMPT = "Please describe the scene in each of these pictures and suggest categories for each of them."
+
+    # Rough prompt tokens for the text of a request, and for the label in front of each image
+    PROMPT_OVERHEAD_TOKENS = 300
+    IMAGE_LABEL_TOKENS = 10
+
+    # Status codes that mean the service rejected the request, ex: because it is too long or one of the images is
+    # invalid.  Splitting the batch narrows the problem down to the images that cause it.
+    REJECTED_STATUS_CODES = (400, 413)
+
+    def __init__(self, max_images=None, max_prompt_tokens=None, completion_tokens_per_image=None, max_completion_tokens=None, concurrency=None):
+        self.max_images = max_images or int(os.getenv('BATCH_ANALYSIS_MAX_IMAGES', '10'))
+        self.max_prompt_tokens = max_prompt_tokens or int(os.getenv('BATCH_ANALYSIS_MAX_PROMPT_TOKENS', '30000'))
+        self.completion_tokens_per_image = completion_tokens_per_image or int(os.getenv('BATCH_ANALYSIS_COMPLETION_TOKENS_PER_IMAGE', '500'))
+        self.max_completion_tokens = max_completion_tokens or int(os.getenv('BATCH_ANALYSIS_MAX_COMPLETION_TOKENS', '4096'))
+        self.concurrency = concurrency or int(os.getenv('BATCH_ANALYSIS_CONCURRENCY', '4'))
+
+    async def analyze_images_async(self, items):
+        """
+        This function generates the narrative and categories for a list of images.
+
+        Parameters:
+        items (list): A dict for each image with its 'key', ex: the filename, and the 'image' as an ImageSource.
+                      'width' and 'height' are optional and improve the token estimate.
+
+        Returns:
+        dict: For each key, the 'narrative', the list of 'categories' and whether it was 'batched'.  Images that
+              could not be analyzed have an 'error' instead.
+
+        """
+
+        results = {}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def run_batch(batch):
+            async with semaphore:
+                await self._analyze_batch(batch, results)
+
+        await asyncio.gather(*(run_batch(batch) for batch in self.pack(items)))
+
+        # Retried images finish after the rest of their batch, so hand the results back in the order they were asked for
+        return {item['key']: results[item['key']] for item in items}
+
+    def analyze_images(self, items):
+        """
+        The synchronous wrapper for analyze_images_async.
+        """
+
+        return event_loop.run_sync(self.analyze_images_async(items))
+
+    def pack(self, items):
+        """
+        This function groups images into batches that stay under the image, prompt token and completion token limits.
+
+        Parameters:
+        items (list): The items passed to analyze_images_async.
+
+        Returns:
+        list: The batches, each a list of items.
+
+        """
+
+        batches = []
+        batch = []
+        prompt_tokens = BatchImageAnalyzer.PROMPT_OVERHEAD_TOKENS
+        for item in items:
+            item_tokens = self.estimate_image_tokens(item.get('width'), item.get('height')) + BatchImageAnalyzer.IMAGE_LABEL_TOKENS
+
+            full = (
+                len(batch) >= self.max_images
+                or prompt_tokens + item_tokens > self.max_prompt_tokens
+                or (len(batch) + 1) * self.completion_tokens_per_image > self.max_completion_tokens
+            )
+            if batch and full:
+                batches.append(batch)
+                batch = []
+                prompt_tokens = BatchImageAnalyzer.PROMPT_OVERHEAD_TOKENS
+
+            batch.append(item)
+            prompt_tokens += item_tokens
+
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def estimate_image_tokens(width, height):
+        """
+        This function estimates the prompt tokens a high detail image costs a GPT-4 vision model.  The image is
+        scaled to fit in 2048 x 2048, then so its shortest side is no more than 768, and is charged for each 512
+        pixel tile it covers.
+
+        Parameters:
+        width (int): The width of the image, or None if it is not known.
+        height (int): The height of the image, or None if it is not known.
+
+        Returns:
+        int: The estimated tokens.
+
+        """
+
+        if not width or not height:
+            # The most a high detail image can cost
+            return 85 + 170 * 8
+
+        scale = min(1.0, 2048 / max(width, height))
+        width, height = width * scale, height * scale
+        scale = min(1.0, 768 / min(width, height))
+        width, height = width * scale, height * scale
+
+        return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+    async def _analyze_batch(self, batch, results):
+        if len(batch) == 1:
+            await self._analyze_single(batch[0], results)
+            return
+
+        try:
+            content, finish_reason = await self._request_batch(batch)
+        except http_client.HttpError as e:
+            if e.response.status_code not in BatchImageAnalyzer.REJECTED_STATUS_CODES:
+                raise
+            logging.warning(f"A batch of {len(batch)} images was rejected, splitting it: {e}")
+            await self._split(batch, results)
+            return
+        except ValueError as e:
+            logging.warning(f"Unexpected response for a batch of {len(batch)} images, splitting it: {e}")
+            await self._split(batch, results)
+            return
+
+        # A response that was cut short can't be parsed, so ask for half as much at a time
+        if finish_reason == 'length':
+            logging.warning(f"The response for a batch of {len(batch)} images was truncated, splitting it")
+            await self._split(batch, results)
+            return
+
+        analyzer = image_analyzer.ImageAnalyzer()
+        try:
+            analyses = analyzer.parse_json(content).get('images')
+            if not isinstance(analyses, list):
+                raise ValueError("'images' must be a list")
+        except ValueError as e:
+            logging.warning(f"Could not parse the response for a batch of {len(batch)} images, splitting it: {e}")
+            await self._split(batch, results)
+            return
+
+        # Map each analysis back to its image by the id it was labelled with
+        items_by_id = {str(i + 1): item for i, item in enumerate(batch)}
+        for analysis in analyses:
+            item = items_by_id.get(str(analysis.get('id')) if isinstance(analysis, dict) else None)
+            if item is None or item['key'] in results:
+                continue
+
+            try:
+                results[item['key']] = dict(analyzer.validate_analysis(analysis), batched=True)
+            except ValueError as e:
+                logging.warning(f"Malformed analysis for {item['key']}: {e}")
+
+        # Retry the images the model skipped or got wrong on their own
+        retries = [item for item in batch if item['key'] not in results]
+        if retries:
+            logging.warning(f"Retrying {len(retries)} of {len(batch)} images individually")
+            await asyncio.gather(*(self._analyze_single(item, results) for item in retries))
+
+    async def _split(self, batch, results):
+        middle = len(batch) // 2
+        await asyncio.gather(self._analyze_batch(batch[:middle], results), self._analyze_batch(batch[middle:], results))
+
+    async def _analyze_single(self, item, results):
+        try:
+            analysis = await image_analyzer.ImageAnalyzer().analyze_image_async(item['image'])
+            results[item['key']] = {
+                'narrative': analysis['narrative'],
+                'categories': analysis['categories'],
+                'batched': False
+            }
+        except Exception as e:
+            # One bad image shouldn't fail the rest of the backfill
+            logging.error(f"Could not analyze {item['key']}: {e}")
+            results[item['key']] = {'error': str(e)}
+
+    async def _request_batch(self, batch):
+        # Azure OpenAI GPT model details
+        api_key = os.getenv("AZURE_OPEN_AI_KEY")
+        gpt4_endpoint = os.getenv("AZURE_OPEN_AI_ENDPOINT")
+
+        # Create headers for the request
+        headers = {
+            "Content-Type": "application/json",
+            "api-key": api_key,
+        }
+
+        # Label each image with its id, so the analyses can be matched back to the images
+        user_content = [
+            {
+                "type": "text",
+                "text": BatchImageAnalyzer.USER_PROMPT
+            }
+        ]
+        for i, item in enumerate(batch):
+            user_content.append({
+                "type": "text",
+                "text": f"Image {i + 1}:"
+            })
+            user_content.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": item['image'].openai_url()
+                }
+            })
+
+        # Create the payload for the request.  JSON mode makes the model respond with a JSON object.
+        payload = {
+            "messages": [
+                {
+                    "role": "system",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": BatchImageAnalyzer.SYSTEM_PROMPT
+                        }
+                    ]
+                },
+                {
+                    "role": "user",
+                    "content": user_content
+                }
+            ],
+            "response_format": {"type": "json_object"},
+            "temperature": 0.7,
+            "top_p": 0.95,
+            "max_tokens": min(self.max_completion_tokens, len(batch) * self.completion_tokens_per_image)
+        }
+
+        # The rate limiter is charged the estimated prompt tokens as well as max_tokens, the images dominate a batch
+        prompt_tokens = BatchImageAnalyzer.PROMPT_OVERHEAD_TOKENS + sum(self.estimate_image_tokens(item.get('width'), item.get('height')) + BatchImageAnalyzer.IMAGE_LABEL_TOKENS for item in batch)
+        response = await http_client.get_client().post(gpt4_endpoint, 'openai.batch', tokens=prompt_tokens + payload["max_tokens"], headers=headers, json=payload)
+        response.raise_for_status()
+        response_json = response.json()
+        http_client.record_usage('openai.batch', response_json.get('usage'))
+
+        try:
+            choice = response_json['choices'][0]
+            content = choice['message']['content']
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"Unexpected response shape: {e}")
+
+        # The content is missing when the response was filtered, which is handled like a malformed response
+        return content or '', choice.get('finish_reason')
@@ -0,0 +1,95 @@
+import os, time
+import shared.telemetry as telemetry
+from opentelemetry.trace import SpanKind
+
+
+class BlobTooLargeError(ValueError):
+    """
+    Raised when a blob is larger than the caller is willing to hold in memory.
+    """
+
+
+def get_client_settings():
+    """
+    This function returns the chunking settings for a BlobServiceClient.  Blobs up to the single request size
+    move in one request, anything larger is split into ranged GETs or staged blocks of the chunk size, which
+    download_bytes() and upload_bytes() move several at a time.
+
+    The SDK's defaults send the first 32 MB of a download in a single GET, and the rest one 4 MB chunk after
+    another, so a 20 MB original never gets a second connection.
+
+    Returns:
+    dict: The keyword arguments for the BlobServiceClient, from BLOB_TRANSFER_CHUNK_BYTES (4 MB) and
+          BLOB_TRANSFER_SINGLE_BYTES (the chunk size).
+
+    """
+
+    chunk_bytes = int(os.getenv('BLOB_TRANSFER_CHUNK_BYTES', str(4*1024*1024)))
+    single_bytes = int(os.getenv('BLOB_TRANSFER_SINGLE_BYTES', str(chunk_bytes)))
+
+    return {
+        'max_single_get_size': single_bytes,
+        'max_chunk_get_size': chunk_bytes,
+        'max_single_put_size': single_bytes,
+        'max_block_size': chunk_bytes
+    }
+
+
+def get_concurrency():
+    """
+    This function returns how many chunks of one blob are moved at once, from BLOB_TRANSFER_CONCURRENCY or 4.
+    """
+
+    return int(os.getenv('BLOB_TRANSFER_CONCURRENCY', '4'))
+
+
+async def download_bytes(blob_client, max_bytes=None, max_concurrency=None):
+    """
+    This function downloads a blob into memory with parallel ranged GETs.  The first request also returns the
+    size of the blob, so a blob over max_bytes is refused before the rest of it is downloaded.
+
+    Parameters:
+    blob_client (azure.storage.blob.aio.BlobClient): The blob to download.
+    max_bytes (int): The largest blob to download, or None for no limit.
+    max_concurrency (int): How many chunks are downloaded at once.  Defaults to get_concurrency().
+
+    Returns:
+    bytes: The contents of the blob.
+
+    """
+
+    attributes = {'storage.container': blob_client.container_name, 'storage.blob': blob_client.blob_name}
+    with telemetry.span('storage download', attributes, SpanKind.CLIENT) as transfer_span:
+        start_time = time.perf_counter()
+        downloader = await blob_client.download_blob(max_concurrency=max_concurrency or get_concurrency())
+        transfer_span.set_attribute('storage.bytes', downloader.size)
+
+        if max_bytes is not None and downloader.size > max_bytes:
+            raise BlobTooLargeError(f"{blob_client.blob_name} is {downloader.size} bytes, more than the limit of {max_bytes} bytes")
+
+        data = await downloader.readall()
+
+    telemetry.storage_duration.record(time.perf_counter() - start_time, {'storage.direction': 'download'})
+    telemetry.storage_bytes.add(len(data), {'storage.direction': 'download'})
+    return data
+
+
+async def upload_bytes(blob_client, data, max_concurrency=None, **kwargs):
+    """
+    This function uploads a buffer to a blob, staging the blocks of a large one in parallel.
+
+    Parameters:
+    blob_client (azure.storage.blob.aio.BlobClient): The blob to upload to.
+    data (bytes): The contents of the blob.
+    max_concurrency (int): How many blocks are uploaded at once.  Defaults to get_concurrency().
+    kwargs: Passed on to upload_blob(), ex: overwrite or content_settings.
+
+    """
+
+    attributes = {'storage.container': blob_client.container_name, 'storage.blob': blob_client.blob_name, 'storage.bytes': len(data)}
+    with telemetry.span('storage upload', attributes, SpanKind.CLIENT):
+        start_time = time.perf_counter()
+        await blob_client.upload_blob(data, max_concurrency=max_concurrency or get_concurrency(), **kwargs)
+
+    telemetry.storage_duration.record(time.perf_counter() - start_time, {'storage.direction': 'upload'})
+    telemetry.storage_bytes.add(len(data), {'storage.direction': 'upload'})
@@ -0,0 +1,153 @@
+import numpy as np
+
+
+def boxes_to_array(rectangles):
+    """
+    This function converts bounding boxes to an array of corners.
+
+    Parameters:
+    rectangles (list): Bounding boxes, each a dict with 'left', 'top', 'width' and 'height' keys.
+
+    Returns:
+    numpy.ndarray: An (n, 4) array with the left, top, right and bottom of each box.
+
+    """
+
+    boxes = np.array([[rectangle['left'], rectangle['top'], rectangle['width'], rectangle['height']] for rectangle in rectangles], dtype=np.float64).reshape(-1, 4)
+    if (boxes[:, 2:] < 0).any():
+        raise ValueError("Bounding boxes must have a non-negative width and height")
+
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes
+
+
+def iou_matrix(boxes1, boxes2):
+    """
+    This function computes the intersection over union of every pair of boxes.
+
+    Parameters:
+    boxes1 (numpy.ndarray): An (n, 4) array of corners, see boxes_to_array.
+    boxes2 (numpy.ndarray): An (m, 4) array of corners.
+
+    Returns:
+    numpy.ndarray: An (n, m) array with the intersection over union of each pair, from 0 to 1.
+
+    """
+
+    # Broadcast the n boxes against the m boxes to get the intersection of every pair at once
+    left = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    top = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    right = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    bottom = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    intersection = np.clip(right - left, 0, None) * np.clip(bottom - top, 0, None)
+
+    area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = area1[:, None] + area2[None, :] - intersection
+
+    # Empty boxes have no union, and overlap nothing
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+
+
+def linear_assignment(cost):
+    """
+    This function solves the assignment problem with the Hungarian algorithm: it pairs rows with columns, each
+    at most once, so the total cost of the pairs is as small as possible.  Every row is paired when there are
+    fewer rows than columns, and every column otherwise.
+
+    Parameters:
+    cost (numpy.ndarray): An (n, m) array with the cost of pairing each row with each column.
+
+    Returns:
+    tuple: The arrays of paired row indexes, in ascending order, and the column indexes they are paired with.
+
+    """
+
+    cost = np.asarray(cost, dtype=np.float64)
+
+    # The algorithm adds one row at a time, so there must be no more rows than columns
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    rows, columns = cost.shape
+
+    # The potentials of the rows and columns, and the row paired with each column.  Index 0 is a sentinel
+    # column, so rows and columns are numbered from 1.
+    u = np.zeros(rows + 1)
+    v = np.zeros(columns + 1)
+    paired_row = np.zeros(columns + 1, dtype=np.int64)
+    way = np.zeros(columns + 1, dtype=np.int64)
+
+    for row in range(1, rows + 1):
+        # Grow a tree of alternating paths from the new row until it reaches a free column
+        paired_row[0] = row
+        column = 0
+        min_slack = np.full(columns + 1, np.inf)
+        used = np.zeros(columns + 1, dtype=bool)
+        while True:
+            used[column] = True
+            current_row = paired_row[column]
+
+            # Update the slack of every column outside the tree at once
+            free = ~used[1:]
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            improved = free & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            way[1:][improved] = column
+
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+
+            used_columns = np.nonzero(used)[0]
+            u[paired_row[used_columns]] += delta
+            v[used_columns] -= delta
+            min_slack[1:][free] -= delta
+
+            column = next_column
+            if paired_row[column] == 0:
+                break
+
+        # Flip the pairs along the path that reached the free column
+        while column != 0:
+            previous_column = way[column]
+            paired_row[column] = paired_row[previous_column]
+            column = previous_column
+
+    column_indexes = np.nonzero(paired_row[1:])[0]
+    row_indexes = paired_row[1:][column_indexes] - 1
+    if transposed:
+        row_indexes, column_indexes = column_indexes, row_indexes
+
+    order = np.argsort(row_indexes)
+    return row_indexes[order], column_indexes[order]
+
+
+def match_boxes(rectangles1, rectangles2, min_iou):
+    """
+    This function pairs up the boxes in two lists that cover the same thing, ex: the faces the Face API found
+    and the celebrities the Vision API found in the same photo.  Each box is paired at most once, and the pairs
+    are chosen so their total intersection over union is as large as possible, so in a crowd a box goes to the
+    face it covers best rather than to the first neighbour it touches.
+
+    Parameters:
+    rectangles1 (list): Bounding boxes, each a dict with 'left', 'top', 'width' and 'height' keys.
+    rectangles2 (list): Bounding boxes to pair with them.
+    min_iou (float): The smallest intersection over union of a pair.  Boxes that don't overlap any box in the
+                     other list this much stay unpaired.
+
+    Returns:
+    dict: The index in rectangles2 paired with each index in rectangles1 that has a pair.
+
+    """
+
+    if not rectangles1 or not rectangles2:
+        return {}
+
+    iou = iou_matrix(boxes_to_array(rectangles1), boxes_to_array(rectangles2))
+
+    # Pairs below the threshold are worth nothing, so they never displace a real match and are dropped afterwards
+    iou[iou < min_iou] = 0
+    row_indexes, column_indexes = linear_assignment(-iou)
+
+    return {int(row): int(column) for row, column in zip(row_indexes, column_indexes) if iou[row, column] > 0 and iou[row, column] >= min_iou}
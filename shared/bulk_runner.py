@@ -0,0 +1,260 @@
+import os, time, asyncio, logging
+import shared.event_loop as event_loop
+import shared.storage as storage
+
+
+async def list_blob_names(container, prefix=None, limit=0, connection_string=None):
+    """
+    This function lists the blobs in a container lazily, a page at a time, so a container with millions of
+    blobs is never held in memory.
+
+    Parameters:
+    container (str): The name of the container.
+    prefix (str): Only list blobs whose names start with this, or None for every blob.
+    limit (int): The most names to list, 0 for all of them.
+    connection_string (str): The storage connection string.  Defaults to STORAGE_ACCOUNT_CONNECTION.
+
+    Returns:
+    async iterator: The blob names.
+
+    """
+
+    container_client = storage.get_blob_service_client(connection_string).get_container_client(container)
+    count = 0
+    async for blob in container_client.list_blobs(name_starts_with=prefix):
+        yield blob.name
+        count += 1
+        if limit and count >= limit:
+            return
+
+
+class Checkpoint:
+    """
+    The names a bulk run has finished, kept in a local file with one name per line, so a rerun after a crash
+    skips them.  Names that failed are not recorded and are tried again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._names = set()
+        self._file = None
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                # A partial last line from a crash is ignored, the name is processed again
+                for line in f:
+                    if line.endswith('\n'):
+                        self._names.add(line[:-1])
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, name):
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+
+        # Flushed on every name so a crash loses at most the names in flight
+        self._file.write(name + '\n')
+        self._file.flush()
+        self._names.add(name)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class Progress:
+    """
+    The throughput and latency of a bulk run, overall and since the last report.
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.claimed = 0
+        self.latencies = []
+        self._interval_start = self.start_time
+        self._interval_completed = 0
+        self._interval_latencies = []
+
+    def record(self, latency, succeeded):
+        if succeeded:
+            self.completed += 1
+        else:
+            self.failed += 1
+        self.latencies.append(latency)
+        self._interval_latencies.append(latency)
+        self._interval_completed += 1
+
+    def report(self):
+        """
+        This function describes the progress since the last report, and starts a new interval.
+
+        Returns:
+        str: The progress, ex: for a log line.
+
+        """
+
+        now = time.perf_counter()
+        interval_latencies = sorted(self._interval_latencies)
+        interval_rate = self._interval_completed / max(now - self._interval_start, 1e-9)
+        overall_rate = (self.completed + self.failed) / max(now - self.start_time, 1e-9)
+
+        self._interval_start = now
+        self._interval_completed = 0
+        self._interval_latencies = []
+
+        return (f"completed {self.completed}  failed {self.failed}  skipped {self.skipped}  other workers {self.claimed}  "
+                f"{interval_rate:.2f}/s now  {overall_rate:.2f}/s overall  "
+                f"p50 {percentile(interval_latencies, 0.50):.2f}s  p95 {percentile(interval_latencies, 0.95):.2f}s  p99 {percentile(interval_latencies, 0.99):.2f}s")
+
+    def summary(self):
+        """
+        This function summarizes the whole run.
+
+        Returns:
+        dict: The counts, including the names 'claimed' or finished by other workers, the 'total_time' in seconds, the 'throughput' per second and the latency percentiles.
+
+        """
+
+        total_time = time.perf_counter() - self.start_time
+        latencies = sorted(self.latencies)
+        return {
+            'completed': self.completed,
+            'failed': self.failed,
+            'skipped': self.skipped,
+            'claimed': self.claimed,
+            'total_time': total_time,
+            'throughput': (self.completed + self.failed) / max(total_time, 1e-9),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99)
+        }
+
+
+class BulkRunner:
+    """
+    Runs a handler over a stream of names, ex: every blob in a container, with a fixed number in flight.  The
+    names are pulled from the stream only as fast as they are handled, names in the checkpoint are skipped,
+    and the throughput and latency are reported as the run goes.
+    """
+
+    def __init__(self, handler, concurrency=None, checkpoint=None, report_seconds=None, on_report=None, claims=None):
+        """
+        Parameters:
+        handler (coroutine function): Called with each name.  A name succeeded unless the handler raises.
+        concurrency (int): How many names are handled at once.  Defaults to BULK_CONCURRENCY or 8.
+        checkpoint (Checkpoint): Where finished names are recorded, or None to not record them.
+        report_seconds (float): How often the progress is reported.  Defaults to BULK_REPORT_SECONDS or 10.
+        on_report (function): Called with each progress line, ex: print.  Defaults to logging.info.
+        claims (WorkClaims): Claims each name before it is handled, so workers on other machines don't handle it
+                             too, or None when this is the only worker.
+        """
+
+        self.handler = handler
+        self.concurrency = concurrency or int(os.getenv('BULK_CONCURRENCY', '8'))
+        self.checkpoint = checkpoint
+        self.report_seconds = report_seconds or float(os.getenv('BULK_REPORT_SECONDS', '10'))
+        self.on_report = on_report or logging.info
+        self.claims = claims
+
+    async def run_async(self, names):
+        """
+        This function handles every name in a stream.
+
+        Parameters:
+        names (async iterator): The names, ex: from list_blob_names.
+
+        Returns:
+        dict: The summary of the run, see Progress.summary.
+
+        """
+
+        progress = Progress()
+
+        # A short queue keeps the listing just ahead of the workers
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def produce():
+            try:
+                async for name in names:
+                    if self.checkpoint is not None and name in self.checkpoint:
+                        progress.skipped += 1
+                        continue
+                    await queue.put(name)
+            finally:
+                for _ in range(self.concurrency):
+                    await queue.put(None)
+
+        async def work():
+            while True:
+                name = await queue.get()
+                if name is None:
+                    return
+
+                start_time = time.perf_counter()
+                claim = None
+                try:
+                    if self.claims is not None:
+                        claim = await self.claims.claim(name)
+                        if claim is None:
+                            # Another worker has it, or already finished it
+                            progress.claimed += 1
+                            continue
+
+                    await self.handler(name)
+                except Exception as e:
+                    # One bad blob shouldn't stop the run, it is tried again by the next one
+                    logging.error(f"Failed to process {name}: {e}")
+                    progress.record(time.perf_counter() - start_time, False)
+                    if claim is not None:
+                        await claim.release()
+                    continue
+
+                if claim is not None:
+                    try:
+                        await claim.complete()
+                    except Exception as e:
+                        # The work is done, but another run may do it again
+                        logging.warning(f"Could not mark {name} as done: {e}")
+                progress.record(time.perf_counter() - start_time, True)
+                if self.checkpoint is not None:
+                    self.checkpoint.add(name)
+
+        async def report():
+            while True:
+                await asyncio.sleep(self.report_seconds)
+                self.on_report(progress.report())
+
+        reporter = asyncio.ensure_future(report())
+        try:
+            await asyncio.gather(produce(), *(work() for _ in range(self.concurrency)))
+        finally:
+            reporter.cancel()
+            if self.checkpoint is not None:
+                self.checkpoint.close()
+
+        self.on_report(progress.report())
+        return progress.summary()
+
+    def run(self, names):
+        """
+        The synchronous wrapper for run_async.
+        """
+
+        return event_loop.run_sync(self.run_async(names))
@@ -1,9 +1,19 @@
-import os, requests, logging, json
+import os, logging, json
+import shared.http_client as http_client
+import shared.event_loop as event_loop
+from shared.image_source import ImageSource
 
 class CategoryGenerator:
 
-    def generate_categories(self, image_url):
-        logging.info(f"Generating categories for image: {image_url}")
+    # The prompts are part of the result cache version, see ImageProcessor._get_cache_version
+    SYSTEM_PROMPT = "You are a helpful assistant that looks at images and suggests categories based on image recognition.  You must only recommend (Lifestyle, Civil Rights, Entertainment, Sports) as potential categories.  If you are not sure, don't recommend anything.  Your response should always text in a comma separated list."
+
+    USER_PROMPT = "Please suggest categories from for the image provided."
+
+    async def generate_categories_async(self, image):
+        # The image can be a URL or an ImageSource.  Inline images are sent as a base64 data URL.
+        image = ImageSource.wrap(image)
+        logging.info(f"Generating categories for image: {image}")
         # Azure OpenAI GPT model details
         api_key = os.getenv("AZURE_OPEN_AI_KEY")
         gpt4_endpoint = os.getenv("AZURE_OPEN_AI_ENDPOINT")
@@ -22,7 +32,7 @@ class CategoryGenerator:
                     "content": [
                         {
                             "type": "text",
-                            "text": "You are a helpful assistant that looks at images and suggests categories based on image recognition.  You must only recommend (Lifestyle, Civil Rights, Entertainment, Sports) as potential categories.  If you are not sure, don't recommend anything.  Your response should always text in a comma separated list."
+                            "text": CategoryGenerator.SYSTEM_PROMPT
                         }
                     ]
                 },
@@ -31,12 +41,12 @@ class CategoryGenerator:
                     "content": [
                         {
                             "type": "text",
-                            "text": "Please suggest categories from for the image provided."
+                            "text": CategoryGenerator.USER_PROMPT
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"{image_url}"
+                                "url": image.openai_url()
                             }
                         }
                     ]
@@ -48,11 +58,14 @@ class CategoryGenerator:
         }
 
         # Send request to GPT-4 endpoint
-        response = requests.post(gpt4_endpoint, headers=headers, json=payload)
+        # max_tokens is the estimated token cost the rate limiter charges against the tokens per minute quota
+        response = await http_client.get_client().post(gpt4_endpoint, 'openai.categories', tokens=payload["max_tokens"], headers=headers, json=payload)
         response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        response_json = response.json()
+        http_client.record_usage('openai.categories', response_json.get('usage'))
         
         # Extract the narrative from the response
-        categories_csv = response.json()['choices'][0]['message']['content']
+        categories_csv = response_json['choices'][0]['message']['content']
 
         categories = [category.strip() for category in categories_csv.split(',')]
         #categories = json.dumps(categories_list)
@@ -61,4 +74,10 @@ class CategoryGenerator:
         logging.info(f"Categories generated: {categories}")
 
         return categories
-        
\ No newline at end of file
+
+    def generate_categories(self, image):
+        """
+        The synchronous wrapper for generate_categories_async.
+        """
+
+        return event_loop.run_sync(self.generate_categories_async(image))
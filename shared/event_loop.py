@@ -0,0 +1,50 @@
+import asyncio, threading
+
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+
+def get_loop():
+    """
+    This function returns the event loop the synchronous wrappers run their coroutines on.  There is a single
+    loop per worker process, running on a daemon thread, so connection pools and rate limiters are shared by
+    every synchronous caller.
+
+    Returns:
+    asyncio.AbstractEventLoop: The worker's event loop.
+
+    """
+
+    global _loop, _loop_thread
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                _loop_thread = threading.Thread(target=loop.run_forever, name='shared-event-loop', daemon=True)
+                _loop_thread.start()
+                _loop = loop
+    return _loop
+
+
+def run_sync(coroutine):
+    """
+    This function runs a coroutine on the worker's event loop and blocks until it completes.  It is how the
+    synchronous APIs, ex: ImageProcessor.process, wrap their async counterparts.
+
+    Parameters:
+    coroutine (coroutine): The coroutine to run.
+
+    Returns:
+    The result of the coroutine.
+
+    """
+
+    loop = get_loop()
+
+    if threading.current_thread() is _loop_thread:
+        coroutine.close()
+        raise RuntimeError("run_sync cannot be called from the shared event loop, await the coroutine instead.")
+
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
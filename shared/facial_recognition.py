@@ -1,16 +1,35 @@
-import requests, json, os, json, logging
+import json, os, logging, asyncio
+import shared.event_loop as event_loop
+import shared.http_client as http_client
+import shared.person_registry as person_registry
+import shared.box_matching as box_matching
+from shared.image_source import ImageSource
 
 
 class AzureFaceRecognition:
 
     API_VERSION = "v1.1-preview.1"
 
-    def _detect_faces(self, image_url):
+    def __init__(self):
+        # Every call made for one image is independent of the ones running alongside it.  The semaphore bounds
+        # how many are in flight at once, so use one instance per image.
+        self.semaphore = asyncio.Semaphore(int(os.getenv('FACE_MAX_CONCURRENCY', '8')))
+
+        # The most faces added to a person, the Face API holds up to 248
+        self.max_person_faces = int(os.getenv('PERSON_MAX_FACES', '248'))
+
+        # The smallest intersection over union of a face and a celebrity's bounding box for the face to be the celebrity
+        self.celebrity_min_iou = float(os.getenv('CELEBRITY_MIN_IOU', '0.3'))
+
+        # The Face API calls the person registry made unnecessary, by endpoint
+        self.saved_calls = {'face.create_person': 0, 'face.update_person': 0, 'face.add_face': 0}
+
+    async def _detect_faces(self, image):
         """
         This function detects faces in an image using Azure's Face API.
 
         Parameters:
-        image_url (str): The URL of the image to analyze.
+        image (str or ImageSource): The URL of the image to analyze, or an ImageSource holding the image.
 
         Returns:
         dict: The JSON response from the API. This includes information about the detected faces.
@@ -22,28 +41,53 @@ class AzureFaceRecognition:
         # along with the specific path for the face detection API.
         face_endpoint = f"{os.getenv('AZURE_AI_SERVICE_ENDPOINT')}/face/{AzureFaceRecognition.API_VERSION}/detect?returnFaceId=true&recognitionModel=recognition_04&detectionModel=detection_03"
 
-        # Define the headers
-        # The headers for the API request are defined here. The Content-Type is set to 'application/json',
-        # and the subscription key for the Azure AI service is retrieved from the AZURE_AI_SERVICE_KEY environment variable.
+        # Define the headers and body
+        # The Content-Type is 'application/json' when the body carries the URL of the image, or 'application/octet-stream'
+        # when the body is the image itself. The subscription key for the Azure AI service is retrieved from the
+        # AZURE_AI_SERVICE_KEY environment variable.
+        content_type, body = ImageSource.wrap(image).face_request()
         headers = {
-            'Content-Type': 'application/json',
+            'Content-Type': content_type,
             'Ocp-Apim-Subscription-Key': os.getenv("AZURE_AI_SERVICE_KEY"),
         }
 
-        # Define the body
-        # The body of the API request is defined here. It is a JSON object that contains the URL of the image to analyze.
-        body = json.dumps({
-            'url': image_url,
-        })
-
         # Make the POST request
         # The API request is made here. The response from the API is a JSON object that contains information about the detected faces.
-        response = requests.post(face_endpoint, headers=headers, data=body)
+        response = await http_client.get_client().post(face_endpoint, 'face.detect', headers=headers, data=body)
+        response.raise_for_status()
 
         # Return the JSON response
         return response.json()
 
-    def _search_for_similar_faces(self, face_ids):
+    async def _search_for_similar_faces(self, face_ids, semaphore=None):
+        """
+        This function identifies the persons that a list of detected faces belong to.  The identify API takes at
+        most 10 faces per call, so the faces are split into chunks which are sent concurrently.
+
+        Parameters:
+        face_ids (list): The IDs of the detected faces.
+        semaphore (asyncio.Semaphore): Bounds how many chunks are in flight at once.  Unbounded if None.
+
+        Returns:
+        list: The identify results, in the same order as face_ids.
+
+        """
+
+        # Split face_ids into chunks of 10
+        chunks = [face_ids[i:i+10] for i in range(0, len(face_ids), 10)]
+
+        # gather returns the responses in the order of the chunks
+        chunk_responses = await asyncio.gather(*(self._bounded(semaphore, self._identify_chunk(chunk)) for chunk in chunks))
+
+        # Flatten the responses back into a single list
+        all_responses = []
+        for response in chunk_responses:
+            all_responses.extend(response)
+
+        # Return all responses
+        return all_responses
+
+    async def _identify_chunk(self, chunk_face_ids):
         # Define the endpoint
         face_endpoint = f"{os.getenv('AZURE_AI_SERVICE_ENDPOINT')}/face/{AzureFaceRecognition.API_VERSION}/identify"
 
@@ -53,29 +97,19 @@ class AzureFaceRecognition:
             'Ocp-Apim-Subscription-Key': os.getenv("AZURE_AI_SERVICE_KEY"),
         }
 
-        # Initialize an empty list to store all responses
-        all_responses = []
-
-        # Split face_ids into chunks of 10
-        for i in range(0, len(face_ids), 10):
-            chunk_face_ids = face_ids[i:i+10]
-
-            # Define the body
-            body = json.dumps({
-                'faceIds': chunk_face_ids,
-                'personIds': ["*"]
-            })
+        # Define the body
+        body = json.dumps({
+            'faceIds': chunk_face_ids,
+            'personIds': ["*"]
+        })
 
-            # Make the POST request
-            response = requests.post(face_endpoint, headers=headers, data=body)
+        # Make the POST request
+        response = await http_client.get_client().post(face_endpoint, 'face.identify', headers=headers, data=body)
+        response.raise_for_status()
 
-            # Append the response to all_responses
-            all_responses.extend(response.json())
+        return response.json()
 
-        # Return all responses
-        return all_responses
-    
-    def _create_person(self, name):
+    async def _create_person(self, name):
         """
         This function creates a new person in Azure's Face API.
 
@@ -107,12 +141,14 @@ class AzureFaceRecognition:
 
         # Make the POST request
         # The API request is made here. The response from the API is a JSON object that contains information about the newly created person.
-        response = requests.post(face_endpoint, headers=headers, data=body)
+        # Creating a person is not idempotent, so it is only retried when the service did not process the request.
+        response = await http_client.get_client().post(face_endpoint, 'face.create_person', idempotent=False, headers=headers, data=body)
+        response.raise_for_status()
         
         # Return the personId from the response
         return response.json()['personId']
 
-    def _update_person(self, person_id, name):
+    async def _update_person(self, person_id, name):
         # Define the endpoint
         face_endpoint = f"{os.getenv('AZURE_AI_SERVICE_ENDPOINT')}/face/{AzureFaceRecognition.API_VERSION}/persons/{person_id}"
 
@@ -128,16 +164,17 @@ class AzureFaceRecognition:
         })
 
         # Make the PATCH request
-        response = requests.patch(face_endpoint, headers=headers, data=body)
+        response = await http_client.get_client().patch(face_endpoint, 'face.update_person', headers=headers, data=body)
+        response.raise_for_status()
 
 
-    def _add_face_to_person(self, person_id, image_url, bounding_box):
+    async def _add_face_to_person(self, person_id, image, bounding_box):
         """
         This function adds a face to a person in Azure's Face API.
 
         Parameters:
         person_id (str): The ID of the person to add the face to.
-        image_url (str): The URL of the image containing the face.
+        image (str or ImageSource): The URL of the image containing the face, or an ImageSource holding the image.
         bounding_box (dict): A dictionary containing the bounding box of the face in the image. 
                             It should have 'left', 'top', 'width', and 'height' keys.
 
@@ -151,33 +188,31 @@ class AzureFaceRecognition:
         # along with the specific path for the face addition API.
         face_endpoint = f"{os.getenv('AZURE_AI_SERVICE_ENDPOINT')}/face/{AzureFaceRecognition.API_VERSION}/persons/{person_id}/recognitionModels/Recognition_04/persistedFaces?targetFace={str(bounding_box['left'])},{str(bounding_box['top'])},{str(bounding_box['width'])},{str(bounding_box['height'])}&detectionModel=Detection_03"
 
-        # Define the headers
-        # The headers for the API request are defined here. The Content-Type is set to 'application/json',
-        # and the subscription key for the Azure AI service is retrieved from the AZURE_AI_SERVICE_KEY environment variable.
+        # Define the headers and body
+        # The Content-Type is 'application/json' when the body carries the URL of the image, or 'application/octet-stream'
+        # when the body is the image itself. The subscription key for the Azure AI service is retrieved from the
+        # AZURE_AI_SERVICE_KEY environment variable.
+        content_type, body = ImageSource.wrap(image).face_request()
         headers = {
-            'Content-Type': 'application/json',
+            'Content-Type': content_type,
             'Ocp-Apim-Subscription-Key': os.getenv("AZURE_AI_SERVICE_KEY"),
         }
 
-        # Define the body
-        # The body the API request is defined here. It is a JSON object that contains the URL of the image containing the face.
-        body = json.dumps({
-            'url': image_url,
-        })
-
         # Make the POST request
         # The API request is made here. The response from the API is a JSON object that contains information about the added face.
-        response = requests.post(face_endpoint, headers=headers, data=body)
+        # Adding a face is not idempotent, so it is only retried when the service did not process the request.
+        response = await http_client.get_client().post(face_endpoint, 'face.add_face', idempotent=False, headers=headers, data=body)
+        response.raise_for_status()
 
         # Return the JSON response
         return response.json()
 
-    def _detect_celebrity(self, image_url):
+    async def _detect_celebrity(self, image):
         """
         This function detects celebrities in an image using Azure's Computer Vision API.
 
         Parameters:
-        image_url (str): The URL of the image to analyze.
+        image (str or ImageSource): The URL of the image to analyze, or an ImageSource holding the image.
 
         Returns:
         list: A list of dictionaries, each containing information about a detected celebrity. 
@@ -190,139 +225,302 @@ class AzureFaceRecognition:
         # along with the specific path for the celebrity detection API.
         face_endpoint = f"{os.getenv('AZURE_AI_SERVICE_ENDPOINT')}/vision/v3.2/analyze?visualFeatures=Categories&details=Celebrities&language=en&model-version=latest"
 
-        # Define the headers
-        # The headers for the API request are defined here. The Content-Type is set to 'application/json',
-        # and the subscription key for the Azure AI service is retrieved from the AZURE_AI_SERVICE_KEY environment variable.
+        # Define the headers and body
+        # The Content-Type is 'application/json' when the body carries the URL of the image, or 'application/octet-stream'
+        # when the body is the image itself. The subscription key for the Azure AI service is retrieved from the
+        # AZURE_AI_SERVICE_KEY environment variable.
+        content_type, body = ImageSource.wrap(image).face_request()
         headers = {
-            'Content-Type': 'application/json',
+            'Content-Type': content_type,
             'Ocp-Apim-Subscription-Key': os.getenv("AZURE_AI_SERVICE_KEY"),
         }
 
-        # Define the body
-        # The body the API request is defined here. It is a JSON object that contains the URL of the image to analyze.
-        body = json.dumps({
-            'url': image_url,
-        })
-
         # Make the POST request
         # The API request is made here. The response from the API is a JSON object that contains information about the detected celebrities.
-        response = requests.post(face_endpoint, headers=headers, data=body)
+        response = await http_client.get_client().post(face_endpoint, 'vision.analyze', headers=headers, data=body)
+        response.raise_for_status()
 
         celebrities = []
 
         try:
             celebrities =  response.json()['categories'][0]['detail']['celebrities']
-        except KeyError:
+        except (KeyError, IndexError):
+            # No categories, or no celebrity details, means there are no celebrities in the image
             pass
         
         return celebrities
 
-    def _check_boundingbox_overlap(self, bb1, bb2):
+    async def process_image_async(self, image, celebrity_image=None, celebrity_scale=1.0):
         """
-        This function checks if two bounding boxes overlap.
+        This function finds the faces in an image, matches them to known persons (creating new persons as needed),
+        and names any persons that are recognized as celebrities.
 
         Parameters:
-        bb1, bb2 (dict): Dictionaries representing bounding boxes. 
-                        Each should have 'top', 'left', 'width', and 'height' keys.
+        image (str or ImageSource): The URL of the image to detect and register faces from, or an ImageSource holding it.
+        celebrity_image (str or ImageSource): The image to detect celebrities in.  This can be a smaller derivative
+                                              of the same image.  Defaults to image.
+        celebrity_scale (float): The factor that maps celebrity bounding boxes onto the coordinates of image,
+                                 ex: 2.0 when the celebrity image is half the width of the face image.
 
         Returns:
-        bool: True if the bounding boxes overlap, False otherwise.
+        list: A dictionary for each face with the 'person_id', 'celebrity_name' and 'bounding_box'.
 
         """
 
-        # Assert that the width and height of both bounding boxes are non-negative
-        assert bb1['width'] >= 0 and bb1['height'] >= 0
-        assert bb2['width'] >= 0 and bb2['height'] >= 0
-
-        # Calculate the coordinates of the corners of the bounding boxes
-        bb1_x1 = bb1['left']
-        bb1_y1 = bb1['top']
-        bb1_x2 = bb1_x1 + bb1['width']
-        bb1_y2 = bb1_y1 + bb1['height']
-
-        bb2_x1 = bb2['left']
-        bb2_y1 = bb2['top']
-        bb2_x2 = bb2_x1 + bb2['width']
-        bb2_y2 = bb2_y1 + bb2['height']
-
-        # Determine the coordinates of the intersection rectangle
-        x_left = max(bb1_x1, bb2_x1)
-        y_top = max(bb1_y1, bb2_y1)
-        x_right = min(bb1_x2, bb2_x2)
-        y_bottom = min(bb1_y2, bb2_y2)
-
-        # If the coordinates of the intersection rectangle are valid (i.e., the right side is to the right of the left side and the bottom is below the top), 
-        # then the bounding boxes overlap. Otherwise, they do not overlap.
-        if x_right < x_left or y_bottom < y_top:
-            return False  # No overlap
-        else:
-            return True  # Overlap exists
-        
-    def process_image(self, image_url):
-        logging.info(f"Processing image: {image_url}")
+        image = ImageSource.wrap(image)
+        logging.info(f"Processing image: {image}")
 
-        # Detect the faces in the image.
-        logging.debug("Detecting faces...")
-        detected_faces_result = self._detect_faces(image_url)
+        if celebrity_image is None:
+            celebrity_image = image
 
-        # Create a dictionary where the key is the faceId and the value is the face data.  We need
-        # to be able to lookup bounding box information.
-        faces_dict = {face['faceId']: face for face in detected_faces_result}
+        # Detect the faces and the celebrities in the image at the same time.
+        logging.debug("Detecting faces and celebrities...")
+        celebrity_task = asyncio.ensure_future(self.detect_celebrities_async(celebrity_image, celebrity_scale))
+        try:
+            detected_faces = await self.detect_faces_async(image)
+            similar_faces_results = await self.identify_faces_async(detected_faces)
+        except BaseException:
+            celebrity_task.cancel()
+            raise
 
+        celebrity_result = await celebrity_task
 
-        # Get any celebrities in the image.
-        logging.debug("Detecting celebrities...")
-        celebrity_result = self._detect_celebrity(image_url)
+        return await self.register_faces_async(image, detected_faces, similar_faces_results, celebrity_result)
 
-        # Extract all face IDs
-        face_ids = [face['faceId'] for face in detected_faces_result]
+    async def detect_faces_async(self, image):
+        """
+        This function detects the faces in an image.  It is the first step of process_image_async.
 
-        # Search for similar faces
-        logging.debug("Searching for similar faces...")
-        similar_faces_results = self._search_for_similar_faces(face_ids)
+        Parameters:
+        image (str or ImageSource): The image to detect faces in.
+
+        Returns:
+        list: The detected faces, each with a 'faceId' and 'faceRectangle'.
+
+        """
 
-        persons = []
+        return await self._bounded(self.semaphore, self._detect_faces(image))
 
-        # For each similar face result, process it
-        for similar_faces_result in similar_faces_results:
-            face_id = similar_faces_result['faceId']
-            logging.debug(f"Processing face: {face_id}")
+    async def identify_faces_async(self, detected_faces):
+        """
+        This function matches detected faces to known persons.  The chunks of 10 are identified concurrently.
 
-            # Initialize the person name as None
-            celebrity_name = "Unknown"
+        Parameters:
+        detected_faces (list): The faces returned by detect_faces_async.
 
-            # Get the person id of the most similar face or create a new person if no similar face is found.
-            if len(similar_faces_result['candidates']) == 0:
-                # create a new person
-                person_id = self._create_person(celebrity_name)
-                logging.debug(f"No similar face found.  Created new person.  Person ID: {person_id}")
-            else:
-                person_id = similar_faces_result['candidates'][0]['personId']
-                logging.debug(f"Similar face found.  Person ID: {person_id}")
+        Returns:
+        list: The identify results, in the same order as detected_faces.
+
+        """
+
+        logging.debug("Searching for similar faces...")
+        return await self._search_for_similar_faces([face['faceId'] for face in detected_faces], self.semaphore)
+
+    async def detect_celebrities_async(self, celebrity_image, celebrity_scale=1.0):
+        """
+        This function detects the celebrities in an image.
+
+        Parameters:
+        celebrity_image (str or ImageSource): The image to detect celebrities in.
+        celebrity_scale (float): The factor that maps celebrity bounding boxes onto the coordinates of the image
+                                 the faces were detected in.
+
+        Returns:
+        list: The detected celebrities, each with a 'name' and 'faceRectangle'.
 
-            # Get the faceRectangle of the face
-            face_rectangle = faces_dict[face_id]['faceRectangle']
+        """
 
-            # Add the face to the person
-            logging.debug(f"Adding face {face_id} to person {person_id}.")
-            self._add_face_to_person(person_id, image_url, face_rectangle)
+        celebrity_result = await self._bounded(self.semaphore, self._detect_celebrity(celebrity_image))
 
-            # Loop through the celebrities to see if we got any matches.
+        # Map the celebrity bounding boxes onto the coordinates of the image the faces were detected in
+        if celebrity_scale != 1.0:
             for celebrity in celebrity_result:
-                logging.debug(f"Checking for celebrity match against {celebrity['name']}")
-                # We need to check if the bounding boxes overlap to determine if the face is a celebrity.
-                if self._check_boundingbox_overlap(celebrity['faceRectangle'], face_rectangle):
-                    logging.debug(f"Face {face_id} is a {celebrity['name']}.  Assigning celebrity to person {person_id}.")
-                    celebrity_name = celebrity['name']
-                    self._update_person(person_id, celebrity_name)
-                    break
-
-            # Add the person data to the list
-            persons.append({
-                'person_id': person_id,
-                'celebrity_name': celebrity_name,
+                celebrity['faceRectangle'] = {key: int(round(value * celebrity_scale)) for key, value in celebrity['faceRectangle'].items()}
+
+        return celebrity_result
+
+    async def register_faces_async(self, image, detected_faces, similar_faces_results, celebrity_result=None):
+        """
+        This function adds each identified face to its person, creating new persons as needed, and names the
+        persons that were recognized as celebrities.
+
+        Parameters:
+        image (str or ImageSource): The image the faces were detected in.
+        detected_faces (list): The faces returned by detect_faces_async.
+        similar_faces_results (list): The results returned by identify_faces_async.
+        celebrity_result (list): The celebrities returned by detect_celebrities_async, or None to skip naming.
+
+        Returns:
+        list: A dictionary for each face with the 'person_id', 'celebrity_name' and 'bounding_box'.
+
+        """
+
+        image = ImageSource.wrap(image)
+        celebrity_result = celebrity_result or []
+        registry = person_registry.get_registry()
+        if registry is not None:
+            await registry.refresh()
+
+        # Create a dictionary where the key is the faceId and the value is the face data.  We need
+        # to be able to lookup bounding box information.
+        faces_dict = {face['faceId']: face for face in detected_faces}
+
+        # Work out which person each face belongs to.  The faces of one person are registered together, so a
+        # person is created, named and given a face at most once per image.
+        face_rectangles = [faces_dict[similar_faces_result['faceId']]['faceRectangle'] for similar_faces_result in similar_faces_results]
+        celebrity_names = self._match_celebrities(face_rectangles, celebrity_result)
+
+        persons = {}
+        faces = []
+        for similar_faces_result, face_rectangle, celebrity_name in zip(similar_faces_results, face_rectangles, celebrity_names):
+            face_id = similar_faces_result['faceId']
+            registered = False
+
+            if len(similar_faces_result['candidates']) > 0:
+                person_id = similar_faces_result['candidates'][0]['personId']
+                logging.debug(f"Similar face found for face {face_id}.  Person ID: {person_id}")
+                key = person_id
+            elif celebrity_name is not None and registry is not None and registry.find_by_name(celebrity_name) is not None:
+                # The celebrity already has a person, so there is no need to create another one
+                person_id = registry.find_by_name(celebrity_name)
+                logging.debug(f"Face {face_id} is a {celebrity_name}, who is already person {person_id}.")
+                self.saved_calls['face.create_person'] += 1
+                key = person_id
+                registered = True
+            else:
+                # A new person, already named if we know who it is.  The faces of the same new celebrity share one person.
+                person_id = None
+                key = ('new', celebrity_name or face_id)
+
+            person = persons.get(key)
+            if person is None:
+                person = persons[key] = {'person_id': person_id, 'celebrity_name': None, 'faces': [], 'registered': registered}
+            elif person_id is None:
+                self.saved_calls['face.create_person'] += 1
+            if person['celebrity_name'] is None:
+                person['celebrity_name'] = celebrity_name
+            person['faces'].append(face_rectangle)
+
+            faces.append((key, face_rectangle, celebrity_name))
+
+        # Register every person concurrently.  Each Face API call is bounded by the semaphore on its own, so a
+        # person waiting on their face adds doesn't hold a slot.
+        keys = list(persons)
+        person_ids = await asyncio.gather(*(self._register_person(image, persons[key], registry) for key in keys))
+        person_ids = dict(zip(keys, person_ids))
+
+        # Hand the persons back in the identify order
+        persons = [
+            {
+                'person_id': person_ids[key],
+                'celebrity_name': celebrity_name or "Unknown",
                 'bounding_box': face_rectangle
-            })
+            }
+            for key, face_rectangle, celebrity_name in faces
+        ]
 
         logging.info(f"Persons detected: {persons}")
         return persons
+
+    def process_image(self, image, celebrity_image=None, celebrity_scale=1.0):
+        """
+        The synchronous wrapper for process_image_async.
+        """
+
+        return event_loop.run_sync(self.process_image_async(image, celebrity_image, celebrity_scale))
+
+    async def _bounded(self, semaphore, coroutine):
+        if semaphore is None:
+            return await coroutine
+        async with semaphore:
+            return await coroutine
+
+    def _match_celebrities(self, face_rectangles, celebrity_result):
+        """
+        This function works out which celebrity each face is.  A celebrity goes to the face their bounding box
+        overlaps best, and to at most one face, see box_matching.match_boxes.
+
+        Parameters:
+        face_rectangles (list): The bounding box of each face.
+        celebrity_result (list): The celebrities returned by detect_celebrities_async.
+
+        Returns:
+        list: The name of the celebrity for each face, or None.
+
+        """
+
+        matches = box_matching.match_boxes(face_rectangles, [celebrity['faceRectangle'] for celebrity in celebrity_result], self.celebrity_min_iou)
+        for face_index, celebrity_index in matches.items():
+            logging.debug(f"Face {face_index} matches celebrity {celebrity_result[celebrity_index]['name']}")
+        return [celebrity_result[matches[face_index]]['name'] if face_index in matches else None for face_index in range(len(face_rectangles))]
+
+    async def _register_person(self, image, person, registry):
+        """
+        This function brings a person in the Face API up to date with the faces found for them in an image.  The
+        person is created if they are new and named if they were recognized as a celebrity, and every one of
+        their faces is added to them, concurrently.  Calls that would not change anything are skipped.
+
+        Parameters:
+        image (ImageSource): The image the faces were detected in.
+        person (dict): The 'person_id', or None for a new person, the 'celebrity_name', or None, the bounding
+                       boxes of their 'faces', and whether the person was found in the registry, 'registered'.
+        registry (PersonRegistry): What is known about the persons, or None to make every call.
+
+        Returns:
+        str: The ID of the person.
+
+        """
+
+        person_id = person['person_id']
+        celebrity_name = person['celebrity_name']
+
+        # A new person is created already named if we know who it is
+        if person_id is None:
+            person_id = await self._bounded(self.semaphore, self._create_person(celebrity_name or "Unknown"))
+            logging.debug(f"No similar face found.  Created new person.  Person ID: {person_id}")
+            if registry is not None:
+                await registry.record(person_id, name=celebrity_name or "Unknown")
+            known = {'name': celebrity_name or "Unknown", 'face_count': 0}
+        else:
+            known = registry.get(person_id) if registry is not None else None
+
+            # A person found in the registry by name already has the name
+            if celebrity_name is not None and not person['registered']:
+                if known is not None and known['name'] == celebrity_name:
+                    self.saved_calls['face.update_person'] += 1
+                else:
+                    logging.debug(f"Person {person_id} is a {celebrity_name}.  Assigning celebrity to person.")
+                    await self._bounded(self.semaphore, self._update_person(person_id, celebrity_name))
+                    if registry is not None:
+                        await registry.record(person_id, name=celebrity_name)
+
+        # A person can only hold so many faces, the Face API would refuse the rest.  The largest faces go first.
+        faces = sorted(person['faces'], key=lambda face: face['width'] * face['height'], reverse=True)
+        if known is not None and known['face_count'] + len(faces) > self.max_person_faces:
+            room = max(0, self.max_person_faces - known['face_count'])
+            logging.debug(f"Person {person_id} already has {known['face_count']} faces.  Adding {room} of {len(faces)}.")
+            self.saved_calls['face.add_face'] += len(faces) - room
+            faces = faces[:room]
+        if not faces:
+            return person_id
+
+        logging.debug(f"Adding {len(faces)} faces to person {person_id}.")
+        results = await asyncio.gather(*(self._bounded(self.semaphore, self._add_face_to_person(person_id, image, face)) for face in faces),
+                                       return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+
+        deleted = all(isinstance(error, http_client.HttpError) and error.response.status_code == 404 for error in errors)
+        if len(errors) == len(faces) and deleted and person.get('registered'):
+            # The person the registry had for the celebrity was deleted from the Face API, so start a new one
+            logging.warning(f"Person {person_id} no longer exists.  Removing it from the person registry.")
+            await registry.forget(person_id)
+            self.saved_calls['face.create_person'] -= 1
+            return await self._register_person(image, dict(person, person_id=None, registered=False), registry)
+
+        if registry is not None and len(errors) < len(faces):
+            await registry.record(person_id, faces_added=len(faces) - len(errors))
+
+        if errors:
+            raise errors[0]
+
+        return person_id
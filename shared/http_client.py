@@ -0,0 +1,330 @@
+import os, time, json, random, logging, threading, contextvars, weakref, asyncio, email.utils
+import aiohttp
+from opentelemetry.trace import SpanKind
+import shared.rate_limiter as rate_limiter
+import shared.http_transport as http_transport
+import shared.telemetry as telemetry
+
+
+class HttpStats:
+    """
+    Per-endpoint latency, retry, error and rate limiter queue time for outbound HTTP calls.  Endpoints are logical
+    names such as 'face.detect' rather than URLs, so calls that differ only by an id are counted together.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, latency, retries, status_code, queue_time=0.0):
+        with self._lock:
+            stats = self._get_endpoint(endpoint)
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['queue_time'] += queue_time
+            stats['total_time'] += latency
+            stats['max_time'] = max(stats['max_time'], latency)
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+
+    def record_usage(self, endpoint, prompt_tokens, completion_tokens):
+        with self._lock:
+            stats = self._get_endpoint(endpoint)
+            stats['prompt_tokens'] = stats.get('prompt_tokens', 0) + prompt_tokens
+            stats['completion_tokens'] = stats.get('completion_tokens', 0) + completion_tokens
+
+    def _get_endpoint(self, endpoint):
+        return self._endpoints.setdefault(endpoint, {
+            'calls': 0,
+            'retries': 0,
+            'errors': 0,
+            'total_time': 0.0,
+            'max_time': 0.0,
+            'queue_time': 0.0
+        })
+
+    def total_queue_time(self):
+        with self._lock:
+            return sum(stats['queue_time'] for stats in self._endpoints.values())
+
+    def summary(self):
+        """
+        This function summarizes the calls recorded so far.
+
+        Returns:
+        dict: For each endpoint, the number of 'calls', 'retries' and 'errors', and the 'total_time', 'avg_time'
+              and 'max_time' in seconds.  'queue_time' is the part of 'total_time' spent waiting on the rate limiter.
+              Endpoints that report token usage also have 'prompt_tokens' and 'completion_tokens'.
+
+        """
+
+        with self._lock:
+            return {
+                endpoint: dict(stats, avg_time=stats['total_time'] / stats['calls'] if stats['calls'] else 0.0)
+                for endpoint, stats in self._endpoints.items()
+            }
+
+
+# The stats for the unit of work in progress, ex: a single image.  See collect_stats().
+_current_stats = contextvars.ContextVar('http_stats', default=None)
+
+
+def record_usage(endpoint, usage):
+    """
+    This function records the token usage an Azure OpenAI response reported, against the process wide stats and
+    the stats being collected for the current unit of work.
+
+    Parameters:
+    endpoint (str): The logical name of the endpoint, ex: 'openai.narrative'.
+    usage (dict): The 'usage' object of the response, with 'prompt_tokens' and 'completion_tokens'.
+
+    """
+
+    if not usage:
+        return
+
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', 0)
+    get_client().stats.record_usage(endpoint, prompt_tokens, completion_tokens)
+
+    current_stats = _current_stats.get()
+    if current_stats is not None:
+        current_stats.record_usage(endpoint, prompt_tokens, completion_tokens)
+
+
+class collect_stats:
+    """
+    A context manager that collects the HTTP stats for everything called within it, including asyncio tasks
+    created within it, which inherit the context.
+
+        with http_client.collect_stats() as stats:
+            ...
+        result["metrics"]["http"] = stats.summary()
+    """
+
+    def __enter__(self):
+        self.stats = HttpStats()
+        self._token = _current_stats.set(self.stats)
+        return self.stats
+
+    def __exit__(self, *exc_info):
+        _current_stats.reset(self._token)
+
+
+class HttpError(Exception):
+    """
+    Raised by HttpResponse.raise_for_status when a service returns an error status.
+    """
+
+    def __init__(self, message, response):
+        super().__init__(message)
+        self.response = response
+
+
+class HttpResponse:
+    """
+    A fully read HTTP response.  The body is read before the connection is handed back to the pool, so the
+    response can be used after the call returns.
+    """
+
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise HttpError(f"{self.status_code} error for url: {self.url.split('?')[0]}: {self.text[:500]}", self)
+
+
+class HttpClient:
+    """
+    A pooled asyncio HTTP client shared by the services in the shared package.  Connections are kept alive in a
+    pool per host, every call has a timeout, and throttled or failed calls are retried with exponential backoff
+    and jitter, honoring the Retry-After header when the service sends one.  Every attempt first acquires from
+    the process wide rate governor, see shared.rate_limiter, and is sent through the transport, which can record
+    the attempts or replay them, see shared.http_transport.
+    """
+
+    # Status codes that mean the request was not processed and can always be retried
+    THROTTLED_STATUS_CODES = (429, 503)
+
+    # Status codes that are only retried for idempotent requests, the request may have been processed
+    TRANSIENT_STATUS_CODES = (500, 502, 504)
+
+    def __init__(self, pool_size=None, connect_timeout=None, read_timeout=None, max_retries=None, backoff_base=None, backoff_max=None, transport=None):
+        # An explicit 0 is a setting too, ex: backoff_base=0 retries at once
+        self.pool_size = pool_size if pool_size is not None else int(os.getenv('HTTP_POOL_SIZE', '32'))
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout if connect_timeout is not None else float(os.getenv('HTTP_CONNECT_TIMEOUT', '5')),
+            sock_read=read_timeout if read_timeout is not None else float(os.getenv('HTTP_READ_TIMEOUT', '120'))
+        )
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv('HTTP_MAX_RETRIES', '4'))
+        self.backoff_base = backoff_base if backoff_base is not None else float(os.getenv('HTTP_BACKOFF_BASE', '0.5'))
+        self.backoff_max = backoff_max if backoff_max is not None else float(os.getenv('HTTP_BACKOFF_MAX', '30'))
+        self.transport = transport or http_transport.get_transport()
+
+        # Process wide stats across every unit of work
+        self.stats = HttpStats()
+
+        # aiohttp sessions belong to the event loop they were created on, so there is one per loop
+        self._sessions = weakref.WeakKeyDictionary()
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # limit_per_host is how many connections are kept alive to each host
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size, ttl_dns_cache=300)
+            # DNS and connection spans are only hooked in when spans are recorded
+            trace_configs = [telemetry.aiohttp_trace_config()] if telemetry.is_enabled() else None
+            session = aiohttp.ClientSession(connector=connector, timeout=self.timeout, trace_configs=trace_configs)
+            self._sessions[loop] = session
+        return session
+
+    async def post(self, url, endpoint, idempotent=True, tokens=0, **kwargs):
+        return await self.request('POST', url, endpoint, idempotent, tokens, **kwargs)
+
+    async def patch(self, url, endpoint, idempotent=True, tokens=0, **kwargs):
+        return await self.request('PATCH', url, endpoint, idempotent, tokens, **kwargs)
+
+    async def get(self, url, endpoint, idempotent=True, tokens=0, **kwargs):
+        return await self.request('GET', url, endpoint, idempotent, tokens, **kwargs)
+
+    async def request(self, method, url, endpoint, idempotent=True, tokens=0, **kwargs):
+        """
+        This function sends a request, retrying it when the service is throttling or has a transient failure.
+
+        Parameters:
+        method (str): The HTTP method.
+        url (str): The URL to call.
+        endpoint (str): The logical name of the endpoint for the stats, ex: 'face.detect'.
+        idempotent (bool): Whether the request is safe to repeat if it may already have been processed.  Requests
+                           that are not idempotent are only retried when the service definitely did not process them.
+        tokens (int): The estimated token cost of the request for endpoints limited by tokens per minute.
+        kwargs: Passed on to aiohttp, ex: headers, data, json.
+
+        Returns:
+        HttpResponse: The final response.  The caller should check the status, it is not raised here.
+
+        """
+
+        session = self._get_session()
+        limiter = rate_limiter.get_governor().get_limiter(endpoint)
+
+        # The query string is left out of the span, it can hold a SAS token or a key
+        attributes = {'http.request.method': method, 'url.full': url.split('?')[0], 'http.endpoint': endpoint}
+        with telemetry.span(f"{method} {endpoint}", attributes, SpanKind.CLIENT) as request_span:
+            start_time = time.perf_counter()
+            queue_time = 0.0
+            attempt = 0
+            while True:
+                # Wait our turn with the rate limiter, so we don't send requests the service is only going to throttle
+                if limiter is not None:
+                    wait_time = limiter.reserve(tokens)
+                    if wait_time > 0:
+                        await asyncio.sleep(wait_time)
+                        queue_time += wait_time
+
+                try:
+                    status_code, headers, content = await self.transport.send(session, method, url, endpoint, kwargs)
+                    response = HttpResponse(status_code, headers, content, url)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # A failure to connect means the request never reached the service.  Anything else may have been processed.
+                    retryable = idempotent or isinstance(e, (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError))
+                    if attempt >= self.max_retries or not retryable:
+                        self._record(endpoint, start_time, attempt, None, queue_time, request_span)
+                        raise
+                    delay = self._backoff(attempt)
+                    logging.warning(f"{endpoint} failed with {type(e).__name__}, retrying in {delay:.2f} seconds")
+                    request_span.add_event('retry', {'error.type': type(e).__name__, 'retry.delay': delay})
+                else:
+                    if limiter is not None:
+                        limiter.feedback(response.status_code == 429)
+
+                    if not self._should_retry(response.status_code, idempotent) or attempt >= self.max_retries:
+                        self._record(endpoint, start_time, attempt, response.status_code, queue_time, request_span)
+                        return response
+                    delay = self._retry_after(response) or self._backoff(attempt)
+                    logging.warning(f"{endpoint} returned {response.status_code}, retrying in {delay:.2f} seconds")
+                    request_span.add_event('retry', {'http.response.status_code': response.status_code, 'retry.delay': delay})
+
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def close(self):
+        # Close the session belonging to the running loop, ex: when a benchmark tears its loop down
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _should_retry(self, status_code, idempotent):
+        if status_code in HttpClient.THROTTLED_STATUS_CODES:
+            return True
+        return idempotent and status_code in HttpClient.TRANSIENT_STATUS_CODES
+
+    def _backoff(self, attempt):
+        # Exponential backoff with full jitter so that concurrent callers do not retry in lock step
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _retry_after(self, response):
+        # Retry-After is either a number of seconds or an HTTP date
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is None:
+            return None
+
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return None
+
+        # Add a little jitter so that every throttled caller does not come back at the same instant
+        return min(self.backoff_max, max(0.0, delay)) + random.uniform(0, self.backoff_base)
+
+    def _record(self, endpoint, start_time, retries, status_code, queue_time, request_span):
+        latency = time.perf_counter() - start_time
+        self.stats.record(endpoint, latency, retries, status_code, queue_time)
+
+        attributes = {'http.endpoint': endpoint, 'http.response.status_code': status_code or 0}
+        telemetry.http_duration.record(latency, attributes)
+        telemetry.http_queue_time.record(queue_time, {'http.endpoint': endpoint})
+        if retries:
+            telemetry.http_retries.add(retries, {'http.endpoint': endpoint})
+        if request_span.is_recording():
+            request_span.set_attributes({'http.response.status_code': status_code or 0, 'http.retries': retries, 'http.queue_time': queue_time})
+
+        current_stats = _current_stats.get()
+        if current_stats is not None:
+            current_stats.record(endpoint, latency, retries, status_code, queue_time)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    This function returns the HttpClient shared by everything in the process, so connections are reused across calls.
+
+    Returns:
+    HttpClient: The shared client.
+
+    """
+
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HttpClient()
+    return _client
@@ -0,0 +1,308 @@
+import os, re, json, time, base64, hashlib, logging, threading, asyncio, datetime, collections
+import aiohttp
+from multidict import CIMultiDict
+
+
+# The response headers kept in a recording, the ones the retry logic and the rate limiter read
+RECORDED_HEADERS = ('Content-Type', 'Retry-After', 'retry-after-ms', 'x-ratelimit-remaining-requests', 'x-ratelimit-remaining-tokens')
+
+# Query parameters that can carry a credential
+SECRET_PARAMETERS = ('sig', 'code', 'key', 'api-key', 'subscription-key', 'subscription_key', 'token')
+
+# URLs inside request bodies, ex: an image's SAS URL, whose query string is a credential that changes with every request
+_BODY_URL = re.compile(r'(https?://[^"\s?]+)\?[^"\s]*')
+
+# Everything up to the blob name of a URL inside a request body
+_URL_PREFIX = re.compile(r'https?://[^"\s]*/')
+
+# Images sent inline to Azure OpenAI, which are replaced by their hash
+_DATA_URI = re.compile(r'data:([\w/+.-]+);base64,([A-Za-z0-9+/=]+)')
+
+
+class ReplayError(LookupError):
+    """
+    Raised when a replayed request has no recording to answer it with.
+    """
+
+
+class AiohttpTransport:
+    """
+    Sends requests over the network with aiohttp.  HttpClient retries, rate limits and measures the requests, a
+    transport only sends one attempt.
+    """
+
+    mode = 'live'
+
+    async def send(self, session, method, url, endpoint, kwargs):
+        """
+        This function sends one attempt of a request.
+
+        Parameters:
+        session (aiohttp.ClientSession): The session of the running event loop.
+        method (str): The HTTP method.
+        url (str): The URL to call.
+        endpoint (str): The logical name of the endpoint, ex: 'face.detect'.
+        kwargs (dict): Passed on to aiohttp, ex: headers, data, json.
+
+        Returns:
+        tuple: The status code, the headers and the body of the response.
+
+        """
+
+        async with session.request(method, url, **kwargs) as raw_response:
+            return raw_response.status, raw_response.headers, await raw_response.read()
+
+
+def scrub_url(url):
+    """
+    This function removes the credentials from the query string of a URL.
+    """
+
+    path, _, query = url.partition('?')
+    if not query:
+        return path
+    parameters = [parameter for parameter in query.split('&') if parameter.split('=')[0].lower() not in SECRET_PARAMETERS]
+    return f"{path}?{'&'.join(parameters)}" if parameters else path
+
+
+def describe_request(method, url, kwargs):
+    """
+    This function describes a request without its credentials, and fingerprints it so the same request made in
+    another run can be matched to it.  Request headers are left out, they carry the keys.  The query strings of URLs
+    in the body are removed, they are SAS tokens, and images in the body are replaced by their size and hash.
+
+    Parameters:
+    method (str): The HTTP method.
+    url (str): The URL of the request.
+    kwargs (dict): The aiohttp arguments of the request, ex: data, json or params.
+
+    Returns:
+    tuple: The fingerprint (str) and the scrubbed request (dict).
+
+    """
+
+    data = kwargs.get('data')
+    if kwargs.get('json') is not None:
+        data = json.dumps(kwargs['json'], sort_keys=True)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+
+    request = {'method': method, 'url': scrub_url(url)}
+    if kwargs.get('params'):
+        request['params'] = {name: value for name, value in kwargs['params'].items() if name.lower() not in SECRET_PARAMETERS}
+
+    body = key_body = None
+    if data is not None and not isinstance(data, (bytes, bytearray)):
+        # A stream or form, which can't be read without consuming it
+        body = key_body = {'type': type(data).__name__}
+    elif data is not None:
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            # An image sent as the body
+            body = key_body = {'bytes': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+        else:
+            text = _BODY_URL.sub(r'\1', text)
+            text = _DATA_URI.sub(lambda match: f"data:{match.group(1)};sha256,{hashlib.sha256(match.group(2).encode()).hexdigest()}", text)
+            body = _parse(text)
+            key_body = _parse(_URL_PREFIX.sub('', text))
+    if body is not None:
+        request['body'] = body
+
+    # The hosts and containers are left out, so a recording from one resource replays against another
+    key = json.dumps([method, request['url'].split('://')[-1].partition('/')[2], request.get('params'), key_body], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest(), request
+
+
+def _parse(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+class RecordingTransport:
+    """
+    Sends requests with another transport and appends every attempt, its response and how long it took to a JSONL
+    file, for ReplayTransport to serve later.  Credentials are left out of the recording, see describe_request.
+    """
+
+    mode = 'record'
+
+    def __init__(self, path, transport=None):
+        self.path = path
+        self.transport = transport or AiohttpTransport()
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    async def send(self, session, method, url, endpoint, kwargs):
+        start_time = time.perf_counter()
+        try:
+            status_code, headers, content = await self.transport.send(session, method, url, endpoint, kwargs)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self._write(method, url, endpoint, kwargs, time.perf_counter() - start_time, {'error': type(e).__name__})
+            raise
+
+        response = {
+            'status': status_code,
+            'headers': {name: headers[name] for name in RECORDED_HEADERS if name in headers}
+        }
+        try:
+            response['body'] = content.decode('utf-8')
+        except UnicodeDecodeError:
+            response['body_base64'] = base64.b64encode(content).decode('ascii')
+
+        self._write(method, url, endpoint, kwargs, time.perf_counter() - start_time, response)
+        return status_code, headers, content
+
+    def _write(self, method, url, endpoint, kwargs, latency, response):
+        fingerprint, request = describe_request(method, url, kwargs)
+        line = json.dumps({
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'endpoint': endpoint,
+            'fingerprint': fingerprint,
+            'latency': latency,
+            'request': request,
+            'response': response
+        })
+
+        # One line per attempt, flushed so a crashed worker keeps what it recorded
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayTransport:
+    """
+    Answers requests from a recording made by RecordingTransport, after the recorded latency, without touching the
+    network.  A request is answered by the recordings of the same request, in the order they were recorded, so a
+    throttled attempt is followed by the retry's answer again.  A request that wasn't recorded is answered by the
+    recordings of its endpoint in turn.
+    """
+
+    mode = 'replay'
+
+    def __init__(self, path, latency_scale=1.0):
+        """
+        Parameters:
+        path (str): The JSONL file written by RecordingTransport.
+        latency_scale (float): Multiplies the recorded latencies, ex: 0 answers at once, 2 twice as slowly.
+        """
+
+        self.path = path
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._requests = collections.defaultdict(list)
+        self._endpoints = collections.defaultdict(list)
+        self._positions = collections.Counter()
+
+        # How many requests were answered from their own recording, and how many from their endpoint's
+        self.matched = collections.Counter()
+        self.unmatched = collections.Counter()
+
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    recording = json.loads(line)
+                    self._requests[recording['fingerprint']].append(recording)
+                    self._endpoints[recording['endpoint']].append(recording)
+
+    async def send(self, session, method, url, endpoint, kwargs):
+        fingerprint, request = describe_request(method, url, kwargs)
+
+        with self._lock:
+            if fingerprint in self._requests:
+                recording = self._next(fingerprint, self._requests[fingerprint])
+                self.matched[endpoint] += 1
+            elif endpoint in self._endpoints:
+                recording = self._next(endpoint, self._endpoints[endpoint])
+                if not self.unmatched[endpoint]:
+                    logging.warning(f"{endpoint} {request['url']} was not recorded, answering it with the other recordings of {endpoint}")
+                self.unmatched[endpoint] += 1
+            else:
+                raise ReplayError(f"{self.path} has no recordings of {endpoint}")
+
+        if self.latency_scale > 0:
+            await asyncio.sleep(recording['latency'] * self.latency_scale)
+
+        response = recording['response']
+        if 'error' in response:
+            raise self._make_error(response['error'])
+
+        if 'body_base64' in response:
+            content = base64.b64decode(response['body_base64'])
+        else:
+            content = response['body'].encode('utf-8')
+        if fingerprint not in self._requests:
+            content = self._adapt(endpoint, request, content)
+
+        # The wait a throttled answer asks for is scaled along with the latency
+        headers = CIMultiDict(response['headers'])
+        if self.latency_scale != 1 and 'Retry-After' in headers:
+            try:
+                headers['Retry-After'] = str(float(headers['Retry-After']) * self.latency_scale)
+            except ValueError:
+                pass
+        return response['status'], headers, content
+
+    def _next(self, key, recordings):
+        # Cycle through the recordings, so a replay can run longer than the recording did
+        position = self._positions[key]
+        self._positions[key] += 1
+        return recordings[position % len(recordings)]
+
+    def _adapt(self, endpoint, request, content):
+        # Identify answers for the faces in the request, and the pipeline looks its answers up by the face IDs
+        if endpoint != 'face.identify' or not isinstance(request.get('body'), dict):
+            return content
+        try:
+            results = json.loads(content)
+            face_ids = request['body']['faceIds']
+            if not isinstance(results, list) or not results:
+                return content
+            return json.dumps([dict(results[index % len(results)], faceId=face_id) for index, face_id in enumerate(face_ids)]).encode('utf-8')
+        except (ValueError, KeyError, TypeError):
+            return content
+
+    def _make_error(self, name):
+        if name == 'ConnectionTimeoutError':
+            return aiohttp.ConnectionTimeoutError()
+        if name in ('TimeoutError', 'ServerTimeoutError', 'SocketTimeoutError'):
+            return asyncio.TimeoutError()
+        return aiohttp.ClientConnectionError(f"Replayed {name}")
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    This function returns the transport HttpClient sends requests through, by HTTP_CAPTURE_MODE: 'live' sends them,
+    'record' sends them and appends them to HTTP_CAPTURE_PATH, and 'replay' answers them from HTTP_CAPTURE_PATH at
+    HTTP_REPLAY_LATENCY_SCALE times the recorded latency.
+
+    Returns:
+    AiohttpTransport, RecordingTransport or ReplayTransport: The transport shared by the process.
+
+    """
+
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                mode = os.getenv('HTTP_CAPTURE_MODE', 'live').lower()
+                path = os.getenv('HTTP_CAPTURE_PATH', 'http_capture.jsonl')
+                if mode == 'live':
+                    _transport = AiohttpTransport()
+                elif mode == 'record':
+                    _transport = RecordingTransport(path)
+                elif mode == 'replay':
+                    _transport = ReplayTransport(path, float(os.getenv('HTTP_REPLAY_LATENCY_SCALE', '1')))
+                else:
+                    raise ValueError(f"Unknown HTTP capture mode '{mode}'.  Expected 'live', 'record' or 'replay'.")
+    return _transport
@@ -0,0 +1,207 @@
+import os, json, logging, asyncio
+import shared.http_client as http_client
+import shared.event_loop as event_loop
+import shared.narrative_generator as narrative_generator
+import shared.category_generator as category_generator
+from shared.image_source import ImageSource
+
+
+class ImageAnalyzer:
+    """
+    Generates the narrative and the categories for an image in a single Azure OpenAI request, rather than one
+    request each from NarrativeGenerator and CategoryGenerator.  The image is only sent, and paid for, once.
+    """
+
+    # The categories the model may choose from
+    CATEGORIES = ['Lifestyle', 'Civil Rights', 'Entertainment', 'Sports']
+
+    # The prompts are part of the result cache version, see ImageProcessor._get_cache_version
+    SYSTEM_PROMPT = (
+        "You are a helpful assistant that looks at images, describes them in as much detail as possible, and suggests categories for them. "
+        "Respond with a JSON object with exactly two keys. "
+        "\"narrative\" is a string describing the scene in the image with as much detail as possible. Don't use any apostrophe characters (like this ') or possessive nouns (like the man's) in it. "
+        "\"categories\" is a list of strings.  You must only recommend (Lifestyle, Civil Rights, Entertainment, Sports) as potential categories.  If you are not sure, don't recommend anything and use an empty list."
+    )
+
+    USER_PROMPT = "Please describe the scene in this picture and suggest categories for it."
+
+    async def analyze_image_async(self, image):
+        """
+        This function generates the narrative and categories for an image.  If the model's response can't be
+        parsed, they are generated with the separate narrative and category requests instead.
+
+        Parameters:
+        image (str or ImageSource): The URL of the image, or an ImageSource holding it.
+
+        Returns:
+        dict: The 'narrative', the list of 'categories', and 'fallback', which is True when the separate
+              requests were used.
+
+        """
+
+        image = ImageSource.wrap(image)
+        logging.info(f"Analyzing image: {image}")
+
+        try:
+            content = await self._request_analysis(image)
+            analysis = self.parse_analysis(content)
+            analysis['fallback'] = False
+        except ValueError as e:
+            logging.warning(f"Could not parse the image analysis, falling back to separate requests: {e}")
+            narrative, categories = await asyncio.gather(
+                narrative_generator.NarrativeGenerator().generate_narrative_async(image),
+                category_generator.CategoryGenerator().generate_categories_async(image)
+            )
+            analysis = {
+                'narrative': narrative,
+                'categories': categories,
+                'fallback': True
+            }
+
+        logging.info(f"Image analysis generated: {analysis}")
+
+        return analysis
+
+    def analyze_image(self, image):
+        """
+        The synchronous wrapper for analyze_image_async.
+        """
+
+        return event_loop.run_sync(self.analyze_image_async(image))
+
+    def parse_analysis(self, content):
+        """
+        This function parses and validates the JSON the model responded with.
+
+        Parameters:
+        content (str): The content of the model's message.
+
+        Returns:
+        dict: The 'narrative' and the list of 'categories', see validate_analysis.
+
+        """
+
+        return self.validate_analysis(self.parse_json(content))
+
+    def parse_json(self, content):
+        """
+        This function parses the JSON object in a model's response.
+
+        Parameters:
+        content (str): The content of the model's message.
+
+        Returns:
+        dict: The parsed object.
+
+        """
+
+        content = content.strip()
+
+        # Models sometimes wrap JSON in a markdown code fence even when asked for a JSON object
+        if content.startswith('```'):
+            content = content.strip('`')
+            if content.startswith('json'):
+                content = content[len('json'):]
+
+        # json.JSONDecodeError is a ValueError
+        parsed = json.loads(content)
+
+        if not isinstance(parsed, dict):
+            raise ValueError(f"Expected a JSON object, got {type(parsed).__name__}")
+        return parsed
+
+    def validate_analysis(self, analysis):
+        """
+        This function validates the analysis of a single image.
+
+        Parameters:
+        analysis (dict): The analysis, with a 'narrative' and 'categories'.
+
+        Returns:
+        dict: The 'narrative' and the list of 'categories'.  Categories are matched to CATEGORIES regardless of
+              case, and any the model made up are dropped.
+
+        """
+
+        if not isinstance(analysis, dict):
+            raise ValueError(f"Expected a JSON object, got {type(analysis).__name__}")
+
+        narrative = analysis.get('narrative')
+        if not isinstance(narrative, str) or not narrative.strip():
+            raise ValueError("'narrative' must be a non-empty string")
+
+        categories = analysis.get('categories')
+        if not isinstance(categories, list) or not all(isinstance(category, str) for category in categories):
+            raise ValueError("'categories' must be a list of strings")
+
+        known_categories = {category.lower(): category for category in ImageAnalyzer.CATEGORIES}
+        unknown_categories = [category for category in categories if category.strip().lower() not in known_categories]
+        if unknown_categories:
+            logging.warning(f"Dropping unknown categories: {unknown_categories}")
+
+        return {
+            'narrative': narrative.strip(),
+            'categories': [known_categories[category.strip().lower()] for category in categories if category.strip().lower() in known_categories]
+        }
+
+    async def _request_analysis(self, image):
+        # Azure OpenAI GPT model details
+        api_key = os.getenv("AZURE_OPEN_AI_KEY")
+        gpt4_endpoint = os.getenv("AZURE_OPEN_AI_ENDPOINT")
+
+        # Create headers for the request
+        headers = {
+            "Content-Type": "application/json",
+            "api-key": api_key,
+        }
+
+        # Create the payload for the request.  JSON mode makes the model respond with a JSON object.
+        payload = {
+            "messages": [
+                {
+                    "role": "system",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": ImageAnalyzer.SYSTEM_PROMPT
+                        }
+                    ]
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": ImageAnalyzer.USER_PROMPT
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": image.openai_url()
+                            }
+                        }
+                    ]
+                }
+            ],
+            "response_format": {"type": "json_object"},
+            "temperature": 0.7,
+            "top_p": 0.95,
+            "max_tokens": 2000
+        }
+
+        # Send request to GPT-4 endpoint
+        # max_tokens is the estimated token cost the rate limiter charges against the tokens per minute quota
+        response = await http_client.get_client().post(gpt4_endpoint, 'openai.analysis', tokens=payload["max_tokens"], headers=headers, json=payload)
+        response.raise_for_status()
+        response_json = response.json()
+        http_client.record_usage('openai.analysis', response_json.get('usage'))
+
+        try:
+            content = response_json['choices'][0]['message']['content']
+        except (KeyError, IndexError, TypeError) as e:
+            raise ValueError(f"Unexpected response shape: {e}")
+
+        # The content is missing when the response was filtered
+        if not isinstance(content, str):
+            raise ValueError("The response has no content")
+        return content
@@ -0,0 +1,196 @@
+import os, io, time, asyncio, weakref, logging, threading, multiprocessing
+import shared.telemetry as telemetry
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class SharedMemoryReader(io.RawIOBase):
+    """
+    A read-only file over a shared memory buffer, so Pillow decodes straight from the buffer without copying
+    it into a BytesIO first.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        # A seek past the end reads nothing, like a file does
+        count = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        # The view has to go before the shared memory it points into can be closed
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+def _warm_worker():
+    # Import Pillow, its codecs and the scaler once per worker, rather than on the first image it is handed
+    from PIL import Image
+    import shared.image_scaler
+    Image.init()
+
+
+def _create_derivatives(shared_memory_name, size, derivative_settings, quality):
+    # Runs in a worker process.  The parent owns the shared memory and unlinks it once the result is back.
+    import shared.image_scaler as image_scaler
+
+    buffer = shared_memory.SharedMemory(name=shared_memory_name)
+    try:
+        with SharedMemoryReader(buffer.buf[:size]) as reader:
+            return image_scaler.ImageHelper().create_derivatives(reader, derivative_settings, quality)
+    finally:
+        buffer.close()
+
+
+class ImagePool:
+    """
+    Warm worker processes for the CPU bound part of a resize, the decode, resample and encode, so a burst of
+    large images doesn't hold the GIL the event loop needs for I/O.  The original is handed over in shared
+    memory rather than pickled down a pipe.  The derivatives are small, and come back pickled.
+
+    At most max_pending resizes are handed to the pool at once, one running on each worker and the rest queued.
+    Callers past that wait their turn, so a burst of uploads can't pile copies of their originals into memory.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        """
+        Parameters:
+        workers (int): The number of worker processes.  Defaults to IMAGE_POOL_WORKERS or the number of CPUs.
+        max_pending (int): The most resizes handed to the pool at once.  Defaults to IMAGE_POOL_MAX_PENDING or
+                           twice the number of workers.
+        """
+
+        self.workers = workers or int(os.getenv('IMAGE_POOL_WORKERS', str(os.cpu_count() or 1)))
+        self.max_pending = max_pending or int(os.getenv('IMAGE_POOL_MAX_PENDING', str(self.workers * 2)))
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # The semaphores belong to the event loop they were created on.  There is normally one loop per process.
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # Workers attach to the shared memory through the parent's resource tracker.  If they started their
+                # own it would unlink the buffers when they exit.
+                resource_tracker.ensure_running()
+
+                # Spawned rather than forked, forking a process with running threads can deadlock the child
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'), initializer=_warm_worker)
+                # The executor only starts a worker when work arrives for it, start them all now
+                for _ in range(self.workers):
+                    self._executor.submit(_warm_worker)
+            return self._executor
+
+    async def create_derivatives(self, image_data, derivative_settings, quality=None):
+        """
+        This function runs ImageHelper.create_derivatives on a worker process.
+
+        Parameters:
+        image_data (bytes): The encoded bytes of the original image.
+        derivative_settings (dict): The output settings for each derivative, keyed by derivative name.
+        quality (str): The resize strategy to use, see ImageHelper.create_derivatives.
+
+        Returns:
+        dict: The derivatives, see ImageHelper.create_derivatives.  Each one also has the 'queue_wait', the seconds
+              spent waiting for room in the pool.
+
+        """
+
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+
+        # The worker's own decode, shrink and encode aren't traced, this span covers them along with the wait
+        with telemetry.span('image pool', {'image.bytes': len(image_data)}) as pool_span:
+            wait_start = time.perf_counter()
+            async with semaphore:
+                queue_wait = time.perf_counter() - wait_start
+                pool_span.set_attribute('image.queue_wait', queue_wait)
+                if queue_wait > 1:
+                    logging.info(f"Waited {queue_wait:.1f}s for room in the image pool")
+
+                buffer = shared_memory.SharedMemory(create=True, size=max(1, len(image_data)))
+                try:
+                    buffer.buf[:len(image_data)] = image_data
+                    executor = self._get_executor()
+                    try:
+                        derivatives = await loop.run_in_executor(executor, _create_derivatives, buffer.name, len(image_data), derivative_settings, quality)
+                    except BrokenProcessPool:
+                        # A worker died, ex: it ran out of memory.  The next resize gets a new pool.
+                        self._reset(executor)
+                        raise
+                finally:
+                    buffer.close()
+                    buffer.unlink()
+
+        for derivative in derivatives.values():
+            derivative['queue_wait'] = queue_wait
+        return derivatives
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def close(self):
+        """
+        This function stops the worker processes.
+        """
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    This function returns the ImagePool shared by everything in the process, when IMAGE_ENGINE is 'process'.
+
+    Returns:
+    ImagePool: The shared pool, or None when images are resized on the event loop's thread pool.
+
+    """
+
+    global _pool
+    engine = os.getenv('IMAGE_ENGINE', 'thread').lower()
+    if engine not in ('thread', 'process'):
+        raise ValueError(f"Unknown image engine '{engine}'.  Expected 'thread' or 'process'.")
+    if engine == 'thread':
+        return None
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ImagePool()
+    return _pool
@@ -1,74 +1,595 @@
-import os
-from azure.storage.blob import BlobServiceClient
-import requests
-import uuid
+import os, asyncio, contextvars
+from azure.storage.blob import ContentSettings
+import shared.storage as storage
+import shared.event_loop as event_loop
+import shared.blob_transfer as blob_transfer
+import shared.image_pool as image_pool
+import shared.telemetry as telemetry
 from PIL import Image
 from io import BytesIO
-import tempfile
 
-from PIL import Image
-from io import BytesIO
+# Pillow refuses to open anything over about 178 megapixels, before a huge JPEG could be DCT scaled on decode.
+# The decode budget in create_derivatives() guards against decompression bombs instead.
+Image.MAX_IMAGE_PIXELS = None
+
+
+class ImageTooLargeError(ValueError):
+    """
+    Raised when an image can't be decoded within the decode budget.
+    """
+
 
 class ImageHelper:
 
-    def resize(self, filename):
-        # Create a BlobServiceClient object
-        blob_service_client = BlobServiceClient.from_connection_string(os.getenv('STORAGE_ACCOUNT_CONNECTION'))  
-    
-        # Get the BlobClient for the original blob
-        original_blob_client = blob_service_client.get_blob_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'), filename)
+    # The largest decoded raster (width x height x bytes per pixel) we hand on to the AI services.
+    MAX_RASTER_BYTES = 6*1024*1024
+
+    # The scales the JPEG decoder can shrink an image by as it decodes it.
+    DRAFT_SCALES = (2, 4, 8)
+
+    # The quality/speed trade offs for shrinking an image.
+    #   draft_gap:  JPEGs are DCT scaled on decode to no less than this multiple of the target size.  None disables it.
+    #   reduce_gap: The image is shrunk with reduce() to no less than this multiple of the target size.  None disables it.
+    #   resample:   The filter used for the final resize to the target size.
+    RESIZE_STRATEGIES = {
+        'best': {'draft_gap': None, 'reduce_gap': None, 'resample': Image.Resampling.LANCZOS},
+        'balanced': {'draft_gap': 2.0, 'reduce_gap': 2.0, 'resample': Image.Resampling.LANCZOS},
+        'fast': {'draft_gap': 1.0, 'reduce_gap': 1.0, 'resample': Image.Resampling.BILINEAR},
+    }
+
+    # The output formats we can encode resized images to, along with the file extension, content type and the modes the encoder accepts.
+    OUTPUT_FORMATS = {
+        'PNG': {'extension': 'png', 'content_type': 'image/png', 'modes': None},
+        'JPEG': {'extension': 'jpg', 'content_type': 'image/jpeg', 'modes': ('L', 'RGB')},
+        'WEBP': {'extension': 'webp', 'content_type': 'image/webp', 'modes': ('RGB', 'RGBA')},
+    }
+
+    # The derivative every image gets.  It is the one sent to the Face API and the fallback for every other service.
+    PRIMARY_DERIVATIVE = 'face'
+
+    # Built in settings for well known derivatives, used when the <NAME>_IMAGE_* environment variables are not set.
+    # GPT-4 vision models scale anything larger than 2048 pixels down before tokenizing it.
+    DERIVATIVE_DEFAULTS = {
+        'llm': {'MAX_DIMENSION': '2048'},
+    }
+
+    # The lowest quality we will drop to when fitting a lossy image under the target size before shrinking it instead.
+    MIN_FIT_QUALITY = 40
+
+    # The perceptual hash compares neighbouring pixels in a grid this size, giving a 64 bit hash.
+    HASH_SIZE = 8
+
+    async def resize_async(self, filename, derivatives=None, upload=True, image_data=None):
+        """
+        This function downloads an image from the original container, resizes and re-encodes it, and uploads
+        it to the resized container.  Every derivative is produced from a single decode of the original.  The
+        decode, resize and encode run off the event loop, see create_derivatives_async(), so it stays free for I/O.
+
+        Parameters:
+        filename (str): The name of the blob in the original image container.
+        derivatives (list): The names of the derivatives to produce.  The primary 'face' derivative is always
+                            produced.  Defaults to get_derivative_names().
+        upload (bool): Whether to upload the derivatives to the resized container.  When False the caller is
+                       expected to call upload_async() with the result once it is ready to.
+        image_data (bytes): The original image, when the caller has already downloaded it.
+
+        Returns:
+        dict: The primary resized blob name along with the format, quality, dimensions and encoded size of the
+              resized image.  The 'derivatives' key holds the same details for every derivative by name, along
+              with the encoded 'data' and its 'content_type'.  'perceptual_hash' is the dHash of the image, see
+              perceptual_hash().
+
+        """
+
+        original_blob_data = image_data
+        if original_blob_data is None:
+            # Get the shared BlobServiceClient for this event loop
+            blob_service_client = storage.get_blob_service_client()
+
+            # Get the BlobClient for the original blob
+            original_blob_client = blob_service_client.get_blob_client(os.getenv('ORIGINAL_IMAGE_CONTAINER'), filename)
+
+            # Download the blob into memory in parallel chunks.  The encoded bytes are decoded straight from this buffer.
+            original_blob_data = await blob_transfer.download_bytes(original_blob_client, self.get_max_original_bytes())
+
+        if derivatives is None:
+            derivatives = self.get_derivative_names()
+
+        # Resize and re-encode every derivative without touching the local disk
+        derivative_settings = {name: self.get_output_settings(name) for name in derivatives}
+        resized_images = await self.create_derivatives_async(original_blob_data, derivative_settings)
+
+        results = {}
+        for name, resized_image in resized_images.items():
+            results[name] = {
+                # The extension of the resized blob follows the output format
+                'resized_filename': self.get_resized_filename(filename, name, resized_image['extension']),
+                'format': resized_image['format'],
+                'quality': resized_image['quality'],
+                'width': resized_image['width'],
+                'height': resized_image['height'],
+                'size_bytes': len(resized_image['data']),
+                'content_type': ImageHelper.OUTPUT_FORMATS[resized_image['format']]['content_type'],
+                'data': resized_image['data']
+            }
+
+        result = dict(results[ImageHelper.PRIMARY_DERIVATIVE])
+        result['derivatives'] = results
+        result['perceptual_hash'] = resized_images[ImageHelper.PRIMARY_DERIVATIVE]['perceptual_hash']
+        result['engine'] = resized_images[ImageHelper.PRIMARY_DERIVATIVE]['engine']
+        result['queue_wait'] = resized_images[ImageHelper.PRIMARY_DERIVATIVE]['queue_wait']
+
+        if upload:
+            await self.upload_async(result)
+
+        return result
+
+    def resize(self, filename, derivatives=None, upload=True, image_data=None):
+        """
+        The synchronous wrapper for resize_async.
+        """
+
+        return event_loop.run_sync(self.resize_async(filename, derivatives, upload, image_data))
+
+    async def upload_async(self, resized_result):
+        """
+        This function uploads every derivative of a resize_async() result to the resized container.
+
+        Parameters:
+        resized_result (dict): The result returned by resize_async().
+
+        """
+
+        # Get the shared BlobServiceClient for this event loop
+        blob_service_client = storage.get_blob_service_client()
 
-        # Download the blob to a stream
-        original_blob_data = original_blob_client.download_blob().readall()
+        async def upload_derivative(derivative):
+            # Create a new BlobClient for the resized blob
+            resized_blob_client = blob_service_client.get_blob_client(os.getenv('RESIZED_IMAGE_CONTAINER'), derivative['resized_filename'])
 
-        # Open the image and convert it to PNG
-        image = Image.open(BytesIO(original_blob_data))
+            # Upload the encoded buffer to the blob
+            await blob_transfer.upload_bytes(resized_blob_client, derivative['data'], overwrite=True, content_settings=ContentSettings(content_type=derivative['content_type']))
+
+        # Upload the derivatives at the same time
+        await asyncio.gather(*(upload_derivative(derivative) for derivative in resized_result['derivatives'].values()))
+
+    def upload(self, resized_result):
+        """
+        The synchronous wrapper for upload_async.
+        """
+
+        event_loop.run_sync(self.upload_async(resized_result))
+
+    def resize_image_data(self, image_data, quality=None, output_settings=None):
+        """
+        This function resizes an encoded image held in memory and returns the re-encoded bytes.
+
+        Parameters:
+        image_data (bytes): The encoded bytes of the original image.
+        quality (str): The resize strategy to use, one of 'best', 'balanced' or 'fast'.  Defaults to the
+                       IMAGE_RESIZE_QUALITY environment variable, or 'balanced' if that is not set.
+        output_settings (dict): The output encoding settings.  Defaults to get_output_settings().
+
+        Returns:
+        dict: The encoded 'data' along with the 'format', file 'extension', encoder 'quality', 'width' and 'height'.
+
+        """
+
+        if output_settings is None:
+            output_settings = self.get_output_settings()
+
+        return self.create_derivatives(image_data, {ImageHelper.PRIMARY_DERIVATIVE: output_settings}, quality)[ImageHelper.PRIMARY_DERIVATIVE]
+
+    async def create_derivatives_async(self, image_data, derivative_settings, quality=None):
+        """
+        This function runs create_derivatives() off the event loop.  With IMAGE_ENGINE set to 'process' it runs on
+        the warm worker processes of the shared ImagePool, otherwise on the event loop's thread pool, where the
+        parts of a resize that hold the GIL compete with the loop.
+
+        Parameters:
+        image_data (bytes): The encoded bytes of the original image.
+        derivative_settings (dict): The output settings for each derivative, keyed by derivative name.
+        quality (str): The resize strategy to use, see create_derivatives().
+
+        Returns:
+        dict: The derivatives, see create_derivatives().  Each one also has the 'engine' it ran on, 'thread' or
+              'process', and the 'queue_wait' in seconds before the process pool had room for it.
+
+        """
+
+        pool = image_pool.get_pool()
+        if pool is not None:
+            derivatives = await pool.create_derivatives(image_data, derivative_settings, quality)
+            for derivative in derivatives.values():
+                derivative['engine'] = 'process'
+            return derivatives
+
+        # The executor doesn't carry the context over, the resize spans need it to find their parent
+        context = contextvars.copy_context()
+        derivatives = await asyncio.get_running_loop().run_in_executor(None, context.run, self.create_derivatives, image_data, derivative_settings, quality)
+        for derivative in derivatives.values():
+            derivative['engine'] = 'thread'
+            derivative['queue_wait'] = 0.0
+        return derivatives
+
+    def create_derivatives(self, image_data, derivative_settings, quality=None):
+        """
+        This function decodes an encoded image once and produces a resized, re-encoded derivative for each
+        of the requested output settings.
+
+        Parameters:
+        image_data (bytes): The encoded bytes of the original image, or a file-like object to read them from.
+        derivative_settings (dict): The output settings for each derivative, keyed by derivative name.
+        quality (str): The resize strategy to use, one of 'best', 'balanced' or 'fast'.  Defaults to the
+                       IMAGE_RESIZE_QUALITY environment variable, or 'balanced' if that is not set.
+
+        Returns:
+        dict: For each derivative name, the encoded 'data' along with the 'format', file 'extension',
+              encoder 'quality', 'width' and 'height'.  Each one also has the 'perceptual_hash' of the image.
+
+        """
+
+        strategy = self._get_strategy(quality)
+
+        # Open the image.  Pillow only reads the header here, the pixels are decoded on first use.
+        image = Image.open(image_data if hasattr(image_data, 'read') else BytesIO(image_data))
 
         # Get the current image mode. It could be 'RGB' for color photos, 'I;16B' for 16-bit grayscale, etc.
         mode = image.mode
 
         #If image.mode begins with 'I;' then it is a 32-bit signed integer image
         if image.mode.startswith('I;'):
-            mode = 'I' 
+            mode = 'I'
+
+        # Work out the size each derivative needs from the header rather than materializing the pixel bytes
+        target_sizes = {name: self._get_target_size(image.width, image.height, mode, settings) for name, settings in derivative_settings.items()}
+
+        # JPEG can decode straight to 1/2, 1/4 or 1/8 scale using the DCT.  This has to happen before the pixels are
+        # loaded, so it is limited by the largest derivative we need.
+        draft_size = None
+        if None not in target_sizes.values() and strategy['draft_gap'] is not None and image.format == 'JPEG':
+            largest_size = max(target_sizes.values())
+            draft_size = (int(largest_size[0] * strategy['draft_gap']), int(largest_size[1] * strategy['draft_gap']))
+
+        # A huge original, ex: a 200 MP panorama, is decoded at the smallest scale that fits the decode budget,
+        # whatever the strategy, rather than at full resolution
+        budget_size = self._get_budget_size(image, mode)
+        if budget_size is not None:
+            draft_size = budget_size if draft_size is None else (min(draft_size[0], budget_size[0]), min(draft_size[1], budget_size[1]))
+
+        if draft_size is not None:
+            image.draft(None, draft_size)
+
+        with telemetry.span('image decode', {'image.format': image.format, 'image.width': image.width, 'image.height': image.height}):
+            image.load()
+
+            # Convert the image to the new mode.  Skip the conversion when nothing changes, it would copy the whole raster.
+            if mode != image.mode:
+                image = image.convert(mode)
+
+        # Produce the derivatives from largest to smallest.  Each one is resampled from the previous one, which is
+        # far cheaper than starting again from the full resolution image each time.
+        source_image = image
+        derivatives = {}
+        for name in sorted(derivative_settings, key=lambda name: target_sizes[name] or image.size, reverse=True):
+            if target_sizes[name] is not None:
+                with telemetry.span('image shrink', {'image.derivative': name}):
+                    source_image = self._shrink(source_image, target_sizes[name], strategy)
+
+            with telemetry.span('image encode', {'image.derivative': name, 'image.output_format': derivative_settings[name]['format']}):
+                derivatives[name] = self._encode_to_fit(source_image, derivative_settings[name], strategy)
+
+        # Hash the smallest derivative, it is already decoded and the cheapest to shrink again
+        with telemetry.span('image hash'):
+            perceptual_hash = self.perceptual_hash(source_image)
+        for derivative in derivatives.values():
+            derivative['perceptual_hash'] = perceptual_hash
+
+        # Hand the derivatives back in the order they were asked for
+        return {name: derivatives[name] for name in derivative_settings}
+
+    def perceptual_hash(self, image):
+        """
+        This function computes the difference hash (dHash) of an image.  Resized, recropped and recompressed
+        copies of an image have hashes within a small Hamming distance of each other.
+
+        Parameters:
+        image (PIL.Image.Image): The decoded image.
+
+        Returns:
+        int: The 64 bit hash.
+
+        """
+
+        # Shrink to a 9x8 grayscale image, averaging every pixel so that noise and compression artifacts cancel out
+        image = self._convert_for_format(image, 'JPEG').convert('L')
+        image = image.resize((ImageHelper.HASH_SIZE + 1, ImageHelper.HASH_SIZE), Image.Resampling.BOX, reducing_gap=2.0)
+        pixels = image.tobytes()
+
+        # Each bit records whether a pixel is brighter than its right hand neighbour
+        image_hash = 0
+        for row in range(ImageHelper.HASH_SIZE):
+            for column in range(ImageHelper.HASH_SIZE):
+                offset = row * (ImageHelper.HASH_SIZE + 1) + column
+                image_hash = (image_hash << 1) | (pixels[offset] > pixels[offset + 1])
+        return image_hash
+
+    def get_derivative_names(self):
+        """
+        This function reads the names of the derivatives to produce from the IMAGE_DERIVATIVES environment variable.
+
+        Returns:
+        list: The derivative names, always starting with the primary 'face' derivative.
+
+        """
+
+        names = [ImageHelper.PRIMARY_DERIVATIVE]
+        for name in os.getenv('IMAGE_DERIVATIVES', '').split(','):
+            name = name.strip().lower()
+            if name and name not in names:
+                names.append(name)
+        return names
+
+    def get_resized_filename(self, filename, derivative, extension):
+        """
+        This function builds the resized blob name for a derivative of an original image.
+
+        Parameters:
+        filename (str): The name of the blob in the original image container.
+        derivative (str): The derivative name.
+        extension (str): The file extension of the derivative's output format.
+
+        Returns:
+        str: The primary derivative keeps the original name with the new extension, ex: photo.png.  Other
+             derivatives include their name, ex: photo.llm.jpg.
+
+        """
+
+        base_filename = os.path.splitext(filename)[0]
+        if derivative == ImageHelper.PRIMARY_DERIVATIVE:
+            return f"{base_filename}.{extension}"
+        return f"{base_filename}.{derivative}.{extension}"
+
+    def get_output_settings(self, derivative=None):
+        """
+        This function reads the output encoding settings for a derivative from the environment.  The primary
+        derivative uses the RESIZED_IMAGE_* settings.  Other derivatives use <NAME>_IMAGE_* settings, ex:
+        LLM_IMAGE_FORMAT, and fall back to DERIVATIVE_DEFAULTS and then the RESIZED_IMAGE_* settings.
+
+        Parameters:
+        derivative (str): The derivative name.  Defaults to the primary 'face' derivative.
+
+        Returns:
+        dict: The 'format' (PNG, JPEG or WEBP), encoder 'quality', 'optimize' flag, 'max_bytes' target encoded size,
+              the 'max_dimension' of the longest side and the 'max_raster_bytes' decoded raster budget.
+
+        """
+
+        if derivative is None:
+            derivative = ImageHelper.PRIMARY_DERIVATIVE
+
+        defaults = ImageHelper.DERIVATIVE_DEFAULTS.get(derivative, {})
+
+        def setting(name, default):
+            value = None
+            if derivative != ImageHelper.PRIMARY_DERIVATIVE:
+                value = os.getenv(f"{derivative.upper()}_IMAGE_{name}")
+            if value is None:
+                value = defaults.get(name)
+            if value is None:
+                value = os.getenv(f"RESIZED_IMAGE_{name}", default)
+            return value
+
+        format = setting('FORMAT', 'PNG').upper()
+        if format == 'JPG':
+            format = 'JPEG'
+
+        if format not in ImageHelper.OUTPUT_FORMATS:
+            raise ValueError(f"Unknown resized image format '{format}'.  Expected one of {', '.join(ImageHelper.OUTPUT_FORMATS)}.")
+
+        max_bytes = setting('MAX_BYTES', None)
+
+        return {
+            'format': format,
+            'quality': int(setting('QUALITY', '85')),
+            'optimize': str(setting('OPTIMIZE', 'false')).lower() == 'true',
+            'max_bytes': int(max_bytes) if max_bytes else None,
+            'max_dimension': int(setting('MAX_DIMENSION', '4096')),
+            'max_raster_bytes': int(setting('MAX_RASTER_BYTES', str(ImageHelper.MAX_RASTER_BYTES)))
+        }
+
+    def _get_target_size(self, width, height, mode, output_settings):
+        # The longest side is always capped
+        scale_factor = min(1.0, output_settings['max_dimension'] / max(width, height))
+
+        # When we are fitting to an encoded size the encoder does the rest.  Otherwise the decoded raster is capped too.
+        if output_settings['max_bytes'] is None:
+            # Calculate the size of the decoded raster
+            image_size_bytes = self.raster_size(width, height, mode)
+
+            # If the image size is greater than max_raster_bytes, resize it
+            if image_size_bytes > output_settings['max_raster_bytes']:
+                scale_factor = min(scale_factor, (output_settings['max_raster_bytes'] / image_size_bytes) ** 0.5)
+
+        if scale_factor >= 1.0:
+            return None
+
+        # Calculate the new size of the image
+        return (max(1, int(width * scale_factor)), max(1, int(height * scale_factor)))
+
+    def _encode_to_fit(self, image, output_settings, strategy):
+        # Convert the image to a mode the output encoder supports
+        image = self._convert_for_format(image, output_settings['format'])
+
+        # Encode the image into an in-memory buffer
+        encoded_data, encoded_quality = self._encode(image, output_settings)
+
+        # If the encoder could not get under the target size, keep shrinking until it does.  Each attempt
+        # is resampled from the same source so the quality does not degrade with every pass.
+        source_image = image
+        while output_settings['max_bytes'] is not None and len(encoded_data) > output_settings['max_bytes']:
+            scale_factor = (output_settings['max_bytes'] / len(encoded_data)) ** 0.5 * 0.95
+            new_size = (max(1, int(image.width * scale_factor)), max(1, int(image.height * scale_factor)))
+            if new_size == image.size:
+                # The image can't get any smaller, ex: the container overhead alone is over the limit
+                raise ValueError(f"Could not encode the image as {output_settings['format']} within {output_settings['max_bytes']} bytes, "
+                                 f"it is {len(encoded_data)} bytes at {image.width}x{image.height}")
+            image = self._shrink(source_image, new_size, strategy)
+            encoded_data, encoded_quality = self._encode(image, output_settings)
+
+        return {
+            'data': encoded_data,
+            'format': output_settings['format'],
+            'extension': ImageHelper.OUTPUT_FORMATS[output_settings['format']]['extension'],
+            'quality': encoded_quality,
+            'width': image.width,
+            'height': image.height
+        }
+
+    def _get_budget_size(self, image, mode):
+        # The decoded raster, and the converted copy when the mode changes, have to fit in the budget
+        def decoded_bytes(width, height):
+            converted_bytes = self.raster_size(width, height, mode) if mode != image.mode else 0
+            return self.raster_size(width, height, image.mode) + converted_bytes
+
+        budget = self.get_decode_budget()
+        if decoded_bytes(image.width, image.height) <= budget:
+            return None
+
+        # Only JPEG can be scaled as it is decoded, anything else would be decoded at full resolution
+        if image.format == 'JPEG':
+            for scale in ImageHelper.DRAFT_SCALES:
+                if decoded_bytes(-(-image.width // scale), -(-image.height // scale)) <= budget:
+                    # draft() picks the largest scale that keeps the image at least this size
+                    return (image.width // scale, image.height // scale)
+
+        raise ImageTooLargeError(f"A {image.width}x{image.height} {image.format} image can't be decoded within the budget of {budget} bytes")
+
+    def get_decode_budget(self):
+        """
+        This function returns the most memory the decoded pixels of an original may take, from
+        IMAGE_DECODE_MAX_BYTES or 256 MB.
+        """
+
+        return int(os.getenv('IMAGE_DECODE_MAX_BYTES', str(256*1024*1024)))
+
+    def get_max_original_bytes(self):
+        """
+        This function returns the size of the largest original image that is downloaded, from
+        ORIGINAL_IMAGE_MAX_BYTES or 256 MB.
+        """
+
+        return int(os.getenv('ORIGINAL_IMAGE_MAX_BYTES', str(256*1024*1024)))
+
+    def _shrink(self, image, new_size, strategy):
+        # Shrink by a whole number factor first.  reduce() is a cheap box filter compared to a full LANCZOS pass.
+        if strategy['reduce_gap'] is not None:
+            reduce_factor = int(min(image.width / (new_size[0] * strategy['reduce_gap']), image.height / (new_size[1] * strategy['reduce_gap'])))
+            if reduce_factor >= 2:
+                image = image.reduce(reduce_factor)
+
+        # Resize the image to the final size
+        return image.resize(new_size, strategy['resample'])
+
+    def _convert_for_format(self, image, format):
+        supported_modes = ImageHelper.OUTPUT_FORMATS[format]['modes']
+
+        if supported_modes is None or image.mode in supported_modes:
+            return image
+
+        # 16-bit grayscale has to be scaled down to 8-bit, a plain convert would clip it to white
+        if image.mode == 'I':
+            return image.point(lambda i: i * (1 / 256)).convert('L')
+
+        if 'L' in supported_modes and image.mode in ('1', 'LA'):
+            return image.convert('L')
+
+        if 'RGBA' in supported_modes and image.has_transparency_data:
+            return image.convert('RGBA')
+
+        return image.convert('RGB')
+
+    def _encode(self, image, output_settings):
+        format = output_settings['format']
+
+        # PNG is lossless, so there is no quality to trade away
+        if format == 'PNG':
+            return self._save(image, output_settings, None), None
+
+        quality = output_settings['quality']
+        encoded_data = self._save(image, output_settings, quality)
+
+        if output_settings['max_bytes'] is None or len(encoded_data) <= output_settings['max_bytes']:
+            return encoded_data, quality
+
+        # Binary search for the highest quality that fits under the target size
+        best_data, best_quality = None, None
+        low, high = ImageHelper.MIN_FIT_QUALITY, quality - 1
+        while low <= high:
+            quality = (low + high) // 2
+            encoded_data = self._save(image, output_settings, quality)
+            if len(encoded_data) <= output_settings['max_bytes']:
+                best_data, best_quality = encoded_data, quality
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        # Nothing fitted, hand back the smallest attempt so the caller can shrink the image
+        if best_data is None:
+            return encoded_data, quality
+
+        return best_data, best_quality
+
+    def _save(self, image, output_settings, quality):
+        output = BytesIO()
+
+        if output_settings['format'] == 'PNG':
+            image.save(output, format='PNG', optimize=output_settings['optimize'])
+        elif output_settings['format'] == 'JPEG':
+            image.save(output, format='JPEG', quality=quality, optimize=output_settings['optimize'])
+        else:
+            # WebP trades encode time for size through the method setting rather than an optimize flag
+            image.save(output, format='WEBP', quality=quality, method=6 if output_settings['optimize'] else 4)
+
+        return output.getvalue()
 
-        # Convert the image to the new mode
-        image = image.convert(mode)
+    def _get_strategy(self, quality):
+        # Fall back to the deployment setting when the caller did not ask for a specific strategy
+        if quality is None:
+            quality = os.getenv('IMAGE_RESIZE_QUALITY', 'balanced')
 
-        max_size_bytes=6*1024*1024
+        try:
+            return ImageHelper.RESIZE_STRATEGIES[quality.lower()]
+        except KeyError:
+            raise ValueError(f"Unknown resize quality '{quality}'.  Expected one of {', '.join(ImageHelper.RESIZE_STRATEGIES)}.")
 
-        # Calculate the size of the image in bytes
-        image_size_bytes = len(image.tobytes())
+    @staticmethod
+    def raster_size(width, height, mode):
+        """
+        This function calculates the size in bytes of a decoded raster without decoding it.
 
-        # If the image size is greater than max_size_bytes, resize it
-        if image_size_bytes > max_size_bytes:
-            # Calculate the scale factor
-            scale_factor = (max_size_bytes / image_size_bytes) ** 0.5
-            # Calculate the new size of the image
-            new_size = (int(image.width * scale_factor), int(image.height * scale_factor))
-            # Resize the image
-            image = image.resize(new_size, Image.Resampling.LANCZOS)
+        Parameters:
+        width (int): The width of the image in pixels.
+        height (int): The height of the image in pixels.
+        mode (str): The Pillow image mode, ex: 'RGB', 'L', 'I;16B'.
 
-        # Generate a temporary file name
-        temp_image_name = uuid.uuid4()
-        # Get the path to the temporary file
-        file_path = os.path.join(tempfile.gettempdir(), f'{temp_image_name}.png')
+        Returns:
+        int: The number of bytes the decoded raster occupies (width x height x bands x bytes per band).
 
-        # Save the image to the temporary file
-        image.save(file_path, format='PNG')
+        """
 
-        # Open the image from the temporary file
-        image = Image.open(file_path)
+        bands = Image.getmodebands(mode)
 
-        # Create a new BlobClient for the resized blob
-        resized_filename = f"{os.path.splitext(filename)[0]}.png"
-        resized_blob_client = blob_service_client.get_blob_client(os.getenv('RESIZED_IMAGE_CONTAINER'), resized_filename)
+        # Bilevel images are packed eight pixels to a byte
+        if mode == '1':
+            return (width + 7) // 8 * height
 
-        # Open the temp file in read mode
-        with open(image.filename, "rb") as data:
-            # Upload the contents of the file to the blob
-            resized_blob_client.upload_blob(data, overwrite=True)
-    
-        # Remove the local temp file
-        os.remove(image.filename)
+        # 16-bit integer modes use two bytes per band, 32-bit integer and float modes use four
+        if mode.startswith('I;16'):
+            bytes_per_band = 2
+        elif mode in ('I', 'F'):
+            bytes_per_band = 4
+        else:
+            bytes_per_band = 1
 
-        return resized_filename
\ No newline at end of file
+        return width * height * bands * bytes_per_band
@@ -0,0 +1,82 @@
+import json, base64
+
+
+class ImageSource:
+    """
+    An image handed to the AI services.  It is either a URL the service fetches the image from, or the encoded
+    image bytes which are posted to the service directly.
+    """
+
+    def __init__(self, url=None, data=None, content_type=None):
+        if (url is None) == (data is None):
+            raise ValueError("An ImageSource needs exactly one of url or data.")
+
+        self.url = url
+        self.data = data
+        self.content_type = content_type
+
+    @staticmethod
+    def from_url(url):
+        return ImageSource(url=url)
+
+    @staticmethod
+    def from_bytes(data, content_type):
+        return ImageSource(data=data, content_type=content_type)
+
+    @staticmethod
+    def wrap(image):
+        """
+        This function lets the services accept either a plain URL string or an ImageSource.
+
+        Parameters:
+        image (str or ImageSource): The image to wrap.
+
+        Returns:
+        ImageSource: The image as an ImageSource.
+
+        """
+
+        if isinstance(image, ImageSource):
+            return image
+        return ImageSource.from_url(image)
+
+    @property
+    def is_inline(self):
+        return self.data is not None
+
+    def face_request(self):
+        """
+        This function builds the Content-Type header and body for the Face and Vision APIs.  Inline images are
+        posted as application/octet-stream, URLs are posted as a JSON document.
+
+        Returns:
+        tuple: The Content-Type header value and the request body.
+
+        """
+
+        if self.is_inline:
+            return 'application/octet-stream', self.data
+
+        return 'application/json', json.dumps({
+            'url': self.url,
+        })
+
+    def openai_url(self):
+        """
+        This function builds the image_url value for an Azure OpenAI chat completions request.  Inline images
+        are sent as a base64 data URL.
+
+        Returns:
+        str: The URL of the image, or a data URL containing it.
+
+        """
+
+        if self.is_inline:
+            return f"data:{self.content_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+        return self.url
+
+    def __str__(self):
+        # Keep the logs readable, an inline image would otherwise be dumped into them
+        if self.is_inline:
+            return f"<inline {self.content_type}, {len(self.data)} bytes>"
+        return self.url
@@ -1,9 +1,19 @@
-import os, requests, logging
+import os, logging
+import shared.http_client as http_client
+import shared.event_loop as event_loop
+from shared.image_source import ImageSource
 
 class NarrativeGenerator:
 
-    def generate_narrative(self, image_url):
-        logging.info(f"Generating narrative for image: {image_url}")
+    # The prompts are part of the result cache version, see ImageProcessor._get_cache_version
+    SYSTEM_PROMPT = "You are a helpful assistant that looks at images and describes the image(s) in as much detail as possible. Don't use any apostrophe characters (like this ') in your response or possessive nouns (like the man's) in your response."
+
+    USER_PROMPT = "Describe the scene in this picture with as much detail as possible. Don't use any apostrophe characters (like this ') in your response or possessive nouns (like the man's) in your response. Review your output, and if there are any apostrophe characters (like this ') replace them with double quotes."
+
+    async def generate_narrative_async(self, image):
+        # The image can be a URL or an ImageSource.  Inline images are sent as a base64 data URL.
+        image = ImageSource.wrap(image)
+        logging.info(f"Generating narrative for image: {image}")
         # Azure OpenAI GPT model details
         api_key = os.getenv("AZURE_OPEN_AI_KEY")
         gpt4_endpoint = os.getenv("AZURE_OPEN_AI_ENDPOINT")
@@ -22,7 +32,7 @@ class NarrativeGenerator:
                     "content": [
                         {
                             "type": "text",
-                            "text": "You are a helpful assistant that looks at images and describes the image(s) in as much detail as possible. Don't use any apostrophe characters (like this ') in your response or possessive nouns (like the man's) in your response."
+                            "text": NarrativeGenerator.SYSTEM_PROMPT
                         }
                     ]
                 },
@@ -31,12 +41,12 @@ class NarrativeGenerator:
                     "content": [
                         {
                             "type": "text",
-                            "text": "Describe the scene in this picture with as much detail as possible. Don't use any apostrophe characters (like this ') in your response or possessive nouns (like the man's) in your response. Review your output, and if there are any apostrophe characters (like this ') replace them with double quotes."
+                            "text": NarrativeGenerator.USER_PROMPT
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"{image_url}"
+                                "url": image.openai_url()
                             }
                         }
                     ]
@@ -48,13 +58,22 @@ class NarrativeGenerator:
         }
 
         # Send request to GPT-4 endpoint
-        response = requests.post(gpt4_endpoint, headers=headers, json=payload)
+        # max_tokens is the estimated token cost the rate limiter charges against the tokens per minute quota
+        response = await http_client.get_client().post(gpt4_endpoint, 'openai.narrative', tokens=payload["max_tokens"], headers=headers, json=payload)
         response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+        response_json = response.json()
+        http_client.record_usage('openai.narrative', response_json.get('usage'))
         
         # Extract the narrative from the response
-        narrative = response.json()['choices'][0]['message']['content']
+        narrative = response_json['choices'][0]['message']['content']
 
         logging.info(f"Narrative generated: {narrative}")
 
         return narrative
-        
\ No newline at end of file
+
+    def generate_narrative(self, image):
+        """
+        The synchronous wrapper for generate_narrative_async.
+        """
+
+        return event_loop.run_sync(self.generate_narrative_async(image))
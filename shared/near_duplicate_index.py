@@ -0,0 +1,206 @@
+import os, json, time, logging, threading, itertools
+import shared.append_log as append_log
+
+
+def hamming_distance(hash1, hash2):
+    return (hash1 ^ hash2).bit_count()
+
+
+class MultiIndexHash:
+    """
+    An in-memory index of 64 bit perceptual hashes that finds the nearest hash within a Hamming distance.
+
+    The hashes are split into blocks, and each block is indexed in its own table.  If two hashes are within
+    distance k, then by the pigeonhole principle at least one of their blocks is within k // blocks of each other,
+    so a lookup only has to probe the few block values near the query's blocks rather than scanning every hash.
+    """
+
+    HASH_BITS = 64
+
+    def __init__(self, blocks=3):
+        self.blocks = blocks
+        self.hashes = []
+        self.values = []
+        self._tables = [{} for _ in range(blocks)]
+
+        # Spread the bits over the blocks as evenly as possible, ex: 22, 21 and 21 bits for 3 blocks
+        self._block_bits = [MultiIndexHash.HASH_BITS // blocks + (1 if block < MultiIndexHash.HASH_BITS % blocks else 0) for block in range(blocks)]
+        self._block_shifts = [sum(self._block_bits[:block]) for block in range(blocks)]
+
+        # The XOR masks that turn a block value into every value within a radius of it, by block and radius
+        self._probe_masks = [{} for _ in range(blocks)]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, image_hash, value):
+        index = len(self.hashes)
+        self.hashes.append(image_hash)
+        self.values.append(value)
+        for block, block_value in enumerate(self._split(image_hash)):
+            self._tables[block].setdefault(block_value, []).append(index)
+
+    def nearest(self, image_hash, max_distance):
+        """
+        This function finds the indexed hash nearest to a hash.
+
+        Parameters:
+        image_hash (int): The hash to look up.
+        max_distance (int): The largest Hamming distance that counts as a match.
+
+        Returns:
+        tuple: The distance, the matching hash and its value, or None if nothing is within max_distance.
+
+        """
+
+        radius = max_distance // self.blocks
+        candidates = set()
+        for block, block_value in enumerate(self._split(image_hash)):
+            table = self._tables[block]
+            for mask in self._get_probe_masks(block, radius):
+                indexes = table.get(block_value ^ mask)
+                if indexes is not None:
+                    candidates.update(indexes)
+
+        best = None
+        hashes = self.hashes
+        for index in candidates:
+            distance = (image_hash ^ hashes[index]).bit_count()
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, hashes[index], self.values[index])
+        return best
+
+    def _split(self, image_hash):
+        return [(image_hash >> shift) & ((1 << bits) - 1) for shift, bits in zip(self._block_shifts, self._block_bits)]
+
+    def _get_probe_masks(self, block, radius):
+        masks = self._probe_masks[block].get(radius)
+        if masks is None:
+            masks = [0]
+            for distance in range(1, radius + 1):
+                for bits in itertools.combinations(range(self._block_bits[block]), distance):
+                    masks.append(sum(1 << bit for bit in bits))
+            self._probe_masks[block][radius] = masks
+        return masks
+
+
+class NearDuplicateIndex:
+    """
+    A persistent index of the perceptual hashes of processed images, used to find earlier results for burst
+    shots, re-crops and recompressed copies of the same photo.  Entries are kept per cache version, so only
+    results produced with the same configuration are matched.
+    """
+
+    def __init__(self, log=None, refresh_seconds=60):
+        self.log = log
+        self.refresh_seconds = refresh_seconds
+        self._indexes = {}
+        self._offset = 0
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    async def find(self, image_hash, version, max_distance):
+        """
+        This function finds the nearest processed image.
+
+        Parameters:
+        image_hash (int): The perceptual hash of the image.
+        version (str): The cache version of the configuration the image is processed with.
+        max_distance (int): The largest Hamming distance that counts as a near duplicate.
+
+        Returns:
+        dict: The 'distance', the 'perceptual_hash' and the entry that was added for the earlier image, or None.
+
+        """
+
+        await self._refresh()
+
+        with self._lock:
+            index = self._indexes.get(version)
+            match = index.nearest(image_hash, max_distance) if index is not None else None
+
+        if match is None:
+            return None
+
+        distance, match_hash, entry = match
+        return dict(entry, distance=distance, perceptual_hash=format(match_hash, '016x'))
+
+    async def add(self, image_hash, version, entry):
+        """
+        This function adds a processed image to the index.
+
+        Parameters:
+        image_hash (int): The perceptual hash of the image.
+        version (str): The cache version of the configuration the image was processed with.
+        entry (dict): What to hand back when the image is matched, ex: its filename and content hash.
+
+        """
+
+        if self.log is not None:
+            # The entry is picked up from the log by the next refresh, along with entries from other workers
+            await self.log.append(f"{image_hash:016x}\t{version}\t{json.dumps(entry)}\n".encode('utf-8'))
+            await self._refresh(force=True)
+        else:
+            with self._lock:
+                self._add(image_hash, version, entry)
+
+    async def _refresh(self, force=False):
+        if self.log is None:
+            return
+        if not force and self._refreshed is not None and time.monotonic() - self._refreshed < self.refresh_seconds:
+            return
+
+        offset = self._offset
+        data = await self.log.read(offset)
+        self._refreshed = time.monotonic()
+
+        data = append_log.whole_lines(data)
+        if not data:
+            return
+
+        with self._lock:
+            # Another refresh got here first
+            if self._offset != offset:
+                return
+
+            for line in data.decode('utf-8').splitlines():
+                try:
+                    image_hash, version, entry = line.split('\t', 2)
+                    self._add(int(image_hash, 16), version, json.loads(entry))
+                except ValueError:
+                    logging.warning(f"Skipping malformed near duplicate index entry: {line[:200]}")
+            self._offset = offset + len(data)
+
+    def _add(self, image_hash, version, entry):
+        index = self._indexes.get(version)
+        if index is None:
+            index = self._indexes[version] = MultiIndexHash()
+        index.add(image_hash, entry)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """
+    This function returns the NearDuplicateIndex shared by everything in the process, persisted to the
+    NEAR_DUPLICATE_CONTAINER blob container or the NEAR_DUPLICATE_PATH file if either is set.
+
+    Returns:
+    NearDuplicateIndex: The shared index.
+
+    """
+
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                log = None
+                if os.getenv('NEAR_DUPLICATE_CONTAINER') is not None:
+                    log = append_log.BlobAppendLog(os.getenv('NEAR_DUPLICATE_CONTAINER'), os.getenv('NEAR_DUPLICATE_BLOB', 'near_duplicates.log'), os.getenv('NEAR_DUPLICATE_CONNECTION'))
+                elif os.getenv('NEAR_DUPLICATE_PATH') is not None:
+                    log = append_log.FileAppendLog(os.getenv('NEAR_DUPLICATE_PATH'))
+
+                _index = NearDuplicateIndex(log, float(os.getenv('NEAR_DUPLICATE_REFRESH_SECONDS', '60')))
+    return _index
@@ -0,0 +1,168 @@
+import os, json, time, logging, datetime, threading
+import shared.append_log as append_log
+
+
+class PersonRegistry:
+    """
+    What this app knows about the persons in the Face API person directory: the name of each person, how many
+    faces were added to them, and when they were last changed.
+
+    The registry is written through, each change is recorded after the Face API call that made it succeeded.  It
+    lets AzureFaceRecognition skip the calls that would not change anything, ex: naming a person with the name
+    they already have, or creating a second person for a celebrity that already has one.
+
+    Changes are recorded in an append only log shared by every worker.  The log holds the number of faces
+    added rather than the total, so workers adding faces to the same person at the same time both count.
+    """
+
+    def __init__(self, log=None, refresh_seconds=60):
+        self.log = log
+        self.refresh_seconds = refresh_seconds
+        self._persons = {}
+        self._offset = 0
+        self._refreshed = None
+        self._lock = threading.Lock()
+
+    def get(self, person_id):
+        """
+        This function looks up a person.
+
+        Parameters:
+        person_id (str): The ID of the person in the Face API.
+
+        Returns:
+        dict: The 'name', 'face_count' and 'updated' time of the person, or None if the person is not known.
+
+        """
+
+        with self._lock:
+            person = self._persons.get(person_id)
+            return dict(person) if person is not None else None
+
+    def find_by_name(self, name):
+        """
+        This function finds the person with a name.
+
+        Parameters:
+        name (str): The name of the person, ex: a celebrity name.
+
+        Returns:
+        str: The ID of the person with the name and the most faces, or None if nobody has the name.
+
+        """
+
+        with self._lock:
+            matches = [(person['face_count'], person_id) for person_id, person in self._persons.items() if person['name'] == name]
+        return max(matches)[1] if matches else None
+
+    async def refresh(self, force=False):
+        """
+        This function loads the changes other workers recorded since the last refresh.  It does nothing until
+        refresh_seconds have passed since the last one, unless it is forced.
+        """
+
+        if self.log is None:
+            return
+        if not force and self._refreshed is not None and time.monotonic() - self._refreshed < self.refresh_seconds:
+            return
+
+        offset = self._offset
+        data = append_log.whole_lines(await self.log.read(offset))
+        self._refreshed = time.monotonic()
+        if not data:
+            return
+
+        with self._lock:
+            # Another refresh got here first
+            if self._offset != offset:
+                return
+
+            for line in data.decode('utf-8').splitlines():
+                try:
+                    self._apply(json.loads(line))
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f"Skipping malformed person registry entry: {line[:200]}")
+            self._offset = offset + len(data)
+
+    async def record(self, person_id, name=None, faces_added=0):
+        """
+        This function records a change the Face API made to a person.
+
+        Parameters:
+        person_id (str): The ID of the person.
+        name (str): The name the person was created or updated with, or None if it didn't change.
+        faces_added (int): The number of faces added to the person.
+
+        """
+
+        change = {'person_id': person_id, 'updated': datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        if name is not None:
+            change['name'] = name
+        if faces_added:
+            change['faces_added'] = faces_added
+        await self._write(change)
+
+    async def forget(self, person_id):
+        """
+        This function removes a person that no longer exists in the Face API, ex: because it was deleted there.
+
+        Parameters:
+        person_id (str): The ID of the person.
+
+        """
+
+        await self._write({'person_id': person_id, 'updated': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'deleted': True})
+
+    async def _write(self, change):
+        if self.log is not None:
+            # The change is picked up from the log by the next refresh, along with changes from other workers
+            await self.log.append((json.dumps(change) + '\n').encode('utf-8'))
+            await self.refresh(force=True)
+        else:
+            with self._lock:
+                self._apply(change)
+
+    def _apply(self, change):
+        person_id = change['person_id']
+        if change.get('deleted'):
+            self._persons.pop(person_id, None)
+            return
+
+        person = self._persons.get(person_id)
+        if person is None:
+            person = self._persons[person_id] = {'name': None, 'face_count': 0, 'updated': None}
+        if 'name' in change:
+            person['name'] = change['name']
+        person['face_count'] += change.get('faces_added', 0)
+        person['updated'] = change['updated']
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    This function returns the PersonRegistry shared by everything in the process, persisted to the
+    PERSON_REGISTRY_CONTAINER blob container or the PERSON_REGISTRY_PATH file if either is set.
+
+    Returns:
+    PersonRegistry: The shared registry, or None if PERSON_REGISTRY_ENABLED is false.
+
+    """
+
+    global _registry
+    if os.getenv('PERSON_REGISTRY_ENABLED', 'true').lower() != 'true':
+        return None
+
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                log = None
+                if os.getenv('PERSON_REGISTRY_CONTAINER') is not None:
+                    log = append_log.BlobAppendLog(os.getenv('PERSON_REGISTRY_CONTAINER'), os.getenv('PERSON_REGISTRY_BLOB', 'persons.log'), os.getenv('PERSON_REGISTRY_CONNECTION'))
+                elif os.getenv('PERSON_REGISTRY_PATH') is not None:
+                    log = append_log.FileAppendLog(os.getenv('PERSON_REGISTRY_PATH'))
+
+                _registry = PersonRegistry(log, float(os.getenv('PERSON_REGISTRY_REFRESH_SECONDS', '60')))
+    return _registry
@@ -0,0 +1,144 @@
+import asyncio, logging
+import shared.telemetry as telemetry
+
+
+class Stage:
+    """
+    A unit of work in a Pipeline.
+
+    A stage runs once every stage it requires has completed.  If a required stage was skipped, the stage is
+    skipped as well.  A stage also waits for the stages it runs after, when they are part of the plan, but it
+    still runs when they are skipped.  This is how an optional input, ex: the celebrity names, is declared.
+    """
+
+    def __init__(self, name, run, requires=(), after=(), prune=None):
+        """
+        Parameters:
+        name (str): The name of the stage, ex: 'detect'.
+        run (coroutine function): Called with the pipeline state dict.  Its return value is stored in the state
+                                  under the stage name.
+        requires (tuple): The names of the stages whose output this stage needs.
+        after (tuple): The names of the stages whose output this stage uses when they ran.
+        prune (function): Optional.  Called with the output of the stage and returns the names of the stages
+                          that no longer need to run, ex: face identification when no faces were detected.
+
+        """
+
+        self.name = name
+        self.run = run
+        self.requires = tuple(requires)
+        self.after = tuple(after)
+        self.prune = prune
+
+
+class Pipeline:
+    """
+    A declarative DAG of stages.  Independent stages run concurrently, each stage starts as soon as the stages it
+    depends on have finished, and stages can prune the ones downstream of them based on their output.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add_stage(self, name, run, requires=(), after=(), prune=None):
+        for dependency in tuple(requires) + tuple(after):
+            if dependency not in self.stages:
+                raise ValueError(f"Stage '{name}' depends on '{dependency}', which must be added first.")
+
+        self.stages[name] = Stage(name, run, requires, after, prune)
+        return self.stages[name]
+
+    def plan(self, selected=None):
+        """
+        This function works out which stages have to run to produce the selected ones.
+
+        Parameters:
+        selected (list): The names of the stages the caller wants.  Every stage when None.
+
+        Returns:
+        list: The names of the selected stages and the stages they require, in the order they were added.
+
+        """
+
+        if selected is None:
+            return list(self.stages)
+
+        unknown = [name for name in selected if name not in self.stages]
+        if unknown:
+            raise ValueError(f"Unknown stages {unknown}.  Expected some of {list(self.stages)}.")
+
+        # Walk the required stages.  Stages that are only run 'after' are not pulled in.
+        planned = set()
+        pending = list(selected)
+        while pending:
+            name = pending.pop()
+            if name not in planned:
+                planned.add(name)
+                pending.extend(self.stages[name].requires)
+
+        return [name for name in self.stages if name in planned]
+
+    async def run(self, state, selected=None):
+        """
+        This function runs the planned stages.
+
+        Parameters:
+        state (dict): Shared by every stage.  Each stage's output is added to it under the stage's name.
+        selected (list): The names of the stages to run, see plan().
+
+        Returns:
+        dict: The 'planned' stage names, the stages that were 'skipped' and, for each stage that ran, its
+              'timings' as a dict of 'start', 'end' and 'total_time'.
+
+        """
+
+        planned = self.plan(selected)
+        skipped = set()
+        timings = {}
+        tasks = {}
+
+        async def run_stage(stage):
+            # Wait for everything this stage depends on that is part of the plan
+            for dependency in stage.requires + stage.after:
+                if dependency in tasks:
+                    await tasks[dependency]
+
+            if stage.name in skipped or any(dependency in skipped for dependency in stage.requires):
+                logging.info(f"Skipping stage: {stage.name}")
+                skipped.add(stage.name)
+                return
+
+            with telemetry.TimedSpan(f"stage {stage.name}", {'pipeline.stage': stage.name}) as timing:
+                state[stage.name] = await stage.run(state)
+
+            timings[stage.name] = {
+                'start': timing.start,
+                'end': timing.end,
+                'total_time': timing.total_time
+            }
+            logging.info(f"Stage {stage.name} completed in {timing.total_time} seconds")
+            telemetry.stage_duration.record(timings[stage.name]['total_time'], {'pipeline.stage': stage.name})
+
+            if stage.prune is not None:
+                pruned = [name for name in stage.prune(state[stage.name]) if name in planned]
+                if pruned:
+                    logging.info(f"Stage {stage.name} pruned: {pruned}")
+                    skipped.update(pruned)
+
+        # Stages were added after their dependencies, so every task is created before anything awaits it
+        for name in planned:
+            tasks[name] = asyncio.ensure_future(run_stage(self.stages[name]))
+
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            # Don't leave the rest of the stages running when one of them fails
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        return {
+            'planned': planned,
+            'skipped': [name for name in planned if name in skipped],
+            'timings': timings
+        }
@@ -0,0 +1,164 @@
+import os, time, threading
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket.  Callers reserve tokens up front and are told how long to wait for them, so the
+    bucket can go into debt and queued callers are released in the order they arrived.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, cost, rate_factor=1.0):
+        """
+        This function takes tokens from the bucket.
+
+        Parameters:
+        cost (float): The number of tokens to take.
+        rate_factor (float): Scales the refill rate, ex: 0.5 to refill at half the configured rate.
+
+        Returns:
+        float: The number of seconds the caller must wait before using the tokens.
+
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate * rate_factor
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * rate)
+            self._updated = now
+
+            self._tokens -= cost
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / rate
+
+
+class EndpointLimiter:
+    """
+    The rate limits for one group of endpoints, ex: 'face' or 'openai'.  It limits requests per second and,
+    optionally, tokens per minute.  The rate backs off when the service throttles us and recovers while it is healthy.
+    """
+
+    # The rate is halved every time we are throttled, down to this fraction of the configured rate
+    MIN_RATE_FACTOR = 0.1
+
+    # The fraction of the configured rate that is added back after every successful call
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, requests_per_second=None, tokens_per_minute=None):
+        self.requests = None
+        self.tokens = None
+        self.rate_factor = 1.0
+        self._lock = threading.Lock()
+
+        if requests_per_second:
+            # Allow a burst of up to a second's worth of requests
+            self.requests = TokenBucket(requests_per_second, max(1.0, requests_per_second))
+
+        if tokens_per_minute:
+            # Azure OpenAI enforces its per minute quota over shorter windows, so only allow a 10 second burst
+            self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute / 6)
+
+    def reserve(self, tokens=0):
+        """
+        This function reserves capacity for one request.
+
+        Parameters:
+        tokens (int): The estimated token cost of the request, ex: its max_tokens.
+
+        Returns:
+        float: The number of seconds the caller must wait before sending the request.
+
+        """
+
+        delay = 0.0
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1, self.rate_factor))
+        if self.tokens is not None and tokens:
+            delay = max(delay, self.tokens.reserve(tokens, self.rate_factor))
+        return delay
+
+    def feedback(self, throttled):
+        """
+        This function adapts the rate to how the service responded.  Multiplicative decrease when throttled,
+        additive increase when not.
+
+        Parameters:
+        throttled (bool): Whether the service throttled the request.
+
+        """
+
+        with self._lock:
+            if throttled:
+                self.rate_factor = max(EndpointLimiter.MIN_RATE_FACTOR, self.rate_factor / 2)
+            elif self.rate_factor < 1.0:
+                self.rate_factor = min(1.0, self.rate_factor + EndpointLimiter.RECOVERY_STEP)
+
+
+class RateGovernor:
+    """
+    The process wide registry of endpoint limiters, shared by every pipeline stage.  Endpoints are grouped by the
+    prefix of their name, ex: 'face.detect' and 'face.identify' share the 'face' limiter.  Each group is configured
+    with the RATE_LIMIT_<GROUP>_RPS and RATE_LIMIT_<GROUP>_TPM environment variables.  Groups without either
+    setting are not limited.
+    """
+
+    def __init__(self):
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get_limiter(self, endpoint):
+        """
+        This function returns the limiter for the group an endpoint belongs to.
+
+        Parameters:
+        endpoint (str): The logical name of the endpoint, ex: 'face.detect'.
+
+        Returns:
+        EndpointLimiter: The limiter, or None if the group is not limited.
+
+        """
+
+        group = endpoint.split('.')[0]
+
+        with self._lock:
+            if group not in self._limiters:
+                requests_per_second = os.getenv(f"RATE_LIMIT_{group.upper()}_RPS")
+                tokens_per_minute = os.getenv(f"RATE_LIMIT_{group.upper()}_TPM")
+
+                limiter = None
+                if requests_per_second or tokens_per_minute:
+                    limiter = EndpointLimiter(
+                        float(requests_per_second) if requests_per_second else None,
+                        float(tokens_per_minute) if tokens_per_minute else None
+                    )
+                self._limiters[group] = limiter
+
+            return self._limiters[group]
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    """
+    This function returns the RateGovernor shared by everything in the process.
+
+    Returns:
+    RateGovernor: The shared governor.
+
+    """
+
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = RateGovernor()
+    return _governor
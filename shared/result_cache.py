@@ -0,0 +1,204 @@
+import os, hashlib, threading, asyncio, logging
+from collections import OrderedDict
+from azure.core.exceptions import ResourceNotFoundError
+import shared.storage as storage
+
+
+class MemoryCache:
+    """
+    A thread safe, in-process LRU cache of result JSON.  It is bounded by the total size of the cached values
+    rather than their count, so a few large results can't crowd out the process.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._values.get(key)
+            if value is not None:
+                # Mark the value as the most recently used
+                self._values.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = len(value)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._values:
+                self.size_bytes -= len(self._values.pop(key))
+            self._values[key] = value
+            self.size_bytes += size
+
+            # Evict the least recently used values until the cache fits
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self._values.popitem(last=False)
+                self.size_bytes -= len(evicted)
+
+
+class FileCacheStore:
+    """
+    A persistent cache tier in a local folder, ex: for scripts and local runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._read, self._get_path(key))
+
+    async def put(self, key, value):
+        await asyncio.to_thread(self._write, self._get_path(key), value)
+
+    def _get_path(self, key):
+        return os.path.join(self.path, *key.split('/')) + '.json'
+
+    def _read(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, value):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so a reader never sees a partial result
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(value)
+        os.replace(temp_path, path)
+
+
+class BlobCacheStore:
+    """
+    A persistent cache tier in a blob container, shared by every worker.
+    """
+
+    def __init__(self, container, connection_string=None):
+        self.container = container
+        self.connection_string = connection_string
+
+    async def get(self, key):
+        blob_client = storage.get_blob_service_client(self.connection_string).get_blob_client(self.container, f"{key}.json")
+        try:
+            return (await (await blob_client.download_blob()).readall()).decode('utf-8')
+        except ResourceNotFoundError:
+            return None
+
+    async def put(self, key, value):
+        blob_client = storage.get_blob_service_client(self.connection_string).get_blob_client(self.container, f"{key}.json")
+        await blob_client.upload_blob(value, overwrite=True)
+
+
+class ResultCache:
+    """
+    A content addressed cache of processing results.  Results are keyed by the SHA-256 of the original image
+    bytes and a version that changes whenever the configuration or prompts that produced them change.  Lookups
+    try the in-process memory tier first and then the persistent tier, if one is configured.
+    """
+
+    def __init__(self, memory=None, store=None):
+        self.memory = memory
+        self.store = store
+
+    @staticmethod
+    def hash_image(image_data):
+        return hashlib.sha256(image_data).hexdigest()
+
+    @staticmethod
+    def make_key(image_hash, version):
+        return f"{version}/{image_hash}"
+
+    async def get(self, key):
+        """
+        This function looks up a cached result.
+
+        Parameters:
+        key (str): The key returned by make_key.
+
+        Returns:
+        tuple: The cached result JSON and the tier it came from, 'memory' or 'persistent'.  (None, None) on a miss.
+
+        """
+
+        if self.memory is not None:
+            value = self.memory.get(key)
+            if value is not None:
+                return value, 'memory'
+
+        if self.store is not None:
+            try:
+                value = await self.store.get(key)
+            except Exception as e:
+                # The cache is an optimization, so a failing store is treated as a miss
+                logging.warning(f"Result cache lookup failed for {key}: {e}")
+                value = None
+
+            if value is not None:
+                if self.memory is not None:
+                    self.memory.put(key, value)
+                return value, 'persistent'
+
+        return None, None
+
+    async def put(self, key, value):
+        """
+        This function caches a result in every tier.
+
+        Parameters:
+        key (str): The key returned by make_key.
+        value (str): The result JSON.
+
+        """
+
+        if self.memory is not None:
+            self.memory.put(key, value)
+
+        if self.store is not None:
+            try:
+                await self.store.put(key, value)
+            except Exception as e:
+                logging.warning(f"Result cache store failed for {key}: {e}")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    This function returns the ResultCache shared by everything in the process, configured from the
+    RESULT_CACHE_MEMORY_BYTES, RESULT_CACHE_CONTAINER, RESULT_CACHE_CONNECTION and RESULT_CACHE_PATH
+    environment variables.
+
+    Returns:
+    ResultCache: The shared cache, or None if every tier is disabled.
+
+    """
+
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                memory = None
+                memory_bytes = int(os.getenv('RESULT_CACHE_MEMORY_BYTES', str(32 * 1024 * 1024)))
+                if memory_bytes > 0:
+                    memory = MemoryCache(memory_bytes)
+
+                store = None
+                if os.getenv('RESULT_CACHE_CONTAINER') is not None:
+                    store = BlobCacheStore(os.getenv('RESULT_CACHE_CONTAINER'), os.getenv('RESULT_CACHE_CONNECTION'))
+                elif os.getenv('RESULT_CACHE_PATH') is not None:
+                    store = FileCacheStore(os.getenv('RESULT_CACHE_PATH'))
+
+                _cache = ResultCache(memory, store)
+
+    if _cache.memory is None and _cache.store is None:
+        return None
+    return _cache
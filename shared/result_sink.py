@@ -0,0 +1,459 @@
+import os, json, uuid, asyncio, logging, sqlite3, datetime, tempfile, threading, atexit
+from azure.core.exceptions import HttpResponseError
+import shared.storage as storage
+import shared.append_log as append_log
+import shared.event_loop as event_loop
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks, ex: on Windows, the sink assumes it is the only process using its spool
+    fcntl = None
+
+
+class AppendBlobResultStore:
+    """
+    Keeps results as JSON lines in append blobs, one per hour, shared by every worker.  Each flush is appended in
+    as few blocks as it fits in, so concurrent workers never interleave.
+    """
+
+    # The largest block an append blob takes
+    MAX_BLOCK_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, container, prefix='', connection_string=None):
+        self.container = container
+        self.prefix = prefix
+        self.connection_string = connection_string
+        self._logs = {}
+        self._hour = None
+        self._rollover = 0
+
+    async def write(self, lines):
+        """
+        This function appends JSON lines to the blob of the current hour.
+
+        Parameters:
+        lines (bytes): Whole JSON lines.
+
+        """
+
+        hour = datetime.datetime.now(datetime.timezone.utc).strftime('%Y/%m/%d/%H')
+        if hour != self._hour:
+            self._hour, self._rollover = hour, 0
+        for block in self._split(lines):
+            while True:
+                blob_name = f"{self.prefix}{hour}.jsonl" if self._rollover == 0 else f"{self.prefix}{hour}-{self._rollover}.jsonl"
+                log = self._logs.get(blob_name)
+                if log is None:
+                    self._logs = {blob_name: append_log.BlobAppendLog(self.container, blob_name, self.connection_string)}
+                    log = self._logs[blob_name]
+                try:
+                    await log.append(block)
+                    break
+                except HttpResponseError as e:
+                    # An append blob takes 50,000 blocks, carry on in the next one
+                    if e.error_code != 'BlockCountExceedsLimit':
+                        raise
+                    self._rollover += 1
+
+    def _split(self, lines):
+        # Blocks of whole lines, each within the block size unless a single line is larger
+        start = 0
+        while start < len(lines):
+            end = start + AppendBlobResultStore.MAX_BLOCK_BYTES
+            if end < len(lines):
+                end = lines.rfind(b'\n', start, end) + 1 or lines.find(b'\n', end) + 1 or len(lines)
+            yield lines[start:end]
+            start = end
+
+    async def export(self, since=None):
+        """
+        This function reads back the results, oldest first.
+
+        Parameters:
+        since (str): Only the results processed at or after this ISO 8601 time, ex: '2024-06-01'.
+
+        Returns:
+        async iterator: The records, dicts with the 'id', 'processed' time, 'filename' and 'result'.  A record can
+                        appear twice after a crash, with the same 'id'.
+
+        """
+
+        container_client = storage.get_blob_service_client(self.connection_string).get_container_client(self.container)
+        since_hour = since[:13].replace('-', '/').replace('T', '/') if since else None
+        async for blob in container_client.list_blobs(name_starts_with=self.prefix):
+            if since_hour is not None and blob.name[len(self.prefix):len(self.prefix) + 13] < since_hour:
+                continue
+            data = await (await container_client.get_blob_client(blob.name).download_blob()).readall()
+            for line in append_log.whole_lines(data).splitlines():
+                record = json.loads(line)
+                if since is None or record['processed'] >= since:
+                    yield record
+
+
+class SqliteResultStore:
+    """
+    Keeps results in a local SQLite database, ex: for a single worker or a local backfill.  Records are keyed by
+    their id, so a batch written again after a crash is not stored twice.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._created = False
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        if not self._created:
+            with connection:
+                # WAL lets the results be queried while they are written
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS results (id TEXT PRIMARY KEY, processed TEXT NOT NULL, filename TEXT NOT NULL, result TEXT NOT NULL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS results_processed ON results (processed)")
+                connection.execute("CREATE INDEX IF NOT EXISTS results_filename ON results (filename)")
+            self._created = True
+        return connection
+
+    async def write(self, lines):
+        await asyncio.to_thread(self._write, lines)
+
+    def _write(self, lines):
+        rows = []
+        for line in lines.splitlines():
+            record = json.loads(line)
+            rows.append((record['id'], record['processed'], record['filename'], json.dumps(record['result'])))
+
+        with self._lock:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany("INSERT OR IGNORE INTO results (id, processed, filename, result) VALUES (?, ?, ?, ?)", rows)
+            finally:
+                connection.close()
+
+    async def export(self, since=None, page_size=1000):
+        """
+        This function reads back the results, oldest first, a page at a time.  See AppendBlobResultStore.export.
+        """
+
+        after = (since or '', '')
+        while True:
+            rows = await asyncio.to_thread(self._read_page, after, page_size)
+            for id, processed, filename, result in rows:
+                yield {'id': id, 'processed': processed, 'filename': filename, 'result': json.loads(result)}
+            if len(rows) < page_size:
+                return
+            after = (rows[-1][1], rows[-1][0])
+
+    def _read_page(self, after, page_size):
+        with self._lock:
+            connection = self._connect()
+        try:
+            return connection.execute("SELECT id, processed, filename, result FROM results WHERE (processed, id) > (?, ?) ORDER BY processed, id LIMIT ?",
+                                      (*after, page_size)).fetchall()
+        finally:
+            connection.close()
+
+
+class ResultBlobStore:
+    """
+    Keeps the result of each image as a blob of its own, '<name without extension>.json', ex: for an orchestrator
+    to pick up.  A later result for an image replaces the earlier one.
+    """
+
+    def __init__(self, container, connection_string=None, max_concurrency=16):
+        self.container = container
+        self.connection_string = connection_string
+        self.max_concurrency = max_concurrency
+
+    async def write(self, lines):
+        """
+        This function uploads the result blob of each record.
+
+        Parameters:
+        lines (bytes): Whole JSON lines.
+
+        """
+
+        # The last result wins when an image was processed more than once
+        results = {}
+        for line in lines.splitlines():
+            record = json.loads(line)
+            results[f"{os.path.splitext(record['filename'])[0]}.json"] = json.dumps(record['result'])
+
+        container_client = storage.get_blob_service_client(self.connection_string).get_container_client(self.container)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def upload(blob_name, result_json):
+            async with semaphore:
+                await container_client.get_blob_client(blob_name).upload_blob(result_json, overwrite=True)
+
+        await asyncio.gather(*(upload(blob_name, result_json) for blob_name, result_json in results.items()))
+
+
+class ResultSink:
+    """
+    Buffers results and writes them to a store in bulk, in the background on the worker's shared event loop, so
+    the caller never waits for them to be stored.
+
+    Each result is first appended to a segment file in a local spool folder, so a crash loses nothing.  A flush
+    closes the segment and writes every closed segment to the store, then deletes it.  A segment that fails to
+    be written stays in the spool for the next flush, and segments left behind by a worker that died are picked
+    up by any worker sharing the spool folder.  Results are stored at least once, each carries an id to tell
+    them apart.
+    """
+
+    def __init__(self, store, spool_path, flush_bytes=1024*1024, flush_seconds=5.0):
+        """
+        Parameters:
+        store (AppendBlobResultStore or SqliteResultStore): Where the results are written.
+        spool_path (str): The local folder for the segments waiting to be written.
+        flush_bytes (int): Flush once this much is waiting.
+        flush_seconds (float): Flush at least this often while anything is waiting.
+        """
+
+        self.store = store
+        self.spool_path = spool_path
+        self.flush_bytes = flush_bytes
+        self.flush_seconds = flush_seconds
+        os.makedirs(spool_path, exist_ok=True)
+
+        # Segments are named by the process that writes them, and the ones before them sort first
+        self._instance = f"{datetime.datetime.now(datetime.timezone.utc):%Y%m%d%H%M%S}-{uuid.uuid4().hex[:8]}"
+        self._sequence = 0
+        self._segment = None
+        self._segment_path = None
+        self._segment_bytes = 0
+        self._lock = threading.Lock()
+
+        self._wakeup = None
+        self._flush_lock = None
+        self._flusher = None
+
+    def add(self, filename, result_json):
+        """
+        This function queues a result to be stored.  It only appends the result to the spool, and returns without
+        waiting for the store.
+
+        Parameters:
+        filename (str): The name of the image.
+        result_json (str): The result as JSON, on one line.
+
+        """
+
+        processed = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        line = f'{{"id": "{uuid.uuid4().hex}", "processed": "{processed}", "filename": {json.dumps(filename)}, "result": {result_json}}}\n'.encode('utf-8')
+
+        with self._lock:
+            if self._segment is None:
+                self._open_segment()
+            os.write(self._segment, line)
+            self._segment_bytes += len(line)
+            full = self._segment_bytes >= self.flush_bytes
+
+        self._start()
+        if full:
+            event_loop.get_loop().call_soon_threadsafe(self._wakeup.set)
+
+    def _open_segment(self):
+        self._sequence += 1
+        self._segment_path = os.path.join(self.spool_path, f"{self._instance}-{self._sequence:08}.open")
+        self._segment = os.open(self._segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        # The lock tells the other workers sharing the spool that the segment is still being written
+        _try_lock(self._segment)
+        self._segment_bytes = 0
+
+    def _close_segment(self):
+        # A closed segment is ready to be written to the store
+        with self._lock:
+            if self._segment is None:
+                return
+            os.rename(self._segment_path, self._segment_path[:-len('.open')] + '.ready')
+            os.close(self._segment)
+            self._segment = None
+
+    def _start(self):
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    loop = event_loop.get_loop()
+                    self._wakeup = asyncio.Event()
+                    self._flusher = asyncio.run_coroutine_threadsafe(self._run(), loop)
+                    atexit.register(self.close)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.warning(f"Failed to flush the result sink, the results stay in {self.spool_path}: {e}")
+
+    async def flush(self):
+        """
+        This function writes everything waiting in the spool to the store.  It runs on the worker's shared event
+        loop, see close() to flush from anywhere else.
+
+        Returns:
+        int: The number of bytes written.
+
+        """
+
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            self._close_segment()
+            self._adopt_segments()
+
+            written = 0
+            for name in sorted(os.listdir(self.spool_path)):
+                if not name.endswith('.ready'):
+                    continue
+
+                path = os.path.join(self.spool_path, name)
+                try:
+                    segment = os.open(path, os.O_RDONLY)
+                except FileNotFoundError:
+                    continue
+                try:
+                    # Another worker sharing the spool is writing the segment, or already has
+                    if not _try_lock(segment) or os.fstat(segment).st_nlink == 0:
+                        continue
+                    with os.fdopen(os.dup(segment), 'rb') as f:
+                        lines = append_log.whole_lines(f.read())
+                    if lines:
+                        await self.store.write(lines)
+                        written += len(lines)
+                    os.unlink(path)
+                finally:
+                    os.close(segment)
+            return written
+
+    def _adopt_segments(self):
+        # A segment still open by a worker that died is ready, its lock went with the worker
+        for name in os.listdir(self.spool_path):
+            path = os.path.join(self.spool_path, name)
+            if not name.endswith('.open') or path == self._segment_path:
+                continue
+            try:
+                segment = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                if _try_lock(segment) and (fcntl is not None or not name.startswith(self._instance)):
+                    os.rename(path, path[:-len('.open')] + '.ready')
+            finally:
+                os.close(segment)
+
+    def close(self):
+        """
+        This function flushes the spool and stops the background flushes.  Whatever can't be written stays in
+        the spool for the next worker that starts.
+        """
+
+        if self._flusher is None:
+            self._close_segment()
+            return
+
+        self._flusher.cancel()
+        self._flusher = None
+        try:
+            event_loop.run_sync(self.flush())
+        except Exception as e:
+            logging.warning(f"Failed to flush the result sink, the results stay in {self.spool_path}: {e}")
+
+    async def export(self, since=None):
+        """
+        This function reads back the stored results, see AppendBlobResultStore.export.
+        """
+
+        async for record in self.store.export(since):
+            yield record
+
+
+def _try_lock(fd):
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_sink():
+    """
+    This function returns the result sink for the process, configured by the RESULT_SINK_CONTAINER or
+    RESULT_SINK_PATH, RESULT_SINK_SPOOL_PATH, RESULT_SINK_FLUSH_BYTES and RESULT_SINK_FLUSH_SECONDS environment
+    variables.
+
+    Returns:
+    ResultSink: The sink, or None if no store is configured.
+
+    """
+
+    global _sink
+    if _sink is None:
+        with _sink_lock:
+            if _sink is None:
+                store = None
+                if os.getenv('RESULT_SINK_CONTAINER') is not None:
+                    store = AppendBlobResultStore(os.getenv('RESULT_SINK_CONTAINER'), os.getenv('RESULT_SINK_PREFIX', ''), os.getenv('RESULT_SINK_CONNECTION'))
+                elif os.getenv('RESULT_SINK_PATH') is not None:
+                    store = SqliteResultStore(os.getenv('RESULT_SINK_PATH'))
+                if store is None:
+                    return None
+
+                _sink = _make_sink(store, _get_spool_path())
+    return _sink
+
+
+_blob_sink = None
+
+
+def get_blob_sink():
+    """
+    This function returns the result sink that uploads the result of each image as a blob of its own to
+    ORCHESTRATOR_RESULT_CONTAINER, in the storage account of ORCHESTRATOR_RESULT_CONNECTION.  Its spool is the
+    'orchestrator' folder in RESULT_SINK_SPOOL_PATH, and it flushes by RESULT_SINK_FLUSH_BYTES and
+    RESULT_SINK_FLUSH_SECONDS.
+
+    Returns:
+    ResultSink: The sink, or None if ORCHESTRATOR_RESULT_CONTAINER is not set.
+
+    """
+
+    global _blob_sink
+    if _blob_sink is None:
+        with _sink_lock:
+            if _blob_sink is None:
+                if os.getenv('ORCHESTRATOR_RESULT_CONTAINER') is None:
+                    return None
+                store = ResultBlobStore(os.getenv('ORCHESTRATOR_RESULT_CONTAINER'), os.getenv('ORCHESTRATOR_RESULT_CONNECTION'))
+                _blob_sink = _make_sink(store, os.path.join(_get_spool_path(), 'orchestrator'))
+    return _blob_sink
+
+
+def _get_spool_path():
+    return os.getenv('RESULT_SINK_SPOOL_PATH', os.path.join(tempfile.gettempdir(), 'result-sink-spool'))
+
+
+def _make_sink(store, spool_path):
+    return ResultSink(
+        store,
+        spool_path,
+        int(os.getenv('RESULT_SINK_FLUSH_BYTES', str(1024*1024))),
+        float(os.getenv('RESULT_SINK_FLUSH_SECONDS', '5'))
+    )
@@ -0,0 +1,66 @@
+import os, asyncio, weakref, datetime
+from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+from azure.storage.blob.aio import BlobServiceClient
+import shared.blob_transfer as blob_transfer
+import shared.telemetry as telemetry
+
+
+# The async storage clients belong to the event loop they were created on, so they are cached per loop and
+# per connection string.  Reusing them keeps the storage connections pooled across images.
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_blob_service_client(connection_string=None):
+    """
+    This function returns an async BlobServiceClient for the running event loop, creating it on first use.  The
+    client splits large blobs into chunks by blob_transfer.get_client_settings().
+
+    Parameters:
+    connection_string (str): The storage connection string.  Defaults to the STORAGE_ACCOUNT_CONNECTION
+                             environment variable.
+
+    Returns:
+    azure.storage.blob.aio.BlobServiceClient: The client.
+
+    """
+
+    if connection_string is None:
+        connection_string = os.getenv('STORAGE_ACCOUNT_CONNECTION')
+
+    loop_clients = _clients.setdefault(asyncio.get_running_loop(), {})
+    if connection_string not in loop_clients:
+        loop_clients[connection_string] = BlobServiceClient.from_connection_string(connection_string, **blob_transfer.get_client_settings())
+    return loop_clients[connection_string]
+
+
+async def copy_blob(source_blob_client, destination_blob_client, poll_seconds=0.5):
+    """
+    This function copies a blob with a server-side copy, so the data never passes through this process.  The
+    source is read through a short lived SAS, so it doesn't need to be public.
+
+    Parameters:
+    source_blob_client (azure.storage.blob.aio.BlobClient): The blob to copy.
+    destination_blob_client (azure.storage.blob.aio.BlobClient): Where to copy it to.
+    poll_seconds (float): How often to check on a copy the service runs in the background.
+
+    """
+
+    with telemetry.span('storage copy', {'storage.container': destination_blob_client.container_name, 'storage.blob': destination_blob_client.blob_name}):
+        sas_token = generate_blob_sas(
+            source_blob_client.account_name,
+            source_blob_client.container_name,
+            source_blob_client.blob_name,
+            account_key=source_blob_client.credential.account_key,
+            permission=BlobSasPermissions(read=True),
+            expiry=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1)
+        )
+        copy = await destination_blob_client.start_copy_from_url(f"{source_blob_client.url}?{sas_token}")
+
+        # Copies within an account usually finish straight away, larger ones are polled until the service is done
+        status = copy['copy_status']
+        while status == 'pending':
+            await asyncio.sleep(poll_seconds)
+            status = (await destination_blob_client.get_blob_properties()).copy.status
+
+        if status != 'success':
+            raise RuntimeError(f"Copying {source_blob_client.blob_name} to {destination_blob_client.container_name} ended with status {status}")
@@ -0,0 +1,194 @@
+import os, datetime, threading, contextlib
+import aiohttp
+from opentelemetry import trace, metrics
+
+
+# The tracer and meter come from whatever providers the process configures, see configure().  Until then they are
+# the OpenTelemetry API's no-op proxies, and every span and measurement below costs a function call or two.
+_tracer = trace.get_tracer('image-pipeline')
+_meter = metrics.get_meter('image-pipeline')
+
+image_duration = _meter.create_histogram('pipeline.image.duration', unit='s', description="How long an image took to process.")
+images_processed = _meter.create_counter('pipeline.images', unit='{image}', description="The images processed, by cache outcome.")
+stage_duration = _meter.create_histogram('pipeline.stage.duration', unit='s', description="How long each pipeline stage took.")
+faces_per_image = _meter.create_histogram('pipeline.image.faces', unit='{face}', description="The faces detected in each image.")
+http_duration = _meter.create_histogram('http.client.request.duration', unit='s', description="How long an outbound request took, retries included.")
+http_queue_time = _meter.create_histogram('http.client.queue_time', unit='s', description="How long an outbound request waited for the rate limiter.")
+http_retries = _meter.create_counter('http.client.retries', unit='{retry}', description="The outbound requests that were retried.")
+storage_duration = _meter.create_histogram('storage.transfer.duration', unit='s', description="How long a blob transfer took.")
+storage_bytes = _meter.create_counter('storage.transfer.bytes', unit='By', description="The bytes downloaded and uploaded.")
+
+# Handed out instead of a span while nothing records them.  The API's no-op spans still cost a context switch each.
+_no_span = contextlib.nullcontext(trace.INVALID_SPAN)
+
+
+def span(name, attributes=None, kind=trace.SpanKind.INTERNAL):
+    """
+    This function starts a span as a child of the current one.  Use it as a context manager, the span ends when
+    the block does, and records the exception if the block raises.
+
+    Parameters:
+    name (str): The name of the span, ex: 'stage resize'.
+    attributes (dict): The span attributes, ex: {'image.filename': 'photo.jpg'}.
+    kind (opentelemetry.trace.SpanKind): CLIENT for outbound calls, INTERNAL otherwise.
+
+    Returns:
+    context manager: Yields the opentelemetry.trace.Span.
+
+    """
+
+    if not is_enabled():
+        return _no_span
+    return _tracer.start_as_current_span(name, kind=kind, attributes=attributes)
+
+
+class TimedSpan:
+    """
+    A span that also measures how long its block took, so the durations reported in a result and the ones in the
+    traces come from the same measurement.  The measurement is taken whether or not spans are recorded.
+
+        with telemetry.TimedSpan('image resize') as timing:
+            ...
+        result['image_resize'] = timing.total_time
+    """
+
+    def __init__(self, name, attributes=None, kind=trace.SpanKind.INTERNAL):
+        """
+        Parameters:
+        name (str): The name of the span, see span().
+        attributes (dict): The span attributes.
+        kind (opentelemetry.trace.SpanKind): CLIENT for outbound calls, INTERNAL otherwise.
+        """
+
+        self._context = span(name, attributes, kind)
+        self.span = None
+        self.start = None
+        self.end = None
+        self.total_time = None
+
+    def __enter__(self):
+        self.span = self._context.__enter__()
+        self.start = datetime.datetime.now()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end = datetime.datetime.now()
+        self.total_time = (self.end - self.start).total_seconds()
+        return self._context.__exit__(*exc_info)
+
+    def elapsed(self):
+        """
+        This function returns how long the block has run so far, in seconds, or its total time once it ended.
+        """
+
+        if self.total_time is not None:
+            return self.total_time
+        return (datetime.datetime.now() - self.start).total_seconds()
+
+
+def is_enabled():
+    """
+    This function checks whether a tracer provider was configured, so spans are recorded.
+    """
+
+    return not isinstance(trace.get_tracer_provider(), (trace.ProxyTracerProvider, trace.NoOpTracerProvider))
+
+
+def aiohttp_trace_config():
+    """
+    This function returns an aiohttp TraceConfig that adds 'dns' and 'connect' spans to outbound requests, so a
+    slow request shows whether it waited on name resolution or on the TCP and TLS handshakes.  The connect span
+    covers both, aiohttp doesn't report the TLS handshake on its own.
+
+    Returns:
+    aiohttp.TraceConfig: The config for an aiohttp.ClientSession.
+
+    """
+
+    def start(name):
+        async def on_start(session, context, params):
+            context.spans = getattr(context, 'spans', {})
+            context.spans[name] = _tracer.start_span(name, kind=trace.SpanKind.CLIENT)
+        return on_start
+
+    def end(name):
+        async def on_end(session, context, params):
+            spans = getattr(context, 'spans', {})
+            if name in spans:
+                spans.pop(name).end()
+        return on_end
+
+    async def on_exception(session, context, params):
+        # A request that failed while resolving or connecting never reaches the end callbacks
+        for pending_span in getattr(context, 'spans', {}).values():
+            pending_span.record_exception(params.exception)
+            pending_span.set_status(trace.Status(trace.StatusCode.ERROR))
+            pending_span.end()
+        context.spans = {}
+
+    config = aiohttp.TraceConfig()
+    config.on_dns_resolvehost_start.append(start('dns'))
+    config.on_dns_resolvehost_end.append(end('dns'))
+    config.on_connection_create_start.append(start('connect'))
+    config.on_connection_create_end.append(end('connect'))
+    config.on_request_exception.append(on_exception)
+    return config
+
+
+_configured = None
+_configure_lock = threading.Lock()
+
+
+def configure(exporter=None):
+    """
+    This function installs the tracer and meter providers for the process, once.  It needs opentelemetry-sdk,
+    and azure-monitor-opentelemetry for the 'azure-monitor' exporter.
+
+    Parameters:
+    exporter (str): Where spans and metrics go, one of 'none', 'console', 'azure-monitor' or 'memory'.  Defaults
+                    to TELEMETRY_EXPORTER or 'none', which leaves the no-op providers in place.  'memory' keeps
+                    them in memory, ex: for tests.
+
+    Returns:
+    tuple: For 'memory', the InMemorySpanExporter and InMemoryMetricReader to read them back from.  None otherwise.
+
+    """
+
+    global _configured
+    exporter = (exporter or os.getenv('TELEMETRY_EXPORTER', 'none')).lower()
+    if exporter not in ('none', 'console', 'azure-monitor', 'memory'):
+        raise ValueError(f"Unknown telemetry exporter '{exporter}'.  Expected 'none', 'console', 'azure-monitor' or 'memory'.")
+
+    with _configure_lock:
+        if _configured is not None:
+            # OpenTelemetry only takes the first provider set in a process
+            if _configured[0] != exporter:
+                raise RuntimeError(f"Telemetry is already configured with the '{_configured[0]}' exporter")
+            return _configured[1]
+
+        readers = None
+        if exporter == 'azure-monitor':
+            # Exports to the Application Insights resource in APPLICATIONINSIGHTS_CONNECTION_STRING
+            from azure.monitor.opentelemetry import configure_azure_monitor
+            configure_azure_monitor()
+        elif exporter != 'none':
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import SimpleSpanProcessor, BatchSpanProcessor, ConsoleSpanExporter
+            from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+            from opentelemetry.sdk.metrics import MeterProvider
+            from opentelemetry.sdk.metrics.export import InMemoryMetricReader, PeriodicExportingMetricReader, ConsoleMetricExporter
+
+            tracer_provider = TracerProvider()
+            if exporter == 'memory':
+                span_exporter, metric_reader = InMemorySpanExporter(), InMemoryMetricReader()
+                tracer_provider.add_span_processor(SimpleSpanProcessor(span_exporter))
+                readers = (span_exporter, metric_reader)
+            else:
+                tracer_provider.add_span_processor(BatchSpanProcessor(ConsoleSpanExporter()))
+                metric_reader = PeriodicExportingMetricReader(ConsoleMetricExporter())
+
+            trace.set_tracer_provider(tracer_provider)
+            metrics.set_meter_provider(MeterProvider(metric_readers=[metric_reader]))
+
+        _configured = (exporter, readers)
+        return readers
@@ -0,0 +1,201 @@
+import os, socket, asyncio, hashlib, logging, datetime
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+import shared.storage as storage
+
+
+class ClaimedError(Exception):
+    """
+    Raised when an item is claimed by another worker.
+    """
+
+
+def shard_of(name, shard_count):
+    """
+    This function assigns a name to one of a number of shards.  The hash is stable across processes and
+    machines, unlike Python's hash().
+
+    Parameters:
+    name (str): The name, ex: of a blob.
+    shard_count (int): The number of shards.
+
+    Returns:
+    int: The shard, from 0 to shard_count - 1.
+
+    """
+
+    # CRC32 is cheaper, but its low bits barely change between sequential names like img0001.jpg and img0002.jpg
+    return int.from_bytes(hashlib.sha1(name.encode('utf-8')).digest()[:8], 'big') % shard_count
+
+
+async def shard_names(names, shard_index, shard_count):
+    """
+    This function filters a stream of names down to the ones in a shard, so each of shard_count workers
+    processes its own part of a container.
+
+    Parameters:
+    names (async iterator): The names.
+    shard_index (int): The shard to keep, from 0 to shard_count - 1.
+    shard_count (int): The number of shards.
+
+    Returns:
+    async iterator: The names in the shard.
+
+    """
+
+    async for name in names:
+        if shard_count <= 1 or shard_of(name, shard_count) == shard_index:
+            yield name
+
+
+class Claim:
+    """
+    A worker's claim on an item.  The lease behind it is renewed in the background until the claim is completed
+    or released, so items that take longer than a lease stay claimed.
+    """
+
+    def __init__(self, blob_client, lease, lease_seconds, worker_id):
+        self.blob_client = blob_client
+        self.lease = lease
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id
+        self.lost = False
+        self._renewal = asyncio.ensure_future(self._renew())
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self.lease.renew()
+            except Exception as e:
+                # Once the lease expires another worker can take the item over
+                logging.warning(f"Lost the claim on {self.blob_client.blob_name}: {e}")
+                self.lost = True
+                return
+
+    def check(self):
+        """
+        This function raises ClaimedError when the claim was lost, so a worker stops before it changes anything that
+        the worker which took the item over may be changing as well.
+        """
+
+        if self.lost:
+            raise ClaimedError(f"Lost the claim on {self.blob_client.blob_name}, another worker may be processing it")
+
+    async def complete(self):
+        """
+        This function marks the item as done, so bulk runs skip it, and releases the claim.  It raises ClaimedError
+        when the claim was lost, the item belongs to the worker that took it over.
+        """
+
+        self._renewal.cancel()
+        self.check()
+        metadata = {
+            'status': 'done',
+            'worker': self.worker_id,
+            'completed': datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+        try:
+            await self.blob_client.set_blob_metadata(metadata, lease=self.lease)
+        finally:
+            await self._release_lease()
+
+    async def release(self):
+        """
+        This function releases the claim without marking the item as done, ex: when processing it failed, so
+        another worker can pick it up.
+        """
+
+        self._renewal.cancel()
+        await self._release_lease()
+
+    async def _release_lease(self):
+        try:
+            await self.lease.release()
+        except Exception as e:
+            # The lease expires on its own
+            logging.warning(f"Could not release the claim on {self.blob_client.blob_name}: {e}")
+
+
+class WorkClaims:
+    """
+    Claims on items of work, ex: the blobs in a container, shared by workers on any number of machines.
+
+    Each item has a marker blob in the claims container, and a worker claims the item by taking a lease on its
+    marker.  Only one worker can hold the lease, the holder renews it while it works, and a finished item is
+    marked as done in the marker's metadata.  If a worker dies its lease expires within lease_seconds, and the
+    next worker to come across the item takes it over.
+    """
+
+    def __init__(self, container, kind, connection_string=None, lease_seconds=None):
+        """
+        Parameters:
+        container (str): The blob container for the marker blobs.
+        kind (str): The kind of work, ex: 'process'.  The same item has a separate claim for each kind.
+        connection_string (str): The storage connection string.  Defaults to STORAGE_ACCOUNT_CONNECTION.
+        lease_seconds (int): How long a claim lasts without being renewed, from 15 to 60 seconds.  Defaults to
+                             WORK_CLAIM_LEASE_SECONDS or 60.
+        """
+
+        self.container = container
+        self.kind = kind
+        self.connection_string = connection_string
+        self.lease_seconds = lease_seconds or int(os.getenv('WORK_CLAIM_LEASE_SECONDS', '60'))
+        if not 15 <= self.lease_seconds <= 60:
+            raise ValueError(f"The claim lease must be from 15 to 60 seconds, got {self.lease_seconds}")
+
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    async def claim(self, name, skip_done=True):
+        """
+        This function claims an item.
+
+        Parameters:
+        name (str): The name of the item, ex: the blob name.
+        skip_done (bool): Whether an item that was already done is left alone.  When False it is claimed again,
+                          ex: when someone asked for it to be processed again.
+
+        Returns:
+        Claim: The claim, or None if another worker holds it or the item is done and skip_done is True.
+
+        """
+
+        blob_client = storage.get_blob_service_client(self.connection_string).get_blob_client(self.container, f"{self.kind}/{name}")
+
+        # Create the marker blob the lease is taken on.  It already exists if the item was claimed before.
+        try:
+            await blob_client.upload_blob(b'', overwrite=False, metadata={'worker': self.worker_id})
+            created = True
+        except (ResourceExistsError, ResourceModifiedError):
+            created = False
+
+        try:
+            lease = await blob_client.acquire_lease(lease_duration=self.lease_seconds)
+        except ResourceExistsError:
+            # Another worker holds the lease
+            return None
+
+        if skip_done and not created:
+            properties = await blob_client.get_blob_properties()
+            if properties.metadata.get('status') == 'done':
+                await lease.release()
+                return None
+
+        return Claim(blob_client, lease, self.lease_seconds, self.worker_id)
+
+
+def get_claims(kind):
+    """
+    This function returns the WorkClaims for a kind of work, kept in the WORK_CLAIM_CONTAINER blob container.
+
+    Parameters:
+    kind (str): The kind of work, ex: 'process'.
+
+    Returns:
+    WorkClaims: The claims, or None if WORK_CLAIM_CONTAINER is not set.
+
+    """
+
+    container = os.getenv('WORK_CLAIM_CONTAINER')
+    if container is None:
+        return None
+    return WorkClaims(container, kind, os.getenv('WORK_CLAIM_CONNECTION'))